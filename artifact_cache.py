@@ -0,0 +1,240 @@
+import os
+import re
+import shutil
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Optional
+import requests
+from file_ops import atomic_copy
+
+# Default size limit of a shared artifact store
+DEFAULT_MAX_BYTES = 20 * 1024 ** 3
+
+_KEY_PATTERN = re.compile(r'^[A-Za-z0-9_.-]+$')
+
+
+def artifact_key(track: Dict, profile: str) -> Optional[str]:
+    """Return the store key for a track's finished MP3 in an output profile.
+
+    The ISRC identifies the recording across albums and playlists, the
+    Spotify track ID is the fallback for tracks without one.
+    """
+    if track.get('isrc'):
+        ident = track['isrc'].upper()
+    elif track.get('id'):
+        ident = f"spotify-{track['id']}"
+    else:
+        return None
+    key = f"{ident}.{profile}"
+    return key if _KEY_PATTERN.match(key) else None
+
+
+class DirectoryArtifactStore:
+    def __init__(self, root: str, max_bytes: int = DEFAULT_MAX_BYTES):
+        """Initialize a store of finished files in a (possibly network mounted) folder.
+
+        Files are published with a rename so readers never see a partial
+        file, and the least recently used ones are evicted once the folder
+        grows beyond max_bytes. A hit refreshes the file's mtime.
+        """
+        self.root = root
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.root, f"{key}.mp3")
+
+    def exists(self, key: str) -> bool:
+        """Return whether the store holds an artifact for key."""
+        return os.path.isfile(self.path(key))
+
+    def fetch(self, key: str, destination: str) -> bool:
+        """Copy the artifact for key to destination, returning False on a miss."""
+        path = self.path(key)
+        try:
+            os.utime(path)
+            os.makedirs(os.path.dirname(destination), exist_ok=True)
+            atomic_copy(path, destination)
+            return True
+        except FileNotFoundError:
+            return False
+        except OSError as e:
+            logging.warning(f"Failed to fetch {key} from artifact cache: {str(e)}")
+            return False
+
+    def publish(self, key: str, source) -> bool:
+        """Atomically store a finished file (path or file object) under key."""
+        try:
+            atomic_copy(source, self.path(key))
+        except OSError as e:
+            logging.warning(f"Failed to publish {key} to artifact cache: {str(e)}")
+            return False
+        self.evict()
+        return True
+
+    def evict(self) -> int:
+        """Delete least recently used files until the store fits in max_bytes."""
+        with self._lock:
+            entries = []
+            for entry in os.scandir(self.root):
+                if entry.is_file() and entry.name.endswith('.mp3'):
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total = sum(size for _, size, _ in entries)
+            removed = 0
+            for _, size, path in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                    removed += 1
+                except FileNotFoundError:
+                    pass
+                # Another instance may have removed it first, it's gone either way
+                total -= size
+            return removed
+
+
+class HttpArtifactStore:
+    def __init__(self, base_url: str, timeout: float = 60):
+        """Initialize a client for an artifact cache served by serve_artifact_cache."""
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self.session = requests.Session()
+
+    def exists(self, key: str) -> bool:
+        """Return whether the server holds an artifact for key, without downloading it."""
+        try:
+            response = self.session.head(f"{self.base_url}/{key}", timeout=self.timeout)
+            if response.status_code == 404:
+                return False
+            response.raise_for_status()
+            return True
+        except Exception as e:
+            logging.warning(f"Failed to look up {key} in artifact cache: {str(e)}")
+            return False
+
+    def fetch(self, key: str, destination: str) -> bool:
+        """Download the artifact for key to destination, returning False on a miss."""
+        try:
+            with self.session.get(f"{self.base_url}/{key}", stream=True, timeout=self.timeout) as response:
+                if response.status_code == 404:
+                    return False
+                response.raise_for_status()
+                os.makedirs(os.path.dirname(destination), exist_ok=True)
+                response.raw.decode_content = True
+                atomic_copy(response.raw, destination)
+            return True
+        except Exception as e:
+            logging.warning(f"Failed to fetch {key} from artifact cache: {str(e)}")
+            return False
+
+    def publish(self, key: str, source: str) -> bool:
+        """Upload a finished file under key."""
+        try:
+            with open(source, 'rb') as f:
+                response = self.session.put(f"{self.base_url}/{key}", data=f, timeout=self.timeout)
+            response.raise_for_status()
+            return True
+        except Exception as e:
+            logging.warning(f"Failed to publish {key} to artifact cache: {str(e)}")
+            return False
+
+
+def open_artifact_store(location: Optional[str], max_bytes: int = DEFAULT_MAX_BYTES):
+    """Return a store for a folder or an http(s) URL, or None if not configured."""
+    if not location:
+        return None
+    if location.startswith(('http://', 'https://')):
+        return HttpArtifactStore(location)
+    return DirectoryArtifactStore(location, max_bytes)
+
+
+def serve_artifact_cache(root: str, host: str = '0.0.0.0', port: int = 8765,
+                         max_bytes: int = DEFAULT_MAX_BYTES) -> None:
+    """Serve a DirectoryArtifactStore over HTTP (GET, HEAD and PUT /<key>) until interrupted."""
+    store = DirectoryArtifactStore(root, max_bytes)
+
+    class Handler(BaseHTTPRequestHandler):
+        def _key(self) -> Optional[str]:
+            key = self.path.lstrip('/')
+            return key if _KEY_PATTERN.match(key) else None
+
+        def do_GET(self):
+            key = self._key()
+            path = store.path(key) if key else None
+            if not path or not os.path.isfile(path):
+                self.send_error(404)
+                return
+            try:
+                f = open(path, 'rb')
+            except FileNotFoundError:
+                self.send_error(404)
+                return
+            with f:
+                os.utime(path)
+                self.send_response(200)
+                self.send_header('Content-Type', 'audio/mpeg')
+                self.send_header('Content-Length', str(os.fstat(f.fileno()).st_size))
+                self.end_headers()
+                shutil.copyfileobj(f, self.wfile)
+
+        def do_HEAD(self):
+            key = self._key()
+            path = store.path(key) if key else None
+            try:
+                size = os.path.getsize(path) if path else None
+            except OSError:
+                size = None
+            if size is None:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', 'audio/mpeg')
+            self.send_header('Content-Length', str(size))
+            self.end_headers()
+
+        def do_PUT(self):
+            key = self._key()
+            length = int(self.headers.get('Content-Length') or 0)
+            if not key or not length:
+                self.send_error(400)
+                return
+            tmp_path = f"{store.path(key)}.{threading.get_ident()}.upload"
+            try:
+                with open(tmp_path, 'wb') as f:
+                    remaining = length
+                    while remaining:
+                        chunk = self.rfile.read(min(remaining, 1024 * 1024))
+                        if not chunk:
+                            raise IOError("Upload ended early")
+                        f.write(chunk)
+                        remaining -= len(chunk)
+                os.replace(tmp_path, store.path(key))
+            except OSError as e:
+                logging.error(f"Failed to store upload for {key}: {str(e)}")
+                self.send_error(500)
+                return
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+            store.evict()
+            self.send_response(201)
+            self.end_headers()
+
+        def log_message(self, format, *args):
+            logging.info(f"{self.address_string()} {format % args}")
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    logging.info(f"Serving artifact cache {root} on {host}:{port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
@@ -0,0 +1,112 @@
+import threading
+import time
+from datetime import datetime
+from typing import Dict, List, Optional
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        """Initialize a thread-safe token bucket refilled at rate tokens per second.
+
+        A rate of 0 means unlimited. Callers reserve tokens up front and sleep
+        off any deficit outside the lock, so concurrent callers are served in
+        arrival order and share the rate fairly.
+        """
+        self._lock = threading.Lock()
+        self.rate = 0.0
+        self.capacity = 0.0
+        self._tokens = 0.0
+        self._last = time.monotonic()
+        self.set_rate(rate, capacity)
+
+    def set_rate(self, rate: float, capacity: Optional[float] = None) -> None:
+        """Change the refill rate; takes effect for the next reservation."""
+        with self._lock:
+            self._refill()
+            self.rate = max(float(rate or 0), 0.0)
+            # Allow bursts of up to one second's worth by default
+            self.capacity = float(capacity) if capacity else self.rate
+            self._tokens = min(self._tokens, self.capacity)
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        if self.rate:
+            self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def reserve(self, amount: float) -> float:
+        """Take amount tokens and return how many seconds the caller must wait."""
+        with self._lock:
+            if not self.rate:
+                return 0.0
+            self._refill()
+            self._tokens -= amount
+            return -self._tokens / self.rate if self._tokens < 0 else 0.0
+
+    def consume(self, amount: float) -> None:
+        """Block until amount tokens are available."""
+        delay = self.reserve(amount)
+        if delay > 0:
+            time.sleep(delay)
+
+
+def _minutes(value: str) -> int:
+    hours, minutes = value.split(':')
+    return int(hours) * 60 + int(minutes)
+
+
+class BandwidthGovernor:
+    def __init__(self, limit: int = 0, schedule: Optional[List[Dict]] = None):
+        """Initialize a process-wide download budget in bytes per second.
+
+        schedule entries look like {"start": "08:00", "end": "18:00",
+        "limit": 500000} and override the base limit during that local time
+        window; windows may wrap past midnight.
+        """
+        self.bucket = TokenBucket(0)
+        self.limit = 0
+        self.schedule: List[Dict] = []
+        self.configure(limit, schedule)
+
+    def configure(self, limit: int = 0, schedule: Optional[List[Dict]] = None) -> None:
+        """Replace the base limit and the time-of-day schedule."""
+        self.limit = max(int(limit or 0), 0)
+        self.schedule = list(schedule or [])
+        self._apply()
+
+    def set_limit(self, limit: int) -> None:
+        """Change the base limit, e.g. from the UI while a sync is running."""
+        self.limit = max(int(limit or 0), 0)
+        self._apply()
+
+    def current_limit(self, now: Optional[datetime] = None) -> int:
+        """Return the limit in effect at a given local time (default: now)."""
+        now = now or datetime.now()
+        minute = now.hour * 60 + now.minute
+        for window in self.schedule:
+            start, end = _minutes(window['start']), _minutes(window['end'])
+            inside = start <= minute < end if start <= end else (minute >= start or minute < end)
+            if inside:
+                return max(int(window.get('limit') or 0), 0)
+        return self.limit
+
+    def _apply(self) -> None:
+        limit = self.current_limit()
+        if limit != self.bucket.rate:
+            self.bucket.set_rate(limit)
+
+    def consume(self, amount: int) -> None:
+        """Wait until amount bytes may be transferred under the current limit."""
+        if amount <= 0:
+            return
+        if self.schedule:
+            self._apply()
+        self.bucket.consume(amount)
+
+
+_governor = BandwidthGovernor()
+
+
+def get_governor() -> BandwidthGovernor:
+    """Return the governor shared by every download in this process."""
+    return _governor
@@ -0,0 +1,82 @@
+import time
+import threading
+from typing import Dict, List, Optional
+from retry_policy import NETWORK, THROTTLED
+
+# Failures that say the link or upstream is overloaded; a missing video
+# or a bad match says nothing about how many workers we can afford
+CAPACITY_ERRORS = {NETWORK, THROTTLED}
+
+
+class AIMDController:
+    def __init__(self, min_limit: int = 1, max_limit: int = 1, interval: float = 30.0,
+                 decrease_factor: float = 0.5, error_threshold: float = 0.1):
+        """Initialize an additive-increase/multiplicative-decrease concurrency limit.
+
+        Every interval seconds the completed tracks per minute are compared
+        with the previous interval: if throughput went up the limit grows by
+        one, if the share of capacity errors is above error_threshold it is
+        multiplied by decrease_factor. Throttling cuts the limit immediately.
+        """
+        self.min_limit = max(1, min_limit)
+        self.max_limit = max(self.min_limit, max_limit)
+        self.interval = interval
+        self.decrease_factor = decrease_factor
+        self.error_threshold = error_threshold
+        self.limit = self.min_limit
+        self.decisions: List[Dict] = []
+        self._lock = threading.Lock()
+        self._last_rate: Optional[float] = None
+        self._reset_window()
+
+    def _reset_window(self) -> None:
+        self._window_start = time.monotonic()
+        self._completed = 0
+        self._errors = 0
+
+    def record(self, error_kind: Optional[str]) -> Optional[Dict]:
+        """Record one finished attempt and return a decision if the limit changed."""
+        with self._lock:
+            if error_kind is None:
+                self._completed += 1
+            elif error_kind in CAPACITY_ERRORS:
+                self._errors += 1
+            if error_kind == THROTTLED:
+                return self._decide(self._decrease(), 'throttled')
+            if time.monotonic() - self._window_start >= self.interval:
+                return self._evaluate()
+            return None
+
+    def _decrease(self) -> int:
+        return max(self.min_limit, int(self.limit * self.decrease_factor))
+
+    def _evaluate(self) -> Optional[Dict]:
+        elapsed = time.monotonic() - self._window_start
+        attempts = self._completed + self._errors
+        rate = self._completed / elapsed * 60 if elapsed > 0 else 0.0
+        error_rate = self._errors / attempts if attempts else 0.0
+        previous = self._last_rate
+        self._last_rate = rate
+        if error_rate > self.error_threshold:
+            return self._decide(self._decrease(), 'errors', rate, error_rate)
+        if previous is None or rate > previous:
+            return self._decide(min(self.limit + 1, self.max_limit), 'throughput up', rate, error_rate)
+        self._reset_window()
+        return None
+
+    def _decide(self, limit: int, reason: str, rate: Optional[float] = None,
+                error_rate: Optional[float] = None) -> Optional[Dict]:
+        self._reset_window()
+        if limit == self.limit:
+            return None
+        decision = {
+            'at': time.strftime('%H:%M:%S'),
+            'from': self.limit,
+            'to': limit,
+            'reason': reason,
+            'tracks_per_minute': round(rate, 2) if rate is not None else None,
+            'error_rate': round(error_rate, 3) if error_rate is not None else None,
+        }
+        self.limit = limit
+        self.decisions.append(decision)
+        return decision
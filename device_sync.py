@@ -0,0 +1,211 @@
+import os
+import queue
+import shutil
+import hashlib
+import logging
+import threading
+from dataclasses import dataclass, field
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+from json_store import JsonStore
+from local_library import read_audio_tags
+from file_ops import CHUNK_SIZE, atomic_copy
+
+# Folder on the device that holds the transfer manifest
+DEVICE_STATE_DIR = '.ipodfiller'
+
+# Space left free on the device for its own database and firmware (bytes)
+DEFAULT_RESERVE_BYTES = 64 * 1024 * 1024
+
+# Albums a worker may have waiting in the queue before the planner blocks
+QUEUE_DEPTH = 2
+
+
+@dataclass
+class TransferReport:
+    """Outcome of mirroring playlist folders onto a device."""
+    device: str
+    copied: List[str] = field(default_factory=list)
+    unchanged: int = 0
+    deleted: List[str] = field(default_factory=list)
+    skipped: List[str] = field(default_factory=list)
+    failed: Dict[str, str] = field(default_factory=dict)
+    copied_bytes: int = 0
+    cancelled: bool = False
+    error: Optional[str] = None
+
+
+def file_hash(path: str) -> str:
+    """Return the SHA-1 of a file's contents."""
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class DeviceSync:
+    def __init__(self, device_root: str, workers: int = 2, delete_removed: bool = False,
+                 reserve_bytes: int = DEFAULT_RESERVE_BYTES, skip_dirs: Tuple[str, ...] = ()):
+        """Initialize a delta transfer of playlist folders onto a mounted device.
+
+        A manifest on the device records the size, mtime and hash of every
+        source file at the time it was copied, so later transfers only copy
+        new or changed files. Work is grouped by album: each worker writes
+        one album at a time from a bounded queue, which keeps writes to slow
+        flash and hard disk iPods mostly sequential.
+        """
+        self.device_root = device_root
+        self.workers = max(1, workers)
+        self.delete_removed = delete_removed
+        self.reserve_bytes = reserve_bytes
+        self.skip_dirs = set(skip_dirs) | {DEVICE_STATE_DIR}
+        self.manifest = JsonStore(os.path.join(device_root, DEVICE_STATE_DIR, 'manifest.json'))
+
+    def _iter_sources(self, source_dir: str) -> Iterator[Tuple[str, str]]:
+        """Yield (source path, device-relative path) for every file in a playlist folder."""
+        name = os.path.basename(os.path.normpath(source_dir))
+        for dirpath, dirnames, filenames in os.walk(source_dir):
+            dirnames[:] = sorted(d for d in dirnames if d not in self.skip_dirs)
+            for filename in sorted(filenames):
+                if filename.endswith('.tmp'):
+                    continue
+                path = os.path.join(dirpath, filename)
+                relative = os.path.join(name, os.path.relpath(path, source_dir))
+                yield path, relative.replace(os.sep, '/')
+
+    def _is_current(self, source: str, relative: str, stat: os.stat_result) -> bool:
+        """Return whether the device already holds this version of source."""
+        entry = self.manifest.get(relative)
+        if not entry:
+            return False
+        target = os.path.join(self.device_root, relative)
+        try:
+            if os.path.getsize(target) != entry['size']:
+                return False
+        except OSError:
+            return False
+        if entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime:
+            return True
+        # Touched (e.g. retagged with identical tags) but maybe not changed
+        if entry['size'] == stat.st_size and entry.get('sha1') == file_hash(source):
+            entry['mtime'] = stat.st_mtime
+            self.manifest.set(relative, entry)
+            return True
+        return False
+
+    def plan(self, source_dirs: List[str], report: TransferReport) -> Tuple[List[List[Tuple[str, str, int]]], List[str]]:
+        """Return the copy jobs grouped by album and the device files to delete."""
+        albums: Dict[str, List[Tuple[str, str, int]]] = {}
+        seen = set()
+        for source_dir in source_dirs:
+            for source, relative in self._iter_sources(source_dir):
+                seen.add(relative)
+                stat = os.stat(source)
+                if self._is_current(source, relative, stat):
+                    report.unchanged += 1
+                    continue
+                tags = read_audio_tags(source) if source.lower().endswith(('.mp3', '.m4a')) else None
+                album = (tags or {}).get('album') or os.path.dirname(relative)
+                albums.setdefault(album, []).append((source, relative, stat.st_size))
+        removed = []
+        if self.delete_removed:
+            prefixes = tuple(f"{os.path.basename(os.path.normpath(d))}/" for d in source_dirs)
+            removed = [relative for relative, _ in self.manifest.items()
+                       if relative.startswith(prefixes) and relative not in seen]
+        return [albums[album] for album in sorted(albums)], removed
+
+    def _delete(self, relative: str, report: TransferReport) -> None:
+        target = os.path.join(self.device_root, relative)
+        try:
+            if os.path.exists(target):
+                os.remove(target)
+            self.manifest.delete(relative)
+            report.deleted.append(relative)
+        except OSError as e:
+            report.failed[relative] = str(e)
+
+    def _copy(self, source: str, relative: str) -> int:
+        """Copy one file to the device under a temporary name and rename it into place."""
+        target = os.path.join(self.device_root, relative)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        stat = os.stat(source)
+        digest = hashlib.sha1()
+        atomic_copy(source, target, digest)
+        self.manifest.set(relative, {'size': stat.st_size, 'mtime': stat.st_mtime, 'sha1': digest.hexdigest()})
+        return stat.st_size
+
+    def mirror(self, source_dirs: List[str],
+               on_event: Optional[Callable[[Dict], None]] = None,
+               is_cancelled: Optional[Callable[[], bool]] = None) -> TransferReport:
+        """Copy new and changed files of source_dirs to the device, album by album."""
+        emit = on_event or (lambda event: None)
+        is_cancelled = is_cancelled or (lambda: False)
+        report = TransferReport(device=self.device_root)
+        if not os.path.isdir(self.device_root):
+            report.error = f"Device not mounted at {self.device_root}"
+            emit({'type': 'status', 'message': f"Error: {report.error}"})
+            return report
+
+        albums, removed = self.plan(source_dirs, report)
+        # Deleting first frees the space the new files may need
+        for relative in removed:
+            self._delete(relative, report)
+
+        # Keep album order and leave out whole albums that don't fit
+        free = shutil.disk_usage(self.device_root).free - self.reserve_bytes
+        accepted = []
+        for jobs in albums:
+            needed = sum(size for _, _, size in jobs)
+            needed -= sum(self.manifest.get(relative, {}).get('size', 0) for _, relative, _ in jobs)
+            if needed > free:
+                report.skipped.extend(relative for _, relative, _ in jobs)
+                continue
+            free -= needed
+            accepted.append(jobs)
+        if report.skipped:
+            emit({'type': 'status', 'message': f"Not enough space on the device for {len(report.skipped)} files"})
+
+        files = sum(len(jobs) for jobs in accepted)
+        emit({'type': 'status', 'message': f"Copying {files} files to {self.device_root} "
+                                           f"({report.unchanged} unchanged, {len(report.deleted)} deleted)"})
+        work: queue.Queue = queue.Queue(maxsize=self.workers * QUEUE_DEPTH)
+        lock = threading.Lock()
+
+        def worker() -> None:
+            while True:
+                jobs = work.get()
+                if jobs is None:
+                    return
+                for source, relative, _ in jobs:
+                    if is_cancelled():
+                        break
+                    try:
+                        size = self._copy(source, relative)
+                    except OSError as e:
+                        logging.error(f"Failed to copy {source} to the device: {str(e)}")
+                        with lock:
+                            report.failed[relative] = str(e)
+                        continue
+                    with lock:
+                        report.copied.append(relative)
+                        report.copied_bytes += size
+                        done = len(report.copied)
+                    emit({'type': 'progress', 'value': done / files})
+
+        threads = [threading.Thread(target=worker, daemon=True) for _ in range(self.workers)]
+        for thread in threads:
+            thread.start()
+        for jobs in accepted:
+            if is_cancelled():
+                report.cancelled = True
+                break
+            work.put(jobs)
+        for _ in threads:
+            work.put(None)
+        for thread in threads:
+            thread.join()
+        report.cancelled = report.cancelled or is_cancelled()
+        self.manifest.save()
+        emit({'type': 'status', 'message': f"Copied {len(report.copied)} files "
+                                           f"({report.copied_bytes / 1_000_000:.1f} MB) to {self.device_root}"})
+        return report
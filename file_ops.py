@@ -0,0 +1,33 @@
+import os
+import shutil
+import threading
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def atomic_copy(source, destination: str, digest=None, copy_stat: bool = False) -> None:
+    """Copy a path or file object to destination via a temporary file and rename.
+
+    A half-written file never shows up under the final name. With a
+    hashlib object as digest, it is updated with the contents as they are
+    copied; copy_stat also copies the source path's mtime and permissions.
+    """
+    tmp_path = f"{destination}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        src = open(source, 'rb') if isinstance(source, str) else source
+        try:
+            with open(tmp_path, 'wb') as f:
+                for chunk in iter(lambda: src.read(CHUNK_SIZE), b''):
+                    if digest is not None:
+                        digest.update(chunk)
+                    f.write(chunk)
+        finally:
+            if src is not source:
+                src.close()
+        if copy_stat and isinstance(source, str):
+            shutil.copystat(source, tmp_path)
+        os.replace(tmp_path, destination)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
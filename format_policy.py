@@ -0,0 +1,101 @@
+from typing import Callable, Dict, Iterator, List, Optional
+
+# Output profiles: the LAME settings for the MP3, its typical bitrate, and the
+# lowest source bitrate that still transcodes to it without audible loss.
+# Anything above the minimum is bandwidth that the encode throws away.
+OUTPUT_PROFILES = {
+    'compact': {'encode_args': ['-b:a', '128k'], 'output_kbps': 128, 'min_source_kbps': 96},
+    'standard': {'encode_args': ['-qscale:a', '2'], 'output_kbps': 190, 'min_source_kbps': 128},
+    'high': {'encode_args': ['-qscale:a', '0'], 'output_kbps': 245, 'min_source_kbps': 160},
+}
+DEFAULT_PROFILE = 'standard'
+
+# Among formats that meet the minimum, prefer these codecs when sizes tie
+CODEC_PREFERENCE = ('opus', 'mp4a', 'aac', 'vorbis')
+
+
+def get_profile(name: Optional[str]) -> Dict:
+    """Return an output profile by name, falling back to the default."""
+    return OUTPUT_PROFILES.get(name or DEFAULT_PROFILE, OUTPUT_PROFILES[DEFAULT_PROFILE])
+
+
+def _bitrate(fmt: Dict) -> Optional[float]:
+    return fmt.get('abr') or fmt.get('tbr')
+
+
+def estimate_size(fmt: Dict, duration_ms: Optional[int]) -> Optional[float]:
+    """Return a format's size in bytes, estimating it from the bitrate if needed."""
+    size = fmt.get('filesize') or fmt.get('filesize_approx')
+    if size:
+        return float(size)
+    bitrate = _bitrate(fmt)
+    if bitrate and duration_ms:
+        return bitrate * 1000 / 8 * duration_ms / 1000
+    return None
+
+
+def _codec_rank(fmt: Dict) -> int:
+    codec = (fmt.get('acodec') or '').lower()
+    for rank, name in enumerate(CODEC_PREFERENCE):
+        if codec.startswith(name):
+            return rank
+    return len(CODEC_PREFERENCE)
+
+
+def select_audio_format(formats: List[Dict], min_kbps: float,
+                        duration_ms: Optional[int] = None) -> Optional[Dict]:
+    """Pick the smallest audio-only format whose bitrate is at least min_kbps.
+
+    If no format meets the target the best audio-only one is used, and if
+    there are no audio-only formats at all the smallest format with audio.
+    """
+    audio_only = [f for f in formats
+                  if f.get('vcodec') == 'none' and f.get('acodec') not in (None, 'none')]
+    meeting = [f for f in audio_only if (_bitrate(f) or 0) >= min_kbps]
+    if meeting:
+        return min(meeting, key=lambda f: (estimate_size(f, duration_ms) or float('inf'), _codec_rank(f)))
+    if audio_only:
+        return max(audio_only, key=lambda f: _bitrate(f) or 0)
+    with_audio = [f for f in formats if f.get('acodec') not in (None, 'none')]
+    if with_audio:
+        return min(with_audio, key=lambda f: estimate_size(f, duration_ms) or float('inf'))
+    return formats[-1] if formats else None
+
+
+def largest_audio_format(formats: List[Dict]) -> Optional[Dict]:
+    """Return the format 'bestaudio' would have picked, for savings accounting."""
+    audio_only = [f for f in formats
+                  if f.get('vcodec') == 'none' and f.get('acodec') not in (None, 'none')]
+    return max(audio_only, key=lambda f: _bitrate(f) or 0) if audio_only else None
+
+
+def make_format_selector(min_kbps: float, duration_ms: Optional[int],
+                         on_select: Optional[Callable[[Dict], None]] = None,
+                         pinned_format_id: Optional[str] = None) -> Callable:
+    """Build a callable for yt-dlp's 'format' option that applies the policy.
+
+    on_select receives the chosen format id, codec, bitrate, estimated size
+    and the bytes saved compared to the largest audio stream. A pinned
+    format id is used as-is when the video still offers it, so a resumed
+    download continues with the same stream.
+    """
+    def selector(ctx: Dict) -> Iterator[Dict]:
+        formats = ctx.get('formats') or []
+        pinned = [f for f in formats if pinned_format_id and f.get('format_id') == pinned_format_id]
+        chosen = pinned[0] if pinned else select_audio_format(formats, min_kbps, duration_ms)
+        if chosen is None:
+            return
+        if on_select:
+            size = estimate_size(chosen, duration_ms)
+            largest = largest_audio_format(formats)
+            largest_size = estimate_size(largest, duration_ms) if largest else None
+            on_select({
+                'format_id': chosen.get('format_id'),
+                'acodec': chosen.get('acodec'),
+                'abr': _bitrate(chosen),
+                'ext': chosen.get('ext'),
+                'estimated_bytes': int(size) if size else None,
+                'saved_bytes': int(max(largest_size - size, 0)) if size and largest_size else 0,
+            })
+        yield chosen
+    return selector
@@ -7,6 +7,7 @@ import logging
 from typing import Callable, Optional
 import os
 import json
+from run_metrics import format_eta
 
 # Frutiger Aero color palette
 AERO_BG = '#eaf6fb'  # light blue/white
@@ -112,11 +113,16 @@ class SpotifyDownloaderGUI:
                 messagebox.showerror("Error", "Please enter both Client ID and Client Secret")
                 return
             if self.spotify_handler.configure(client_id, client_secret):
-                config = {'client_id': client_id, 'client_secret': client_secret}
                 config_path = os.path.join(os.path.dirname(__file__), 'config.json')
                 try:
+                    # Keep any other options already stored in the config file
+                    config = {}
+                    if os.path.exists(config_path):
+                        with open(config_path, 'r') as f:
+                            config = json.load(f)
+                    config.update({'client_id': client_id, 'client_secret': client_secret})
                     with open(config_path, 'w') as f:
-                        json.dump(config, f)
+                        json.dump(config, f, indent=2)
                 except Exception as e:
                     logging.error(f"Failed to save config: {str(e)}")
                 dialog.destroy()
@@ -158,7 +164,7 @@ class SpotifyDownloaderGUI:
         # URL input
         self.url_label = ctk.CTkLabel(
             self.main_frame,
-            text="Spotify Playlist URL:",
+            text="Spotify Playlist, Album or Artist URL:",
             font=(AERO_FONT, 14),
             text_color=AERO_DARK,
             fg_color=AERO_BG
@@ -234,6 +240,15 @@ class SpotifyDownloaderGUI:
         self.progress_bar.pack(pady=(5, 10))
         self.progress_bar.set(0)
 
+        self.stats_label = ctk.CTkLabel(
+            self.progress_frame,
+            text="",
+            font=(AERO_FONT, 12),
+            text_color=AERO_DARK,
+            fg_color=AERO_BG
+        )
+        self.stats_label.pack(anchor="w")
+
         # Status text
         self.status_text = ctk.CTkTextbox(
             self.main_frame,
@@ -355,6 +370,17 @@ class SpotifyDownloaderGUI:
         """Update the progress bar."""
         self.progress_bar.set(value)
 
+    def update_stats(self, stats: dict):
+        """Update the throughput and ETA line below the progress bar."""
+        self.stats_label.configure(
+            text=(
+                f"{stats['completed_tracks']}/{stats['total_tracks']} tracks  |  "
+                f"{stats['downloaded_bytes'] / 1_000_000:.1f} MB  |  "
+                f"{stats['rate_mb_s']:.2f} MB/s  |  "
+                f"ETA {format_eta(stats['eta_seconds'])}"
+            )
+        )
+
     def process_queue(self):
         """Process messages from the queue."""
         try:
@@ -367,6 +393,8 @@ class SpotifyDownloaderGUI:
                         self.update_status(message)
                 elif isinstance(message, float):
                     self.update_progress(message)
+                elif isinstance(message, dict) and message.get('type') == 'stats':
+                    self.update_stats(message)
                 elif message == "ERROR":
                     self.download_error()
         except queue.Empty:
@@ -385,7 +413,7 @@ class SpotifyDownloaderGUI:
         directory = self.dir_entry.get().strip()
 
         if not url:
-            messagebox.showerror("Error", "Please enter a Spotify playlist URL")
+            messagebox.showerror("Error", "Please enter a Spotify playlist, album or artist URL")
             return
 
         if not directory:
@@ -400,6 +428,7 @@ class SpotifyDownloaderGUI:
         self.cancel_button.configure(state="normal")
         self.status_text.delete(1.0, tk.END)
         self.progress_bar.set(0)
+        self.stats_label.configure(text="")
         self.cancel_requested = False
 
         # Start download in a separate thread
@@ -477,7 +506,7 @@ class SpotifyDownloaderGUI:
 
         instructions = (
             "1. Click the Settings button and enter your Spotify API credentials.\n"
-            "2. Paste a public Spotify playlist URL into the 'Spotify Playlist URL' field.\n"
+            "2. Paste a public Spotify playlist, album, artist or track URL into the URL field.\n"
             "3. Choose a download directory where your music will be saved.\n"
             "4. Click 'Start Download' to begin.\n"
             "5. Watch the progress and status updates.\n"
@@ -0,0 +1,79 @@
+import json
+import logging
+import os
+import threading
+from typing import Any, Dict, Iterator, Tuple
+
+
+class JsonStore:
+    def __init__(self, path: str, autosave_every: int = 25):
+        """Initialize a small thread-safe key/value store persisted as JSON."""
+        self.path = path
+        self.autosave_every = autosave_every
+        self._data: Dict[str, Any] = {}
+        self._dirty = 0
+        self._lock = threading.RLock()
+        self._load()
+
+    def _load(self) -> None:
+        """Load existing data from disk, starting empty if it is missing or corrupt."""
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            if isinstance(data, dict):
+                self._data = data
+        except Exception as e:
+            logging.error(f"Failed to load {self.path}: {str(e)}")
+
+    def get(self, key: str, default: Any = None) -> Any:
+        """Return the value stored under key."""
+        with self._lock:
+            return self._data.get(key, default)
+
+    def set(self, key: str, value: Any) -> None:
+        """Store a value and save periodically."""
+        with self._lock:
+            self._data[key] = value
+            self._mark_dirty()
+
+    def delete(self, key: str) -> None:
+        """Remove a key if present."""
+        with self._lock:
+            if self._data.pop(key, None) is not None:
+                self._mark_dirty()
+
+    def items(self) -> Iterator[Tuple[str, Any]]:
+        """Iterate over a snapshot of the stored items."""
+        with self._lock:
+            return iter(list(self._data.items()))
+
+    def __contains__(self, key: str) -> bool:
+        with self._lock:
+            return key in self._data
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._data)
+
+    def _mark_dirty(self) -> None:
+        self._dirty += 1
+        if self.autosave_every and self._dirty >= self.autosave_every:
+            self.save()
+
+    def save(self) -> None:
+        """Atomically write the store to disk if it has unsaved changes."""
+        with self._lock:
+            if not self._dirty:
+                return
+            try:
+                os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+                tmp_path = f"{self.path}.tmp"
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    json.dump(self._data, f)
+                os.replace(tmp_path, self.path)
+                self._dirty = 0
+            except Exception as e:
+                logging.error(f"Failed to save {self.path}: {str(e)}")
+
@@ -0,0 +1,76 @@
+import os
+import errno
+import logging
+from typing import Optional
+from json_store import JsonStore
+from file_ops import atomic_copy
+
+
+def link_or_copy(source: str, destination: str) -> str:
+    """Hard-link source to destination, falling back to a copy.
+
+    Returns 'linked' or 'copied' so callers know whether the file is shared.
+    """
+    os.makedirs(os.path.dirname(destination), exist_ok=True)
+    if os.path.exists(destination):
+        if os.path.samefile(source, destination):
+            return 'linked'
+        os.remove(destination)
+    try:
+        os.link(source, destination)
+        return 'linked'
+    except OSError:
+        # Different filesystem or no hard-link support (e.g. FAT32)
+        atomic_copy(source, destination, copy_stat=True)
+        return 'copied'
+
+
+def publish_file(source: str, destination: str) -> None:
+    """Move a finished file from the scratch area to its final path.
+
+    On the same filesystem this is a single rename. From another filesystem
+    (e.g. a tmpfs scratch area) the file is copied in one sequential write
+    under a temporary name and then renamed, so a half-written file never
+    shows up under the final name.
+    """
+    os.makedirs(os.path.dirname(destination), exist_ok=True)
+    try:
+        os.replace(source, destination)
+        return
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+    atomic_copy(source, destination, copy_stat=True)
+    os.remove(source)
+
+
+class LibraryIndex:
+    def __init__(self, index_path: str, library_root: str):
+        """Initialize the ISRC to local file index for a download directory."""
+        self.library_root = library_root
+        self.store = JsonStore(index_path)
+
+    def lookup(self, isrc: Optional[str]) -> Optional[str]:
+        """Return the canonical local file for an ISRC, if it still exists."""
+        if not isrc:
+            return None
+        relative_path = self.store.get(isrc)
+        if not relative_path:
+            return None
+        path = os.path.join(self.library_root, relative_path)
+        if not os.path.exists(path):
+            logging.info(f"Library file for {isrc} is gone, dropping it from the index")
+            self.store.delete(isrc)
+            return None
+        return path
+
+    def add(self, isrc: Optional[str], file_path: str) -> None:
+        """Record file_path as the canonical file for an ISRC."""
+        if not isrc:
+            return
+        # Paths are stored relative to the library so the folder can be moved
+        self.store.set(isrc, os.path.relpath(file_path, self.library_root))
+
+    def save(self) -> None:
+        """Persist the index to disk."""
+        self.store.save()
@@ -0,0 +1,148 @@
+import os
+import re
+import logging
+from typing import Dict, List, Optional, Set, Tuple
+from json_store import JsonStore
+
+# Formats an iPod plays natively, anything else would need a transcode
+AUDIO_EXTENSIONS = ('.mp3', '.m4a')
+
+# Maximum difference between a local file and a Spotify track to count as a match
+DURATION_TOLERANCE_MS = 3000
+
+
+def normalize(text: Optional[str]) -> str:
+    """Normalize a title or artist for fuzzy matching."""
+    if not text:
+        return ''
+    text = text.lower()
+    # Drop "(feat. ...)", "[Remastered]" and similar decorations
+    text = re.sub(r'[\(\[].*?[\)\]]', '', text)
+    text = re.sub(r'\s+-\s+.*remaster.*$', '', text)
+    return re.sub(r'[^a-z0-9]+', '', text)
+
+
+def duration_matches(duration_ms: Optional[int], expected_ms: Optional[int]) -> bool:
+    """Return whether a local file's duration is close enough to a Spotify track's."""
+    return bool(duration_ms and expected_ms and abs(duration_ms - expected_ms) <= DURATION_TOLERANCE_MS)
+
+
+def _first(tags, key: str) -> Optional[str]:
+    """Return the first value of a tag from a mutagen tag mapping."""
+    values = tags.get(key) if tags else None
+    if not values:
+        return None
+    value = values[0]
+    if isinstance(value, bytes):
+        value = value.decode('utf-8', 'ignore')
+    return str(value)
+
+
+def read_audio_tags(path: str) -> Optional[Dict]:
+    """Read title, artist, album, duration and ISRC from an audio file."""
+    try:
+        from mutagen import File as MutagenFile
+        audio = MutagenFile(path, easy=True)
+        if audio is None:
+            return None
+        isrc = _first(audio.tags, 'isrc')
+        if not isrc and path.lower().endswith('.m4a'):
+            raw = MutagenFile(path)
+            isrc = _first(raw.tags, '----:com.apple.iTunes:ISRC')
+        return {
+            'title': _first(audio.tags, 'title'),
+            'artist': _first(audio.tags, 'artist'),
+            'album': _first(audio.tags, 'album'),
+            'duration_ms': int(audio.info.length * 1000) if audio.info else None,
+            'isrc': isrc.upper() if isrc else None,
+        }
+    except Exception as e:
+        logging.error(f"Failed to read tags from {path}: {str(e)}")
+        return None
+
+
+class LocalLibrary:
+    def __init__(self, roots: List[str], index_path: str):
+        """Initialize a resolver for audio files already in local archives.
+
+        Tags are cached in an index keyed by path, with mtime and size used to
+        detect changes, so rescans only read files that were added or modified.
+        """
+        self.roots = [os.path.abspath(root) for root in roots]
+        self.store = JsonStore(index_path, autosave_every=500)
+        self._by_isrc: Dict[str, str] = {}
+        self._by_name: Dict[tuple, List[str]] = {}
+
+    def scan(self) -> Dict[str, int]:
+        """Update the index from disk and rebuild the lookup tables."""
+        counts = {'files': 0, 'read': 0, 'removed': 0}
+        seen = set()
+        for root in self.roots:
+            if not os.path.isdir(root):
+                logging.warning(f"Local library root not found: {root}")
+                continue
+            for dirpath, dirnames, filenames in os.walk(root):
+                dirnames[:] = [d for d in dirnames if not d.startswith('.')]
+                for filename in filenames:
+                    if not filename.lower().endswith(AUDIO_EXTENSIONS):
+                        continue
+                    path = os.path.join(dirpath, filename)
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    seen.add(path)
+                    counts['files'] += 1
+                    entry = self.store.get(path)
+                    if entry and entry['mtime'] == stat.st_mtime_ns and entry['size'] == stat.st_size:
+                        continue
+                    tags = read_audio_tags(path) or {}
+                    tags.update({'mtime': stat.st_mtime_ns, 'size': stat.st_size})
+                    self.store.set(path, tags)
+                    counts['read'] += 1
+
+        # Forget files that were deleted or whose root is no longer configured
+        for path, _ in self.store.items():
+            if path not in seen:
+                self.store.delete(path)
+                counts['removed'] += 1
+        self.store.save()
+        self._build_lookup()
+        return counts
+
+    def _build_lookup(self) -> None:
+        """Build in-memory ISRC and title/artist lookups from the index."""
+        self._by_isrc = {}
+        self._by_name = {}
+        for path, entry in self.store.items():
+            if entry.get('isrc'):
+                self._by_isrc.setdefault(entry['isrc'], path)
+            key = (normalize(entry.get('title')), normalize(entry.get('artist')))
+            if key[0]:
+                self._by_name.setdefault(key, []).append(path)
+
+    def file_ids(self) -> Set[Tuple[int, int]]:
+        """Return the (device, inode) pairs of the indexed files, to recognise hard links to them."""
+        ids = set()
+        for path, _ in self.store.items():
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            ids.add((stat.st_dev, stat.st_ino))
+        return ids
+
+    def resolve(self, track: Dict) -> Optional[str]:
+        """Return a local file for a track, matching by ISRC then title, artist and duration."""
+        isrc = track.get('isrc')
+        if isrc and isrc.upper() in self._by_isrc:
+            path = self._by_isrc[isrc.upper()]
+            if os.path.exists(path):
+                return path
+
+        key = (normalize(track.get('title')), normalize(track['artists'][0] if track.get('artists') else None))
+        for path in self._by_name.get(key, []):
+            entry = self.store.get(path) or {}
+            if duration_matches(entry.get('duration_ms'), track.get('duration_ms')) and os.path.exists(path):
+                return path
+        return None
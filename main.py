@@ -1,19 +1,29 @@
 import os
 import sys
+import time
 import logging
-from typing import Optional
+import argparse
+from typing import Dict, List
 from spotify_handler import SpotifyHandler
-from youtube_handler import YouTubeHandler
 from metadata_handler import MetadataHandler
-from gui import SpotifyDownloaderGUI
+from sync_engine import SyncConfig, SyncEngine
+from mp3_verifier import scan_library
+from planner import SyncPlan
+from artifact_cache import serve_artifact_cache
+from watch import PlaylistWatcher
 import json
 
 class SpotifyDownloader:
-    def __init__(self):
-        """Initialize the Spotify downloader application."""
+    def __init__(self, headless: bool = False):
+        """Initialize the Spotify downloader application.
+
+        With headless=True no CustomTkinter window is created and the sync
+        engine (self.engine) can be driven directly.
+        """
         self.setup_logging()
         self.setup_handlers()
-        self.setup_gui()
+        if not headless:
+            self.setup_gui()
 
     def setup_logging(self):
         """Set up logging configuration."""
@@ -24,21 +34,17 @@ class SpotifyDownloader:
 
     def setup_handlers(self):
         """Set up all necessary handlers."""
-        # Try to load credentials from config file first
+        # Try to load credentials and options from config file first
+        self.config = {}
         config_path = os.path.join(os.path.dirname(__file__), 'config.json')
         if os.path.exists(config_path):
             try:
                 with open(config_path, 'r') as f:
-                    config = json.load(f)
-                    client_id = config.get('client_id')
-                    client_secret = config.get('client_secret')
+                    self.config = json.load(f)
             except Exception as e:
                 logging.error(f"Error loading config file: {str(e)}")
-                client_id = None
-                client_secret = None
-        else:
-            client_id = None
-            client_secret = None
+        client_id = self.config.get('client_id')
+        client_secret = self.config.get('client_secret')
 
         # If no config file, try environment variables
         if not client_id:
@@ -51,108 +57,187 @@ class SpotifyDownloader:
             client_id=client_id,
             client_secret=client_secret
         )
-        self.metadata = MetadataHandler()
+        sync_config = SyncConfig.from_dict(self.config)
+        self.metadata = MetadataHandler(id3_padding=sync_config.id3_padding)
+        self.engine = SyncEngine(sync_config, self.spotify, self.metadata)
 
     def setup_gui(self):
         """Set up the GUI and connect it to the download process."""
+        from gui import SpotifyDownloaderGUI
         self.gui = SpotifyDownloaderGUI()
         self.gui.download_process = self.download_process
         self.gui.set_spotify_handler(self.spotify)
 
+    def _queue_event(self, event: Dict) -> None:
+        """Translate a sync engine event into the GUI queue's message format."""
+        if event['type'] == 'status':
+            self.gui.queue.put(event['message'])
+        elif event['type'] == 'progress':
+            self.gui.queue.put(event['value'])
+        else:
+            self.gui.queue.put(event)
+
     def download_process(self, url: str, directory: str):
         """Main download process."""
-        try:
-            # Check if we have valid credentials
-            if not self.spotify.is_configured():
-                self.gui.queue.put("Error: Spotify credentials not configured")
-                self.gui.queue.put("ERROR")
-                return
-
-            # Extract playlist ID
-            playlist_id = self.spotify.extract_playlist_id(url)
-            if not playlist_id:
-                self.gui.queue.put("Error: Invalid Spotify playlist URL")
-                self.gui.queue.put("ERROR")
-                return
-
-            # Get playlist name
-            playlist_name = self.spotify.get_playlist_name(playlist_id)
-            if not playlist_name:
-                self.gui.queue.put("Error: Could not retrieve playlist information")
-                self.gui.queue.put("ERROR")
-                return
-
-            self.gui.queue.put(f"Processing playlist: {playlist_name}")
-
-            # Get all tracks
-            tracks = self.spotify.get_playlist_tracks(playlist_id)
-            if not tracks:
-                self.gui.queue.put("Error: No tracks found in playlist")
-                self.gui.queue.put("ERROR")
-                return
-
-            self.gui.queue.put(f"Found {len(tracks)} tracks")
-
-            # Create playlist directory
-            playlist_dir = os.path.join(directory, playlist_name)
-            os.makedirs(playlist_dir, exist_ok=True)
-
-            # Initialize YouTube handler
-            youtube = YouTubeHandler(playlist_dir)
-
-            # Download each track
-            for i, track in enumerate(tracks, 1):
-                if self.gui.is_cancelled():
-                    self.gui.queue.put("Download cancelled by user.")
-                    self.gui.queue.put("DONE")
-                    return
-                try:
-                    self.gui.queue.put(f"\nProcessing track {i}/{len(tracks)}: {track['title']}")
-
-                    # Download track
-                    file_path = youtube.search_and_download(track)
-                    if not file_path:
-                        self.gui.queue.put(f"Failed to download: {track['title']}")
-                        continue
-
-                    # Verify download
-                    if not youtube.verify_download(file_path):
-                        self.gui.queue.put(f"Download verification failed: {track['title']}")
-                        continue
-
-                    # Embed metadata
-                    if not self.metadata.embed_metadata(file_path, track):
-                        self.gui.queue.put(f"Failed to embed metadata: {track['title']}")
-                        continue
-
-                    # Verify metadata
-                    if not self.metadata.verify_metadata(file_path):
-                        self.gui.queue.put(f"Metadata verification failed: {track['title']}")
-                        continue
-
-                    self.gui.queue.put(f"Successfully processed: {track['title']}")
-
-                except Exception as e:
-                    logging.error(f"Error processing track {track['title']}: {str(e)}")
-                    self.gui.queue.put(f"Error processing track: {track['title']}")
-
-                # Update progress
-                progress = i / len(tracks)
-                self.gui.queue.put(progress)
-
-            self.gui.queue.put("\nDownload completed!")
-            self.gui.queue.put("DONE")
-
-        except Exception as e:
-            logging.error(f"Download process error: {str(e)}")
-            self.gui.queue.put(f"Error: {str(e)}")
+        report = self.engine.sync(url, directory, self._queue_event, self.gui.is_cancelled)
+        if report.error:
             self.gui.queue.put("ERROR")
+            return
+        if not report.cancelled:
+            self.gui.queue.put("\nDownload completed!")
+        self.gui.queue.put("DONE")
 
     def run(self):
         """Start the application."""
         self.gui.run()
 
+def verify_library(root: str) -> int:
+    """Check every MP3 below root and print the ones that look broken."""
+    checked = 0
+    broken = 0
+    for report in scan_library(root):
+        checked += 1
+        if not report['ok']:
+            broken += 1
+            print(f"{report['path']}: {', '.join(report['problems'])}")
+    print(f"Checked {checked} files, {broken} with problems")
+    return 1 if broken else 0
+
+def print_event(event: Dict) -> None:
+    """Print status messages from the sync engine on the console."""
+    if event['type'] == 'status':
+        print(event['message'])
+
+def retag_library(root: str) -> int:
+    """Refresh the tags of every file below root from current Spotify metadata."""
+    app = SpotifyDownloader(headless=True)
+    report = app.engine.retag(root, print_event)
+    if report.error:
+        return 1
+    unchanged = sum(1 for result in report.tracks if result.status == 'unchanged')
+    print(f"Retagged {len(report.succeeded) - unchanged} of {len(report.tracks)} files, {unchanged} already up to date")
+    for result in report.failed:
+        print(f"{result.file_path}: {result.error}")
+    return 0
+
+def retry_failed(root: str) -> int:
+    """Re-run the tracks recorded in root's failure report."""
+    app = SpotifyDownloader(headless=True)
+    reports = app.engine.retry_failures(root, print_event)
+    if not reports:
+        print("No failed tracks to retry")
+        return 0
+    remaining = 0
+    for report in reports:
+        if report.error:
+            print(f"{report.playlist_dir}: {report.error}")
+        for result in report.failed:
+            remaining += 1
+            print(f"{result.title} - {result.artist}: {result.error} ({result.error_kind})")
+    return 1 if remaining else 0
+
+def plan_sync(url: str, root: str) -> int:
+    """Print and save a cost estimate for syncing a playlist into root."""
+    app = SpotifyDownloader(headless=True)
+    try:
+        plan = app.engine.plan(url, root, print_event)
+    except Exception as e:
+        print(f"Error: {str(e)}")
+        return 1
+    path = app.engine.state_path(root, 'plans', f"{time.strftime('%Y%m%d-%H%M%S')}.json")
+    plan.save(path)
+    print(f"Plan saved to {path}, run it with --execute-plan")
+    return 0
+
+def execute_plan(path: str) -> int:
+    """Run a plan saved by --plan."""
+    app = SpotifyDownloader(headless=True)
+    plan = SyncPlan.load(path)
+    report = app.engine.execute_plan(plan, print_event)
+    if report.error:
+        return 1
+    print(f"Synced {len(report.succeeded)} of {len(report.tracks)} tracks")
+    return 1 if report.failed else 0
+
+def transfer_to_device(device: str, playlist_dirs: List[str]) -> int:
+    """Copy new and changed files of playlist folders to a mounted device."""
+    app = SpotifyDownloader(headless=True)
+    report = app.engine.transfer(playlist_dirs, device, print_event)
+    if report.error:
+        return 1
+    for relative, error in report.failed.items():
+        print(f"{relative}: {error}")
+    return 1 if report.failed or report.skipped else 0
+
+def watch_playlists(root: str, urls: List[str]) -> int:
+    """Keep playlists in root up to date, syncing the ones that change, until interrupted."""
+    app = SpotifyDownloader(headless=True)
+    config = app.engine.config
+    urls = urls or config.watch_playlists
+    if not urls:
+        print("No playlists to watch, pass URLs or set watch_playlists in config.json")
+        return 1
+    watcher = PlaylistWatcher(app.engine, urls, root, config.watch_interval,
+                              config.watch_jitter, config.watch_api_rate)
+    print(f"Watching {len(watcher.urls)} playlists every {config.watch_interval / 60:.0f} minutes, Ctrl+C to stop")
+    try:
+        watcher.run(print_event)
+    except KeyboardInterrupt:
+        pass
+    return 0
+
 def main():
+    parser = argparse.ArgumentParser(description="Download Spotify playlists for your iPod.")
+    parser.add_argument('--verify-library', metavar='DIR',
+                        help="check the MP3 frame structure of every file below DIR and exit")
+    parser.add_argument('--retag', metavar='DIR',
+                        help="update the tags of every file below DIR from Spotify without downloading and exit")
+    parser.add_argument('--retry-failed', metavar='DIR',
+                        help="retry only the tracks that failed in earlier syncs into DIR and exit")
+    parser.add_argument('--serve-cache', metavar='DIR',
+                        help="serve DIR as a shared artifact cache over HTTP for other instances")
+    parser.add_argument('--port', type=int, default=8765,
+                        help="port for --serve-cache (default: 8765)")
+    parser.add_argument('--plan', nargs=2, metavar=('URL', 'DIR'),
+                        help="estimate the tracks, bytes and time a sync of URL into DIR would take and exit")
+    parser.add_argument('--execute-plan', metavar='FILE',
+                        help="sync exactly the tracks of a plan saved by --plan and exit")
+    parser.add_argument('--transfer', nargs='+', metavar=('DEVICE', 'DIR'),
+                        help="copy new and changed files of the playlist folders DIR... to the device mounted at DEVICE and exit")
+    parser.add_argument('--watch', nargs='+', metavar=('DIR', 'URL'),
+                        help="check the playlists URL... (default: watch_playlists from config.json) on a schedule "
+                             "and sync the ones that changed into DIR")
+    args = parser.parse_args()
+
+    if args.verify_library:
+        logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+        sys.exit(verify_library(args.verify_library))
+
+    if args.retag:
+        sys.exit(retag_library(args.retag))
+
+    if args.retry_failed:
+        sys.exit(retry_failed(args.retry_failed))
+
+    if args.serve_cache:
+        logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+        serve_artifact_cache(args.serve_cache, port=args.port)
+        sys.exit(0)
+
+    if args.plan:
+        sys.exit(plan_sync(*args.plan))
+
+    if args.execute_plan:
+        sys.exit(execute_plan(args.execute_plan))
+
+    if args.transfer:
+        if len(args.transfer) < 2:
+            parser.error("--transfer needs a device path and at least one playlist folder")
+        sys.exit(transfer_to_device(args.transfer[0], args.transfer[1:]))
+
+    if args.watch:
+        sys.exit(watch_playlists(args.watch[0], args.watch[1:]))
+
     try:
         app = SpotifyDownloader()
         app.run()
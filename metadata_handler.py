@@ -1,21 +1,121 @@
 import os
+import math
+import threading
 import requests
+from collections import OrderedDict
 from mutagen.mp3 import MP3
-from mutagen.id3 import ID3, TIT2, TPE1, TALB, TRCK, TPOS, APIC
-from typing import Dict, Optional
+from mutagen.id3 import ID3, TIT2, TPE1, TPE2, TALB, TRCK, TPOS, TDRC, TCON, TLEN, TSRC, TXXX, COMM, APIC
+from typing import Dict, List, Optional, Tuple
 import logging
 from PIL import Image
 from io import BytesIO
 
+# Bytes of free space reserved in the ID3 tag so later tag edits don't move the audio
+DEFAULT_ID3_PADDING = 16384
+
+# Number of converted cover images kept in memory
+ART_CACHE_SIZE = 64
+
+# ReplayGain 2.0 reference level in LUFS
+REPLAYGAIN_REFERENCE_LUFS = -18.0
+
+
+def itunnorm(gain_db: float, peak: float) -> str:
+    """Build an iTunes Sound Check (iTunNORM) value from a gain and linear peak."""
+    v1000 = min(round(1000 * 10 ** (-gain_db / 10)), 65534)
+    v2500 = min(round(2500 * 10 ** (-gain_db / 10)), 65534)
+    peak_value = min(round(peak * 32768), 32768)
+    values = [v1000, v1000, v2500, v2500, 0, 0, peak_value, peak_value, 0, 0]
+    return ''.join(f" {value:08X}" for value in values)
+
+
 class MetadataHandler:
-    def __init__(self):
-        """Initialize the metadata handler."""
-        pass
+    def __init__(self, id3_padding: int = DEFAULT_ID3_PADDING):
+        """Initialize the metadata handler.
+
+        id3_padding is the free space reserved when a tag has to be rewritten,
+        so later updates (e.g. a retag) fit in place without rewriting the file.
+        """
+        self.id3_padding = id3_padding
+        # Reuse connections to the album art CDN across tracks
+        self.session = requests.Session()
+        self._art_cache = OrderedDict()
+        # Workers share the cache; the download itself runs outside the lock
+        self._art_lock = threading.Lock()
+
+    def _padding(self, info) -> int:
+        """mutagen padding callback: keep the tag in place whenever it still fits."""
+        if 0 <= info.padding <= max(self.id3_padding * 4, 65536):
+            return info.padding
+        return self.id3_padding
+
+    def _tag_signature(self, audio: ID3) -> Dict:
+        """Return a cheap comparable summary of all frames in a tag."""
+        signature = {}
+        for key, frame in audio.items():
+            if key.startswith('APIC'):
+                signature[key] = (frame.mime, frame.type, frame.desc, hash(frame.data))
+            else:
+                signature[key] = repr(frame)
+        return signature
+
+    def get_cover_art(self, url: str) -> Optional[bytes]:
+        """Return JPEG cover art for a URL, downloading and converting it once."""
+        with self._art_lock:
+            if url in self._art_cache:
+                self._art_cache.move_to_end(url)
+                return self._art_cache[url]
+        art_data = self.download_album_art(url)
+        if not art_data:
+            return None
+        try:
+            # Convert image to JPEG if needed
+            image = Image.open(BytesIO(art_data))
+            if image.format != 'JPEG':
+                output = BytesIO()
+                image.convert('RGB').save(output, format='JPEG')
+                art_data = output.getvalue()
+        except Exception as e:
+            logging.error(f"Failed to process album art: {str(e)}")
+            return None
+        with self._art_lock:
+            self._art_cache[url] = art_data
+            if len(self._art_cache) > ART_CACHE_SIZE:
+                self._art_cache.popitem(last=False)
+        return art_data
+
+    def read_track_ids(self, file_path: str) -> Tuple[Optional[str], Optional[str]]:
+        """Return the (Spotify track ID, ISRC) stored in a file's tags."""
+        try:
+            audio = ID3(file_path)
+        except Exception:
+            return None, None
+        spotify_id = audio.get('TXXX:SPOTIFY_TRACK_ID')
+        isrc = audio.get('TSRC')
+        return (
+            str(spotify_id.text[0]) if spotify_id else None,
+            str(isrc.text[0]) if isrc else None,
+        )
+
+    def read_loudness(self, file_path: str) -> Optional[Dict]:
+        """Return the loudness measurement behind a file's ReplayGain track tags."""
+        try:
+            audio = ID3(file_path)
+            gain = audio.get('TXXX:REPLAYGAIN_TRACK_GAIN')
+            if not gain:
+                return None
+            loudness = {'integrated_lufs': REPLAYGAIN_REFERENCE_LUFS - float(str(gain.text[0]).split()[0])}
+            peak = audio.get('TXXX:REPLAYGAIN_TRACK_PEAK')
+            if peak and float(str(peak.text[0])) > 0:
+                loudness['true_peak_dbfs'] = 20 * math.log10(float(str(peak.text[0])))
+            return loudness
+        except Exception:
+            return None
 
     def download_album_art(self, url: str) -> Optional[bytes]:
         """Download album art from URL."""
         try:
-            response = requests.get(url)
+            response = self.session.get(url, timeout=30)
             if response.status_code == 200:
                 return response.content
             return None
@@ -23,55 +123,125 @@ class MetadataHandler:
             logging.error(f"Failed to download album art: {str(e)}")
             return None
 
-    def embed_metadata(self, file_path: str, track_info: Dict) -> bool:
-        """Embed metadata into an MP3 file."""
+    def _position(self, number: int, total: Optional[int]) -> str:
+        """Format a track or disc number, including the total when known."""
+        return f"{number}/{total}" if total else str(number)
+
+    def _replaygain_values(self, loudness: Dict) -> Tuple[float, float]:
+        """Return (gain in dB, linear peak) for a loudness measurement."""
+        gain = REPLAYGAIN_REFERENCE_LUFS - loudness['integrated_lufs']
+        peak_db = loudness.get('true_peak_dbfs')
+        peak = 10 ** (peak_db / 20) if peak_db is not None else 1.0
+        return gain, peak
+
+    def _set_loudness_tags(self, audio: ID3, loudness: Dict) -> None:
+        """Write ReplayGain track tags and the iTunes normalization comment."""
+        gain, peak = self._replaygain_values(loudness)
+        audio['TXXX:REPLAYGAIN_TRACK_GAIN'] = TXXX(encoding=3, desc='REPLAYGAIN_TRACK_GAIN', text=f"{gain:.2f} dB")
+        audio['TXXX:REPLAYGAIN_TRACK_PEAK'] = TXXX(encoding=3, desc='REPLAYGAIN_TRACK_PEAK', text=f"{peak:.6f}")
+        audio['COMM:iTunNORM:eng'] = COMM(encoding=3, lang='eng', desc='iTunNORM', text=itunnorm(gain, peak))
+
+    def embed_album_gain(self, entries: List[Tuple[str, Dict, int]]) -> bool:
+        """Write ReplayGain album tags to every file of an album.
+
+        entries holds (file_path, loudness, duration_ms) per track. The album
+        loudness is the duration weighted energy mean of the track loudness, so
+        no file has to be decoded again.
+        """
+        try:
+            total_ms = sum(duration_ms for _, _, duration_ms in entries)
+            if not total_ms:
+                return False
+            energy = sum(
+                duration_ms * 10 ** (loudness['integrated_lufs'] / 10)
+                for _, loudness, duration_ms in entries
+            ) / total_ms
+            album_lufs = 10 * math.log10(energy)
+            album_gain, album_peak = self._replaygain_values({
+                'integrated_lufs': album_lufs,
+                'true_peak_dbfs': max(
+                    (l['true_peak_dbfs'] for _, l, _ in entries if l.get('true_peak_dbfs') is not None),
+                    default=None
+                ),
+            })
+            for file_path, _, _ in entries:
+                audio = ID3(file_path)
+                audio['TXXX:REPLAYGAIN_ALBUM_GAIN'] = TXXX(encoding=3, desc='REPLAYGAIN_ALBUM_GAIN', text=f"{album_gain:.2f} dB")
+                audio['TXXX:REPLAYGAIN_ALBUM_PEAK'] = TXXX(encoding=3, desc='REPLAYGAIN_ALBUM_PEAK', text=f"{album_peak:.6f}")
+                audio.save(file_path, padding=self._padding)
+            return True
+        except Exception as e:
+            logging.error(f"Failed to embed album gain: {str(e)}")
+            return False
+
+    def embed_metadata(self, file_path: str, track_info: Dict) -> Optional[str]:
+        """Embed metadata into an MP3 file.
+
+        Returns 'written', or 'unchanged' if the tags already matched and the
+        file was left alone; None on failure.
+        """
         try:
             if not os.path.exists(file_path):
                 logging.error(f"File not found: {file_path}")
-                return False
+                return None
 
             # Create ID3 tag if it doesn't exist
             try:
                 audio = ID3(file_path)
             except:
                 audio = ID3()
+            before = self._tag_signature(audio)
 
             # Add basic metadata
             audio['TIT2'] = TIT2(encoding=3, text=track_info['title'])
             audio['TPE1'] = TPE1(encoding=3, text=track_info['artists'][0])
             audio['TALB'] = TALB(encoding=3, text=track_info['album'])
-            audio['TRCK'] = TRCK(encoding=3, text=str(track_info['track_number']))
-            audio['TPOS'] = TPOS(encoding=3, text=str(track_info['disc_number']))
+            audio['TRCK'] = TRCK(encoding=3, text=self._position(track_info['track_number'], track_info.get('total_tracks')))
+            audio['TPOS'] = TPOS(encoding=3, text=self._position(track_info['disc_number'], track_info.get('total_discs')))
+
+            # Album level details added by SpotifyHandler.enrich_tracks
+            if track_info.get('year'):
+                audio['TDRC'] = TDRC(encoding=3, text=str(track_info['year']))
+            if track_info.get('album_artist'):
+                audio['TPE2'] = TPE2(encoding=3, text=track_info['album_artist'])
+            if track_info.get('genre'):
+                audio['TCON'] = TCON(encoding=3, text=track_info['genre'])
+
+            # Loudness measured during the encode pass, if enabled
+            if track_info.get('loudness'):
+                self._set_loudness_tags(audio, track_info['loudness'])
+            if track_info.get('duration_ms'):
+                # Lets mp3_verifier check files against the expected length later
+                audio['TLEN'] = TLEN(encoding=3, text=str(track_info['duration_ms']))
+            if track_info.get('isrc'):
+                audio['TSRC'] = TSRC(encoding=3, text=track_info['isrc'])
+            if track_info.get('id'):
+                # Lets a retag find the track again without searching
+                audio['TXXX:SPOTIFY_TRACK_ID'] = TXXX(encoding=3, desc='SPOTIFY_TRACK_ID', text=track_info['id'])
 
             # Add album art if available
             if track_info.get('album_art'):
-                art_data = self.download_album_art(track_info['album_art'])
+                art_data = self.get_cover_art(track_info['album_art'])
                 if art_data:
-                    try:
-                        # Convert image to JPEG if needed
-                        image = Image.open(BytesIO(art_data))
-                        if image.format != 'JPEG':
-                            output = BytesIO()
-                            image.convert('RGB').save(output, format='JPEG')
-                            art_data = output.getvalue()
-
-                        audio['APIC'] = APIC(
-                            encoding=3,
-                            mime='image/jpeg',
-                            type=3,
-                            desc='Cover',
-                            data=art_data
-                        )
-                    except Exception as e:
-                        logging.error(f"Failed to process album art: {str(e)}")
-
-            # Save the metadata
-            audio.save(file_path)
-            return True
+                    audio.setall('APIC', [APIC(
+                        encoding=3,
+                        mime='image/jpeg',
+                        type=3,
+                        desc='Cover',
+                        data=art_data
+                    )])
+
+            # Nothing changed, leave the file alone
+            if self._tag_signature(audio) == before:
+                return 'unchanged'
+
+            # Save the metadata, reusing the existing padding when the tag fits
+            audio.save(file_path, padding=self._padding)
+            return 'written'
 
         except Exception as e:
             logging.error(f"Failed to embed metadata: {str(e)}")
-            return False
+            return None
 
     def verify_metadata(self, file_path: str) -> bool:
         """Verify that metadata was properly embedded."""
@@ -0,0 +1,170 @@
+import mmap
+import os
+import logging
+from typing import Dict, Iterator, Optional, Tuple
+
+# Bitrates in kbps indexed by [version_is_mpeg1][layer][bitrate_index]
+BITRATES = {
+    True: {
+        1: [0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448],
+        2: [0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384],
+        3: [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+    },
+    False: {
+        1: [0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256],
+        2: [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+        3: [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+    },
+}
+
+# Sample rates in Hz indexed by the two version bits of the header
+SAMPLE_RATES = {
+    3: [44100, 48000, 32000],  # MPEG 1
+    2: [22050, 24000, 16000],  # MPEG 2
+    0: [11025, 12000, 8000],   # MPEG 2.5
+}
+
+# A file with more unparseable bytes than this between frames is flagged
+MAX_GARBAGE_BYTES = 4096
+
+# Allowed difference between the measured and the expected duration
+DURATION_TOLERANCE_MS = 10000
+DURATION_TOLERANCE_RATIO = 0.1
+
+
+def _parse_header(header: int) -> Optional[Tuple[int, int, int, bool]]:
+    """Parse a 32 bit frame header into (frame length, samples, sample rate, mono)."""
+    if header & 0xFFE00000 != 0xFFE00000:
+        return None
+    version = (header >> 19) & 0x3
+    layer = 4 - ((header >> 17) & 0x3)
+    bitrate_index = (header >> 12) & 0xF
+    sample_rate_index = (header >> 10) & 0x3
+    padding = (header >> 9) & 0x1
+    mono = ((header >> 6) & 0x3) == 3
+    if version == 1 or layer == 4 or bitrate_index in (0, 15) or sample_rate_index == 3:
+        return None
+
+    mpeg1 = version == 3
+    bitrate = BITRATES[mpeg1][layer][bitrate_index] * 1000
+    sample_rate = SAMPLE_RATES[version][sample_rate_index]
+    if layer == 1:
+        return (12 * bitrate // sample_rate + padding) * 4, 384, sample_rate, mono
+    if layer == 2 or mpeg1:
+        return 144 * bitrate // sample_rate + padding, 1152, sample_rate, mono
+    return 72 * bitrate // sample_rate + padding, 576, sample_rate, mono
+
+
+def _id3v2_size(data: mmap.mmap) -> int:
+    """Return the size of a leading ID3v2 tag, or 0 if there is none."""
+    if len(data) < 10 or data[:3] != b'ID3':
+        return 0
+    size = (data[6] << 21) | (data[7] << 14) | (data[8] << 7) | data[9]
+    footer = 10 if data[5] & 0x10 else 0
+    return 10 + size + footer
+
+
+def _xing_frames(data: mmap.mmap, offset: int, header: int) -> Optional[int]:
+    """Return the frame count from a Xing/Info (LAME) header in the first frame."""
+    mpeg1 = ((header >> 19) & 0x3) == 3
+    mono = ((header >> 6) & 0x3) == 3
+    side_info = (17 if mono else 32) if mpeg1 else (9 if mono else 17)
+    tag = offset + 4 + side_info
+    if data[tag:tag + 4] not in (b'Xing', b'Info'):
+        return None
+    flags = int.from_bytes(data[tag + 4:tag + 8], 'big')
+    if not flags & 0x1:
+        return None
+    return int.from_bytes(data[tag + 8:tag + 12], 'big')
+
+
+def verify_mp3(file_path: str, expected_ms: Optional[int] = None) -> Dict:
+    """Walk the MPEG frame headers of a file without decoding any audio.
+
+    Returns a report dict with 'ok', a list of 'problems' and the measured
+    'duration_ms'. Problems include truncation (last frame cut off or fewer
+    frames than the Xing header announces), garbage between frames, and a
+    duration that doesn't match the expected one (usually a wrong match).
+    """
+    report = {'path': file_path, 'ok': False, 'problems': [], 'duration_ms': 0, 'frames': 0}
+    try:
+        size = os.path.getsize(file_path)
+        if size == 0:
+            report['problems'].append('empty file')
+            return report
+        with open(file_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            end = size
+            if size >= 128 and data[size - 128:size - 125] == b'TAG':
+                end -= 128
+
+            offset = _id3v2_size(data)
+            frames = 0
+            samples = 0
+            garbage = 0
+            xing_frames = None
+            while offset + 4 <= end:
+                header = int.from_bytes(data[offset:offset + 4], 'big')
+                parsed = _parse_header(header)
+                if parsed is None:
+                    # Lost sync, skip ahead to the next candidate frame start
+                    next_sync = data.find(b'\xff', offset + 1, end)
+                    skipped = (next_sync if next_sync != -1 else end) - offset
+                    garbage += skipped
+                    offset += skipped
+                    continue
+                length, frame_samples, sample_rate, _ = parsed
+                if frames == 0 and xing_frames is None:
+                    xing_frames = _xing_frames(data, offset, header)
+                    if xing_frames is not None:
+                        # The Xing/Info frame carries no audio
+                        offset += length
+                        continue
+                if offset + length > end:
+                    report['problems'].append('last frame is truncated')
+                    break
+                frames += 1
+                samples += frame_samples
+                offset += length
+
+            report['frames'] = frames
+            report['duration_ms'] = int(samples * 1000 / sample_rate) if frames else 0
+
+        if not frames:
+            report['problems'].append('no MPEG audio frames found')
+        if garbage > MAX_GARBAGE_BYTES:
+            report['problems'].append(f'{garbage} bytes of garbage between frames')
+        if xing_frames and frames < xing_frames:
+            report['problems'].append(f'truncated: {frames} of {xing_frames} frames present')
+        if expected_ms and frames:
+            difference = abs(report['duration_ms'] - expected_ms)
+            if difference > max(DURATION_TOLERANCE_MS, expected_ms * DURATION_TOLERANCE_RATIO):
+                report['problems'].append(
+                    f"duration {report['duration_ms'] / 1000:.0f}s differs from expected {expected_ms / 1000:.0f}s"
+                )
+        report['ok'] = not report['problems']
+        return report
+    except Exception as e:
+        logging.error(f"Error scanning {file_path}: {str(e)}")
+        report['problems'].append(str(e))
+        return report
+
+
+def _expected_duration(file_path: str) -> Optional[int]:
+    """Read the expected duration from the TLEN tag written by MetadataHandler."""
+    try:
+        from mutagen.id3 import ID3
+        tlen = ID3(file_path).get('TLEN')
+        return int(str(tlen.text[0])) if tlen else None
+    except Exception:
+        return None
+
+
+def scan_library(root: str) -> Iterator[Dict]:
+    """Verify every MP3 below root, yielding one report per file."""
+    for dirpath, dirnames, filenames in os.walk(root):
+        # Skip our own state folder
+        dirnames[:] = [d for d in dirnames if not d.startswith('.')]
+        for filename in sorted(filenames):
+            if filename.lower().endswith('.mp3'):
+                path = os.path.join(dirpath, filename)
+                yield verify_mp3(path, _expected_duration(path))
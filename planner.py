@@ -0,0 +1,131 @@
+import glob
+import json
+import logging
+import os
+import time
+from dataclasses import dataclass, field, asdict, fields
+from typing import Dict, List, Optional
+
+# Audio seconds LAME encodes per CPU second on a typical desktop core
+ENCODE_SPEED = 30.0
+
+# Search request, politeness delay and tagging per downloaded track (seconds)
+PER_TRACK_OVERHEAD = 6.0
+
+# Throughput assumed when no earlier run has been measured (bytes/s)
+DEFAULT_THROUGHPUT = 1_000_000
+
+
+@dataclass
+class PlannedTrack:
+    """A track in a plan and what the sync is expected to do with it."""
+    index: int
+    spotify_id: Optional[str]
+    title: str
+    artist: str
+    duration_ms: int
+    action: str  # 'download', 'library', 'local' or 'cached'
+
+
+@dataclass
+class SyncPlan:
+    """Cost estimate for a sync that can be executed as-is later."""
+    url: str
+    directory: str
+    playlist_id: Optional[str] = None
+    playlist_name: Optional[str] = None
+    playlist_dir: Optional[str] = None
+    snapshot_id: Optional[str] = None
+    output_profile: Optional[str] = None
+    tracks: List[PlannedTrack] = field(default_factory=list)
+    download_bytes: int = 0
+    output_bytes: int = 0
+    cpu_minutes: float = 0.0
+    wall_seconds: float = 0.0
+    created_at: str = field(default_factory=lambda: time.strftime('%Y-%m-%dT%H:%M:%S'))
+
+    def counts(self) -> Dict[str, int]:
+        """Return the number of tracks per planned action."""
+        counts = {'download': 0, 'library': 0, 'local': 0, 'cached': 0}
+        for track in self.tracks:
+            counts[track.action] = counts.get(track.action, 0) + 1
+        return counts
+
+    def summary(self) -> str:
+        """Return a short human readable description of the plan."""
+        counts = self.counts()
+        return (
+            f"{len(self.tracks)} tracks: {counts['download']} to download, "
+            f"{counts['library']} already in the library, {counts['local']} from local archives, "
+            f"{counts['cached']} from the artifact cache\n"
+            f"~{self.download_bytes / 1_000_000:.0f} MB to download, "
+            f"~{self.output_bytes / 1_000_000:.0f} MB of MP3s, "
+            f"~{self.cpu_minutes:.1f} CPU-minutes of encoding, "
+            f"~{self.wall_seconds / 60:.0f} minutes in total"
+        )
+
+    def to_dict(self) -> Dict:
+        data = asdict(self)
+        data['counts'] = self.counts()
+        return data
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> 'SyncPlan':
+        names = {f.name for f in fields(cls)}
+        plan = cls(**{key: value for key, value in data.items() if key in names and key != 'tracks'})
+        plan.tracks = [PlannedTrack(**track) for track in data.get('tracks', [])]
+        return plan
+
+    def save(self, path: str) -> None:
+        """Write the plan to a JSON file."""
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+    @classmethod
+    def load(cls, path: str) -> 'SyncPlan':
+        """Read a plan written by save."""
+        with open(path, 'r', encoding='utf-8') as f:
+            return cls.from_dict(json.load(f))
+
+
+def measured_throughput(runs_dir: str) -> Optional[float]:
+    """Return the average download rate (bytes/s) of the most recent measured run."""
+    for path in sorted(glob.glob(os.path.join(runs_dir, '*.json')), reverse=True):
+        try:
+            with open(path, 'r') as f:
+                stats = json.load(f)
+        except (OSError, ValueError) as e:
+            logging.warning(f"Skipping unreadable run metrics {path}: {str(e)}")
+            continue
+        # Run files of older versions name the same value average_mbps
+        average = stats.get('average_mb_s') or stats.get('average_mbps')
+        if stats.get('downloaded_bytes') and average:
+            return average * 1_000_000
+    return None
+
+
+def estimate_costs(plan: SyncPlan, profile: Dict, workers: int = 1,
+                   throughput: Optional[float] = None, bandwidth_limit: int = 0) -> None:
+    """Fill in the byte, CPU and wall time estimates of a plan.
+
+    Sizes come from each track's duration and the profile's bitrates; wall
+    time is the slower of transfer and encoding plus per-track overhead,
+    spread across the workers. Tracks from the artifact cache are finished
+    MP3s that only have to be transferred.
+    """
+    download_ms = sum(t.duration_ms or 0 for t in plan.tracks if t.action == 'download')
+    downloads = sum(1 for t in plan.tracks if t.action == 'download')
+    cached_ms = sum(t.duration_ms or 0 for t in plan.tracks if t.action == 'cached')
+    cached_bytes = int(profile['output_kbps'] * 1000 / 8 * cached_ms / 1000)
+    plan.download_bytes = int(profile['min_source_kbps'] * 1000 / 8 * download_ms / 1000)
+    plan.output_bytes = int(profile['output_kbps'] * 1000 / 8 * download_ms / 1000) + cached_bytes
+    plan.cpu_minutes = download_ms / 1000 / ENCODE_SPEED / 60
+
+    rate = throughput or DEFAULT_THROUGHPUT
+    if bandwidth_limit:
+        rate = min(rate, bandwidth_limit)
+    workers = max(workers, 1)
+    transfer = (plan.download_bytes + cached_bytes) / rate
+    encode = plan.cpu_minutes * 60 / workers
+    plan.wall_seconds = max(transfer, encode) + downloads * PER_TRACK_OVERHEAD / workers
@@ -0,0 +1,116 @@
+import os
+import json
+import time
+import pstats
+import cProfile
+import logging
+import threading
+import tracemalloc
+from contextlib import contextmanager
+from typing import Dict, Iterator, Optional
+
+# Allocation sites listed in the memory report
+TOP_ALLOCATIONS = 25
+
+# Frames kept per allocation; enough to see e.g. Image.open behind get_cover_art
+TRACEBACK_FRAMES = 5
+
+
+class StageProfiler:
+    def __init__(self, cpu: bool = False, memory: bool = False):
+        """Initialize optional per-stage CPU and memory profiling for one run.
+
+        With cpu, every stage is run under cProfile and the results are
+        merged per stage name. Only one profiler can be active at a time on
+        newer Pythons, so stages that overlap one another on other workers
+        are timed but not profiled. With memory, tracemalloc traces the run
+        and the growth of traced memory is recorded per stage.
+        """
+        self.cpu = cpu
+        self.memory = memory
+        self._stats: Dict[str, pstats.Stats] = {}
+        self._stages: Dict[str, Dict] = {}
+        self._started_tracing = False
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.cpu or self.memory
+
+    def start(self) -> None:
+        """Start tracing allocations if memory profiling is on."""
+        if self.memory and not tracemalloc.is_tracing():
+            tracemalloc.start(TRACEBACK_FRAMES)
+            self._started_tracing = True
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        """Collect timing, and CPU and memory data if enabled, for a block of stage name."""
+        if not self.enabled:
+            yield
+            return
+        profile = None
+        if self.cpu:
+            profile = cProfile.Profile()
+            try:
+                profile.enable()
+            except ValueError:
+                # Another stage is being profiled right now
+                profile = None
+        memory_before = tracemalloc.get_traced_memory()[0] if self.memory else 0
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            if profile is not None:
+                profile.disable()
+            growth = tracemalloc.get_traced_memory()[0] - memory_before if self.memory else 0
+            with self._lock:
+                entry = self._stages.setdefault(name, {'calls': 0, 'seconds': 0.0, 'profiled': 0, 'max_growth_bytes': 0})
+                entry['calls'] += 1
+                entry['seconds'] += elapsed
+                entry['max_growth_bytes'] = max(entry['max_growth_bytes'], growth)
+                if profile is not None:
+                    entry['profiled'] += 1
+                    if name in self._stats:
+                        self._stats[name].add(profile)
+                    else:
+                        self._stats[name] = pstats.Stats(profile)
+
+    def save(self, directory: str) -> Optional[str]:
+        """Write one .pstats file per stage, a stage summary and the memory report.
+
+        Returns the directory, or None if profiling was off.
+        """
+        if not self.enabled:
+            return None
+        os.makedirs(directory, exist_ok=True)
+        with self._lock:
+            for name, stats in self._stats.items():
+                stats.dump_stats(os.path.join(directory, f"{name}.pstats"))
+            summary = {name: dict(entry, seconds=round(entry['seconds'], 3)) for name, entry in self._stages.items()}
+        if self.memory and tracemalloc.is_tracing():
+            current, peak = tracemalloc.get_traced_memory()
+            summary['_memory'] = {'current_bytes': current, 'peak_bytes': peak}
+            # Leave out what the profilers themselves allocated
+            snapshot = tracemalloc.take_snapshot().filter_traces((
+                tracemalloc.Filter(False, tracemalloc.__file__),
+                tracemalloc.Filter(False, pstats.__file__),
+                tracemalloc.Filter(False, cProfile.__file__),
+                tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+            ))
+            with open(os.path.join(directory, 'allocations.txt'), 'w', encoding='utf-8') as f:
+                f.write(f"Traced memory: {current / 1_000_000:.1f} MB now, {peak / 1_000_000:.1f} MB peak\n\n")
+                for stat in snapshot.statistics('traceback')[:TOP_ALLOCATIONS]:
+                    f.write(f"{stat.size / 1024:.1f} KiB in {stat.count} blocks\n")
+                    for line in stat.traceback.format():
+                        f.write(f"{line}\n")
+                    f.write("\n")
+            if self._started_tracing:
+                tracemalloc.stop()
+                self._started_tracing = False
+        with open(os.path.join(directory, 'stages.json'), 'w', encoding='utf-8') as f:
+            json.dump(summary, f, indent=2)
+        logging.info(f"Profile written to {directory}")
+        return directory
@@ -0,0 +1,139 @@
+import re
+import heapq
+import random
+import time
+from typing import Any, Dict, List, Optional, Tuple
+from json_store import JsonStore
+
+# Error kinds, stored as plain strings so they can go into JSON reports
+NETWORK = 'network'
+THROTTLED = 'throttled'
+UNAVAILABLE = 'unavailable'
+NO_MATCH = 'no_match'
+ENCODE = 'encode'
+VERIFY = 'verify'
+TAG = 'tag'
+TIMEOUT = 'timeout'
+UNKNOWN = 'unknown'
+
+# Kinds that may succeed on a later attempt; the rest go straight to the failure
+# report. A stage that hung once is likely to hang again, so timeouts aren't retried.
+RETRYABLE = {NETWORK, THROTTLED, ENCODE, VERIFY, TAG, UNKNOWN}
+
+# Backoff is capped so a long outage doesn't park a track for hours
+MAX_BACKOFF = 600.0
+
+# Throttling needs a much longer cool-down than a dropped connection
+THROTTLE_FACTOR = 4
+
+# Checked in order, the first pattern that matches the error message wins
+_PATTERNS = [
+    (TIMEOUT, re.compile(r"stage exceeded its \d+s deadline")),
+    (THROTTLED, re.compile(r"HTTP Error 429|Too Many Requests|rate.?limit|not a bot", re.IGNORECASE)),
+    (UNAVAILABLE, re.compile(
+        r"Video unavailable|Private video|has been removed|copyright|not available in your country|"
+        r"members-only|confirm your age|This video is unavailable", re.IGNORECASE)),
+    (NETWORK, re.compile(
+        r"timed? ?out|Connection (?:reset|refused|aborted)|Temporary failure in name resolution|"
+        r"Network is unreachable|HTTP Error 5\d\d|Remote end closed|IncompleteRead|SSL", re.IGNORECASE)),
+    (NO_MATCH, re.compile(r"No results found", re.IGNORECASE)),
+]
+
+
+def classify_error(message: Optional[str], stage: Optional[str] = None) -> str:
+    """Map an error message (and the stage that failed) to an error kind."""
+    for kind, pattern in _PATTERNS:
+        if message and pattern.search(message):
+            return kind
+    if stage in (ENCODE, VERIFY, TAG):
+        return stage
+    return UNKNOWN
+
+
+def is_retryable(kind: Optional[str]) -> bool:
+    """Return whether a failure of this kind is worth another attempt."""
+    return kind in RETRYABLE
+
+
+def backoff_delay(kind: str, attempt: int, base: float) -> float:
+    """Return the delay before attempt + 1, exponential with jitter."""
+    delay = base * 2 ** max(attempt - 1, 0)
+    if kind == THROTTLED:
+        delay *= THROTTLE_FACTOR
+    return min(delay, MAX_BACKOFF) * random.uniform(0.5, 1.5)
+
+
+class RetryQueue:
+    def __init__(self):
+        """Initialize a queue of items that become ready after a delay."""
+        self._heap: List[Tuple[float, int, Any]] = []
+        self._counter = 0
+
+    def push(self, item: Any, delay: float) -> None:
+        """Schedule item to become ready in delay seconds."""
+        self._counter += 1
+        heapq.heappush(self._heap, (time.monotonic() + delay, self._counter, item))
+
+    def pop_ready(self) -> Optional[Any]:
+        """Return the earliest item whose delay has passed, if any."""
+        if self._heap and self._heap[0][0] <= time.monotonic():
+            return heapq.heappop(self._heap)[2]
+        return None
+
+    def next_ready_in(self) -> Optional[float]:
+        """Return the seconds until the next item is ready, or None if empty."""
+        if not self._heap:
+            return None
+        return max(self._heap[0][0] - time.monotonic(), 0.0)
+
+    def drain(self) -> List[Any]:
+        """Remove and return every item regardless of its delay."""
+        items = [item for _, _, item in sorted(self._heap)]
+        self._heap = []
+        return items
+
+    def __len__(self) -> int:
+        return len(self._heap)
+
+
+class FailureReport:
+    def __init__(self, path: str):
+        """Initialize the persistent list of tracks that failed permanently.
+
+        Entries are keyed by Spotify track ID and dropped again once the
+        track succeeds, so the report can be re-run on its own.
+        """
+        self.store = JsonStore(path, autosave_every=10)
+
+    def record(self, result, playlist_dir: Optional[str]) -> None:
+        """Add or update the entry for a failed TrackResult."""
+        key = result.spotify_id or result.isrc or f"{playlist_dir}:{result.title}"
+        self.store.set(key, {
+            'spotify_id': result.spotify_id,
+            'title': result.title,
+            'artist': result.artist,
+            'isrc': result.isrc,
+            'kind': result.error_kind,
+            'message': result.error,
+            'attempts': result.attempts,
+            'playlist_dir': playlist_dir,
+            'failed_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        })
+
+    def resolve(self, spotify_id: Optional[str]) -> None:
+        """Forget a track that has since been processed successfully."""
+        if spotify_id:
+            self.store.delete(spotify_id)
+
+    def by_playlist(self) -> Dict[Optional[str], List[Dict]]:
+        """Group the recorded failures by the playlist folder they belong to."""
+        groups: Dict[Optional[str], List[Dict]] = {}
+        for _, entry in self.store.items():
+            groups.setdefault(entry.get('playlist_dir'), []).append(entry)
+        return groups
+
+    def __len__(self) -> int:
+        return len(self.store)
+
+    def save(self) -> None:
+        self.store.save()
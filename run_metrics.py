@@ -0,0 +1,243 @@
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+from typing import Dict, Optional
+
+# Assumed source size per millisecond of audio until real downloads have been
+# measured (~192 kbps).
+DEFAULT_BYTES_PER_MS = 24.0
+
+# Share of a track's progress attributed to the download vs. the encode.
+DOWNLOAD_WEIGHT = 0.7
+ENCODE_WEIGHT = 0.3
+
+
+def format_eta(seconds: Optional[float]) -> str:
+    """Format a number of seconds as a short human readable duration."""
+    if seconds is None:
+        return "--"
+    seconds = int(seconds)
+    hours, remainder = divmod(seconds, 3600)
+    minutes, seconds = divmod(remainder, 60)
+    if hours:
+        return f"{hours}h{minutes:02d}m"
+    if minutes:
+        return f"{minutes}m{seconds:02d}s"
+    return f"{seconds}s"
+
+
+class RunMetrics:
+    def __init__(self, total_tracks: int, total_duration_ms: int = 0, report_interval: float = 0.5):
+        """Initialize byte and time progress tracking for a single sync run.
+
+        When tracks are streamed in page by page, pass only the track count and
+        register each page with add_tracks as it arrives.
+        """
+        self.total_tracks = total_tracks
+        self.total_duration_ms = total_duration_ms
+        self.known_tracks = total_tracks if total_duration_ms else 0
+        self.report_interval = report_interval
+        self.started_at = time.monotonic()
+        self.completed_tracks = 0
+        self.failed_tracks = 0
+        self.completed_duration_ms = 0
+        self.downloaded_bytes = 0
+        self.measured_bytes = 0
+        self.measured_duration_ms = 0
+        self.encoded_duration_ms = 0
+        self.saved_bytes = 0
+        self.concurrency = 1
+        self.concurrency_decisions = []
+        self._active: Dict[int, Dict] = {}
+        self._window = deque(maxlen=50)
+        self._last_report = 0.0
+        self._lock = threading.Lock()
+
+    def add_tracks(self, tracks) -> None:
+        """Register the durations of a newly fetched page of tracks."""
+        with self._lock:
+            self.known_tracks += len(tracks)
+            self.total_duration_ms += sum(track['duration_ms'] or 0 for track in tracks)
+            self.total_tracks = max(self.total_tracks, self.known_tracks)
+
+    def expected_duration_ms(self) -> float:
+        """Return the run's total audio duration, extrapolating unfetched pages."""
+        if not self.known_tracks:
+            return 0.0
+        average = self.total_duration_ms / self.known_tracks
+        return self.total_duration_ms + average * max(self.total_tracks - self.known_tracks, 0)
+
+    def start_track(self, index: int, duration_ms: int) -> None:
+        """Register a track that is about to be downloaded."""
+        with self._lock:
+            self._active[index] = {
+                'duration_ms': duration_ms,
+                'downloaded': 0,
+                'total_bytes': None,
+                'encoded_ms': 0,
+            }
+
+    def update_download(self, index: int, downloaded: int, total: Optional[int]) -> None:
+        """Record the number of bytes fetched so far for a track."""
+        with self._lock:
+            state = self._active.get(index)
+            if state is None:
+                return
+            delta = downloaded - state['downloaded']
+            if delta < 0:
+                # yt-dlp restarted the transfer (e.g. a retry), count it afresh
+                delta = downloaded
+            state['downloaded'] = downloaded
+            if total:
+                state['total_bytes'] = total
+            self.downloaded_bytes += delta
+            self._window.append((time.monotonic(), self.downloaded_bytes))
+
+    def update_encode(self, index: int, encoded_ms: int) -> None:
+        """Record how much audio FFmpeg has encoded so far for a track."""
+        with self._lock:
+            state = self._active.get(index)
+            if state is not None:
+                state['encoded_ms'] = min(encoded_ms, state['duration_ms'])
+
+    def add_saved_bytes(self, saved: int) -> None:
+        """Record bytes not transferred thanks to picking a smaller source format."""
+        with self._lock:
+            self.saved_bytes += saved
+
+    def record_concurrency(self, decision: Dict) -> None:
+        """Record a change of the number of parallel workers."""
+        with self._lock:
+            self.concurrency = decision['to']
+            self.concurrency_decisions.append(decision)
+
+    def finish_track(self, index: int, success: bool) -> None:
+        """Mark a track as finished and fold its numbers into the run totals."""
+        with self._lock:
+            state = self._active.pop(index, None)
+            if state is None:
+                return
+            self.completed_duration_ms += state['duration_ms']
+            if success:
+                self.completed_tracks += 1
+                if state['downloaded']:
+                    self.measured_bytes += state['downloaded']
+                    self.measured_duration_ms += state['duration_ms']
+                self.encoded_duration_ms += state['encoded_ms']
+            else:
+                self.failed_tracks += 1
+
+    def requeue_track(self, index: int) -> None:
+        """Drop an in-flight track that will be attempted again later.
+
+        Bytes already transferred stay counted, the track's progress doesn't.
+        """
+        with self._lock:
+            self._active.pop(index, None)
+
+    def _track_fraction(self, state: Dict) -> float:
+        """Return how far along a single in-flight track is (0..1)."""
+        download = 0.0
+        if state['total_bytes']:
+            download = min(state['downloaded'] / state['total_bytes'], 1.0)
+        encode = 0.0
+        if state['duration_ms']:
+            encode = state['encoded_ms'] / state['duration_ms']
+        return DOWNLOAD_WEIGHT * download + ENCODE_WEIGHT * encode
+
+    def track_progress(self, index: int) -> float:
+        """Return the progress (0..1) of a single in-flight track."""
+        with self._lock:
+            state = self._active.get(index)
+            return self._track_fraction(state) if state else 1.0
+
+    def overall_progress(self) -> float:
+        """Return overall progress (0..1) weighted by track duration."""
+        with self._lock:
+            expected_ms = self.expected_duration_ms()
+            if not expected_ms:
+                return 0.0
+            done = self.completed_duration_ms
+            for state in self._active.values():
+                done += state['duration_ms'] * self._track_fraction(state)
+            return min(done / expected_ms, 1.0)
+
+    def current_rate(self) -> float:
+        """Return the recent download rate in bytes per second."""
+        with self._lock:
+            if len(self._window) < 2:
+                return 0.0
+            (t0, b0), (t1, b1) = self._window[0], self._window[-1]
+            if time.monotonic() - t1 > 5:
+                return 0.0
+            return (b1 - b0) / (t1 - t0) if t1 > t0 else 0.0
+
+    def average_rate(self) -> float:
+        """Return the effective bytes per second over the whole run so far."""
+        elapsed = time.monotonic() - self.started_at
+        return self.downloaded_bytes / elapsed if elapsed > 0 else 0.0
+
+    def bytes_per_ms(self) -> float:
+        """Return the measured source size per millisecond of audio."""
+        if self.measured_duration_ms and self.measured_bytes:
+            return self.measured_bytes / self.measured_duration_ms
+        return DEFAULT_BYTES_PER_MS
+
+    def eta_seconds(self) -> Optional[float]:
+        """Estimate the remaining time from the remaining audio and measured throughput."""
+        rate = self.average_rate()
+        if rate <= 0:
+            return None
+        with self._lock:
+            remaining_ms = max(self.expected_duration_ms() - self.completed_duration_ms, 0)
+            for state in self._active.values():
+                remaining_ms -= state['duration_ms'] * self._track_fraction(state)
+        return max(remaining_ms, 0) * self.bytes_per_ms() / rate
+
+    def should_report(self) -> bool:
+        """Rate-limit progress messages sent to the GUI."""
+        now = time.monotonic()
+        if now - self._last_report >= self.report_interval:
+            self._last_report = now
+            return True
+        return False
+
+    def snapshot(self) -> Dict:
+        """Return the current metrics as a plain dict."""
+        return {
+            'type': 'stats',
+            'progress': self.overall_progress(),
+            'completed_tracks': self.completed_tracks,
+            'failed_tracks': self.failed_tracks,
+            'total_tracks': self.total_tracks,
+            'downloaded_bytes': self.downloaded_bytes,
+            'saved_bytes': self.saved_bytes,
+            'concurrency': self.concurrency,
+            'concurrency_decisions': list(self.concurrency_decisions),
+            'rate_mb_s': self.current_rate() / 1_000_000,
+            'average_mb_s': self.average_rate() / 1_000_000,
+            'eta_seconds': self.eta_seconds(),
+            'elapsed_seconds': time.monotonic() - self.started_at,
+        }
+
+    def summary(self) -> str:
+        """Return a one line human readable summary of the current state."""
+        stats = self.snapshot()
+        return (
+            f"{stats['downloaded_bytes'] / 1_000_000:.1f} MB at "
+            f"{stats['rate_mb_s']:.2f} MB/s (avg {stats['average_mb_s']:.2f} MB/s), "
+            f"ETA {format_eta(stats['eta_seconds'])}, "
+            f"{stats['saved_bytes'] / 1_000_000:.1f} MB saved by format selection"
+        )
+
+    def save(self, path: str) -> None:
+        """Write the final metrics for this run to a JSON file."""
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'w') as f:
+                json.dump(self.snapshot(), f, indent=2)
+        except OSError as e:
+            logging.error(f"Failed to save run metrics: {str(e)}")
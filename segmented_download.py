@@ -0,0 +1,90 @@
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Set, Tuple
+import requests
+
+# Files smaller than this are fetched over a single connection
+MIN_SEGMENTED_SIZE = 16 * 1024 * 1024
+
+# Each segment covers at least this many bytes
+MIN_SEGMENT_SIZE = 8 * 1024 * 1024
+
+CHUNK_SIZE = 64 * 1024
+
+
+def segment_count(size: int, max_segments: int) -> int:
+    """Return how many segments to split a file of size bytes into."""
+    if size < MIN_SEGMENTED_SIZE:
+        return 1
+    return max(1, min(max_segments, size // MIN_SEGMENT_SIZE))
+
+
+def plan_segments(size: int, count: int) -> List[Tuple[int, int]]:
+    """Split size bytes into count inclusive (start, end) byte ranges."""
+    step = -(-size // count)
+    return [(start, min(start + step, size) - 1) for start in range(0, size, step)]
+
+
+def download_segmented(url: str, path: str, size: int, count: int,
+                       headers: Optional[Dict] = None,
+                       done: Optional[Set[int]] = None,
+                       consume: Optional[Callable[[int], None]] = None,
+                       progress: Optional[Callable[[int, int], None]] = None,
+                       on_segment_done: Optional[Callable[[int], None]] = None,
+                       timeout: float = 30) -> None:
+    """Fetch url into path using count parallel HTTP range requests.
+
+    Every segment is written straight to its offset in the one output file,
+    so nothing has to be joined afterwards. Segments listed in done are
+    skipped, which lets an interrupted download continue; on_segment_done
+    is called as each segment completes. consume is called with the size of
+    every chunk as it is received, before it is written, and may block (e.g.
+    a bandwidth governor); progress gets the bytes fetched in this call and
+    the bytes that were left to fetch.
+    """
+    done = done if done is not None else set()
+    segments = plan_segments(size, count)
+    remaining = sum(end - start + 1 for i, (start, end) in enumerate(segments) if i not in done)
+    fetched = [0]
+    lock = threading.Lock()
+
+    # Create the file without truncating segments written by an earlier attempt
+    with open(path, 'ab'):
+        pass
+
+    def fetch(index: int, start: int, end: int) -> None:
+        range_headers = dict(headers or {})
+        range_headers['Range'] = f"bytes={start}-{end}"
+        with requests.get(url, headers=range_headers, stream=True, timeout=timeout) as response:
+            response.raise_for_status()
+            if response.status_code != 206:
+                raise IOError(f"Server ignored the range request for segment {index}")
+            written = 0
+            with open(path, 'r+b') as f:
+                f.seek(start)
+                for chunk in response.iter_content(CHUNK_SIZE):
+                    if consume:
+                        consume(len(chunk))
+                    f.write(chunk)
+                    written += len(chunk)
+                    with lock:
+                        fetched[0] += len(chunk)
+                        if progress:
+                            progress(fetched[0], remaining)
+            if written != end - start + 1:
+                raise IOError(f"Segment {index} ended after {written} of {end - start + 1} bytes")
+        if on_segment_done:
+            on_segment_done(index)
+
+    pending = [(i, start, end) for i, (start, end) in enumerate(segments) if i not in done]
+    if not pending:
+        return
+    logging.info(f"Fetching {len(pending)} of {len(segments)} segments of {size} bytes")
+    with ThreadPoolExecutor(max_workers=len(pending)) as pool:
+        futures = [pool.submit(fetch, *segment) for segment in pending]
+        # Wait for all of them so no thread is still writing when we raise
+        errors = [future.exception() for future in futures]
+    for error in errors:
+        if error is not None:
+            raise error
@@ -1,8 +1,91 @@
 import re
+import time
 import spotipy
+from concurrent.futures import ThreadPoolExecutor
 from spotipy.oauth2 import SpotifyClientCredentials
-from typing import List, Dict, Optional
+from typing import Any, Iterator, List, Dict, Optional, Set, Tuple
 import logging
+from json_store import JsonStore
+from local_library import normalize
+
+# Batch limits of the several-albums, several-artists and several-tracks endpoints
+ALBUM_BATCH_SIZE = 20
+ARTIST_BATCH_SIZE = 50
+TRACK_BATCH_SIZE = 50
+
+# Page size of the artist-albums endpoint
+ARTIST_ALBUMS_PAGE_SIZE = 50
+
+# Catalog requests sent at the same time when expanding an artist or album
+CATALOG_WORKERS = 4
+
+# Release groups that make up an artist's discography
+DISCOGRAPHY_GROUPS = 'album,single'
+
+# Cached album and artist details are refreshed after this many seconds
+CATALOG_CACHE_TTL = 30 * 24 * 3600
+
+# Only request the playlist item fields that end up in a TrackRecord
+PLAYLIST_TRACK_FIELDS = (
+    'next,total,items(track(type,id,name,duration_ms,track_number,disc_number,'
+    'external_ids(isrc),artists(id,name),album(id,name,images(url))))'
+)
+
+
+class TrackRecord:
+    """Compact per-track metadata that still reads like the old track dicts."""
+
+    __slots__ = (
+        'id', 'title', 'artists', 'artist_ids', 'album', 'album_id', 'album_art',
+        'duration_ms', 'track_number', 'disc_number', 'isrc',
+        'year', 'album_artist', 'genre', 'total_tracks', 'total_discs',
+        'loudness', 'source_format',
+    )
+
+    def __init__(self, **fields: Any):
+        for name in self.__slots__:
+            setattr(self, name, fields.get(name))
+
+    @classmethod
+    def from_spotify(cls, track: Dict) -> 'TrackRecord':
+        """Build a record from a Spotify track object."""
+        album = track.get('album') or {}
+        return cls(
+            id=track.get('id'),
+            title=track['name'],
+            artists=[artist['name'] for artist in track['artists']],
+            artist_ids=[artist.get('id') for artist in track['artists']],
+            album=album.get('name'),
+            album_id=album.get('id'),
+            album_art=album['images'][0]['url'] if album.get('images') else None,
+            duration_ms=track['duration_ms'],
+            track_number=track['track_number'],
+            disc_number=track['disc_number'],
+            isrc=(track.get('external_ids') or {}).get('isrc'),
+        )
+
+    def __getitem__(self, key: str) -> Any:
+        try:
+            return getattr(self, key)
+        except (AttributeError, TypeError):
+            raise KeyError(key)
+
+    def __setitem__(self, key: str, value: Any) -> None:
+        try:
+            setattr(self, key, value)
+        except AttributeError:
+            raise KeyError(key)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.__slots__
+
+    def get(self, key: str, default: Any = None) -> Any:
+        value = getattr(self, key, None)
+        return default if value is None else value
+
+    def to_dict(self) -> Dict:
+        """Return the record as a plain dict."""
+        return {name: getattr(self, name) for name in self.__slots__}
 
 class SpotifyHandler:
     def __init__(self, client_id: Optional[str] = None, client_secret: Optional[str] = None):
@@ -59,44 +142,296 @@ class SpotifyHandler:
             logging.error(f"Failed to extract playlist ID: {str(e)}")
             return None
 
-    def get_playlist_tracks(self, playlist_id: str) -> List[Dict]:
-        """Retrieve all tracks from a playlist with their metadata."""
+    def extract_source(self, url: str) -> Optional[Tuple[str, str]]:
+        """Return the kind ('playlist', 'album', 'artist' or 'track') and ID of a Spotify URL or URI."""
+        match = re.search(r'(playlist|album|artist|track)[:/]([a-zA-Z0-9]+)', url)
+        return (match.group(1), match.group(2)) if match else None
+
+    def get_source_summary(self, kind: str, source_id: str,
+                           cache: Optional[JsonStore] = None) -> Optional[Dict]:
+        """Get the name and track count of any source without listing its tracks.
+
+        An artist's count is only known once duplicates across editions are
+        removed, so the discography is expanded here and its tracks returned
+        under 'pages' for iter_source_pages to pass on.
+        """
+        if kind == 'playlist':
+            return self.get_playlist_summary(source_id)
         try:
-            tracks = []
-            results = self.sp.playlist_tracks(playlist_id)
-            
+            if kind == 'album':
+                album = self.sp.album(source_id)
+                return {'name': album['name'], 'snapshot_id': None, 'total': album['total_tracks']}
+            if kind == 'track':
+                track = self.sp.track(source_id)
+                return {'name': (track.get('album') or {}).get('name') or track['name'], 'snapshot_id': None, 'total': 1}
+            if kind == 'artist':
+                artist = self.sp.artist(source_id)
+                albums = self._discography(source_id)
+                pages = list(self._iter_album_pages([album['id'] for album in albums], cache))
+                return {
+                    'name': artist['name'],
+                    'snapshot_id': None,
+                    'total': sum(len(page) for page in pages),
+                    'pages': pages,
+                }
+        except Exception as e:
+            logging.error(f"Failed to get {kind} information: {str(e)}")
+        return None
+
+    def iter_source_pages(self, kind: str, source_id: str,
+                          cache: Optional[JsonStore] = None,
+                          summary: Optional[Dict] = None) -> Iterator[List[TrackRecord]]:
+        """Yield the tracks of a playlist, album, artist discography or single track in pages.
+
+        Album details fetched along the way are put in the catalog cache, so
+        enriching the tracks afterwards costs no further requests. Pages
+        already fetched by get_source_summary are reused.
+        """
+        if summary and summary.get('pages') is not None:
+            yield from summary['pages']
+        elif kind == 'playlist':
+            yield from self.iter_playlist_pages(source_id)
+        elif kind == 'track':
+            yield self.get_tracks([source_id])
+        elif kind == 'album':
+            yield from self._iter_album_pages([source_id], cache)
+        elif kind == 'artist':
+            albums = self._discography(source_id)
+            yield from self._iter_album_pages([album['id'] for album in albums], cache)
+        else:
+            raise ValueError(f"Unsupported source: {kind}")
+
+    def _discography(self, artist_id: str) -> List[Dict]:
+        """Return one edition of every album and single of an artist, albums first.
+
+        Editions (deluxe, remastered, regional) share a normalized name; the
+        one with the most tracks is kept. Pages after the first are fetched
+        in parallel.
+        """
+        def page(offset: int) -> Dict:
+            return self.sp.artist_albums(artist_id, include_groups=DISCOGRAPHY_GROUPS,
+                                         limit=ARTIST_ALBUMS_PAGE_SIZE, offset=offset)
+
+        first = page(0)
+        items = list(first['items'])
+        offsets = range(ARTIST_ALBUMS_PAGE_SIZE, first.get('total') or 0, ARTIST_ALBUMS_PAGE_SIZE)
+        with ThreadPoolExecutor(max_workers=CATALOG_WORKERS) as pool:
+            for result in pool.map(page, offsets):
+                items.extend(result['items'])
+
+        editions: Dict[str, Dict] = {}
+        for album in items:
+            key = normalize(album['name']) or album['name'].lower()
+            current = editions.get(key)
+            if current is None or (album.get('total_tracks') or 0) > (current.get('total_tracks') or 0):
+                editions[key] = album
+        # Albums before singles so a song keeps its album version
+        return sorted(editions.values(), key=lambda a: (
+            (a.get('album_group') or a.get('album_type')) != 'album', a.get('release_date') or ''
+        ))
+
+    def _iter_album_pages(self, album_ids: List[str], cache: Optional[JsonStore] = None) -> Iterator[List[TrackRecord]]:
+        """Yield the tracks of albums, 20 albums per request, skipping repeats of a recording.
+
+        Album track listings lack ISRCs, so the tracks are then fetched in
+        batches of 50 through the several-tracks endpoint.
+        """
+        seen: Set = set()
+
+        def fetch(batch: List[str]) -> List[str]:
+            track_ids = []
+            for album in self.sp.albums(batch)['albums']:
+                if not album:
+                    continue
+                if cache is not None:
+                    self._cache_album(album, cache)
+                tracks = album.get('tracks') or {}
+                items = list(tracks.get('items') or [])
+                # Albums with more than 50 tracks come with only the first page
+                while tracks.get('next'):
+                    tracks = self.sp.next(tracks)
+                    items.extend(tracks.get('items') or [])
+                track_ids.extend(item['id'] for item in items if item and item.get('id'))
+            return track_ids
+
+        batches = [album_ids[start:start + ALBUM_BATCH_SIZE] for start in range(0, len(album_ids), ALBUM_BATCH_SIZE)]
+        with ThreadPoolExecutor(max_workers=CATALOG_WORKERS) as pool:
+            for track_ids in pool.map(fetch, batches):
+                track_ids = [track_id for track_id in dict.fromkeys(track_ids) if track_id not in seen]
+                seen.update(track_ids)
+                page = []
+                for track in self.get_tracks(track_ids):
+                    keys = self._recording_keys(track)
+                    if keys & seen:
+                        continue
+                    seen.update(keys)
+                    page.append(track)
+                yield page
+
+    @staticmethod
+    def _recording_keys(track: TrackRecord) -> Set:
+        """Return keys under which the same recording on another edition is recognised."""
+        title = normalize(track['title']) or track['title'].lower()
+        artist = normalize(track['artists'][0]) if track['artists'] else ''
+        # Live and alternate versions usually differ in length
+        keys = {(title, artist, round((track['duration_ms'] or 0) / 2000))}
+        if track.get('isrc'):
+            keys.add(track['isrc'].upper())
+        return keys
+
+    def iter_playlist_pages(self, playlist_id: str) -> Iterator[List[TrackRecord]]:
+        """Yield the tracks of a playlist one API page at a time.
+
+        Downloading can start as soon as the first page arrives, and only one
+        page of compact records is held in memory at a time.
+        """
+        try:
+            results = self.sp.playlist_items(
+                playlist_id,
+                fields=PLAYLIST_TRACK_FIELDS,
+                additional_types=('track',)
+            )
+
             while results:
+                page = []
                 for item in results['items']:
-                    track = item['track']
-                    if track is None:
+                    track = item.get('track')
+                    if track is None or track.get('type', 'track') != 'track':
                         continue
-                        
-                    track_info = {
-                        'title': track['name'],
-                        'artists': [artist['name'] for artist in track['artists']],
-                        'album': track['album']['name'],
-                        'album_art': track['album']['images'][0]['url'] if track['album']['images'] else None,
-                        'duration_ms': track['duration_ms'],
-                        'track_number': track['track_number'],
-                        'disc_number': track['disc_number']
-                    }
-                    tracks.append(track_info)
-                
+                    page.append(TrackRecord.from_spotify(track))
+                yield page
+
                 if results['next']:
                     results = self.sp.next(results)
                 else:
                     break
-                    
-            return tracks
         except Exception as e:
             logging.error(f"Failed to get playlist tracks: {str(e)}")
             raise
 
-    def get_playlist_name(self, playlist_id: str) -> Optional[str]:
-        """Get the name of a playlist."""
+    def get_playlist_tracks(self, playlist_id: str) -> List[TrackRecord]:
+        """Retrieve all tracks from a playlist with their metadata."""
+        return [track for page in self.iter_playlist_pages(playlist_id) for track in page]
+
+    def get_tracks(self, track_ids: List[str]) -> List[TrackRecord]:
+        """Fetch current metadata for tracks by ID, 50 per request."""
+        records = []
+        for start in range(0, len(track_ids), TRACK_BATCH_SIZE):
+            batch = track_ids[start:start + TRACK_BATCH_SIZE]
+            try:
+                tracks = self.sp.tracks(batch)['tracks']
+            except Exception as e:
+                logging.error(f"Failed to fetch tracks: {str(e)}")
+                continue
+            records.extend(TrackRecord.from_spotify(track) for track in tracks if track)
+        return records
+
+    def find_track_by_isrc(self, isrc: str) -> Optional[TrackRecord]:
+        """Look up a track by ISRC for files that predate the Spotify ID tag."""
         try:
-            playlist = self.sp.playlist(playlist_id)
-            return playlist['name']
+            results = self.sp.search(q=f"isrc:{isrc}", type='track', limit=1)
+            items = results['tracks']['items']
+            return TrackRecord.from_spotify(items[0]) if items else None
         except Exception as e:
-            logging.error(f"Failed to get playlist name: {str(e)}")
-            return None 
\ No newline at end of file
+            logging.error(f"Failed to search for ISRC {isrc}: {str(e)}")
+            return None
+
+    def _cached(self, cache: JsonStore, key: str) -> Optional[Dict]:
+        """Return a cache entry if it is still fresh."""
+        entry = cache.get(key)
+        if entry and time.time() - entry.get('fetched_at', 0) < CATALOG_CACHE_TTL:
+            return entry
+        return None
+
+    def _fetch_albums(self, album_ids: List[str], cache: JsonStore) -> None:
+        """Fetch album details in batches through the several-albums endpoint."""
+        missing = [album_id for album_id in album_ids if not self._cached(cache, f"album:{album_id}")]
+        for start in range(0, len(missing), ALBUM_BATCH_SIZE):
+            batch = missing[start:start + ALBUM_BATCH_SIZE]
+            try:
+                albums = self.sp.albums(batch)['albums']
+            except Exception as e:
+                logging.error(f"Failed to fetch album details: {str(e)}")
+                continue
+            for album in albums:
+                if album:
+                    self._cache_album(album, cache)
+
+    def _cache_album(self, album: Dict, cache: JsonStore) -> None:
+        """Store the details of a full album object that enrich_tracks uses."""
+        album_tracks = album.get('tracks', {}).get('items') or []
+        cache.set(f"album:{album['id']}", {
+            'fetched_at': time.time(),
+            'year': (album.get('release_date') or '')[:4] or None,
+            'album_artist': album['artists'][0]['name'] if album.get('artists') else None,
+            'album_artist_id': album['artists'][0].get('id') if album.get('artists') else None,
+            'genres': album.get('genres') or [],
+            'total_tracks': album.get('total_tracks'),
+            'total_discs': max((t.get('disc_number', 1) for t in album_tracks), default=None),
+        })
+
+    def _fetch_artists(self, artist_ids: List[str], cache: JsonStore) -> None:
+        """Fetch artist genres in batches through the several-artists endpoint."""
+        missing = [artist_id for artist_id in artist_ids if not self._cached(cache, f"artist:{artist_id}")]
+        for start in range(0, len(missing), ARTIST_BATCH_SIZE):
+            batch = missing[start:start + ARTIST_BATCH_SIZE]
+            try:
+                artists = self.sp.artists(batch)['artists']
+            except Exception as e:
+                logging.error(f"Failed to fetch artist details: {str(e)}")
+                continue
+            for artist in artists:
+                if artist:
+                    cache.set(f"artist:{artist['id']}", {
+                        'fetched_at': time.time(),
+                        'genres': artist.get('genres') or [],
+                    })
+
+    def enrich_tracks(self, tracks: List[TrackRecord], cache: JsonStore) -> None:
+        """Add year, album artist, genre and track/disc totals to each track.
+
+        Unique albums and artists are fetched in batches and cached across runs,
+        so a playlist costs only a few extra requests.
+        """
+        album_ids = list(dict.fromkeys(t['album_id'] for t in tracks if t.get('album_id')))
+        self._fetch_albums(album_ids, cache)
+
+        artist_ids = []
+        for track in tracks:
+            if track.get('artist_ids') and track['artist_ids'][0]:
+                artist_ids.append(track['artist_ids'][0])
+        self._fetch_artists(list(dict.fromkeys(artist_ids)), cache)
+
+        for track in tracks:
+            album = cache.get(f"album:{track.get('album_id')}") or {}
+            genres = album.get('genres') or []
+            if not genres and track.get('artist_ids'):
+                genres = (cache.get(f"artist:{track['artist_ids'][0]}") or {}).get('genres') or []
+            track['year'] = album.get('year')
+            track['album_artist'] = album.get('album_artist')
+            track['genre'] = genres[0].title() if genres else None
+            track['total_tracks'] = album.get('total_tracks')
+            total_discs = album.get('total_discs')
+            if total_discs:
+                # Albums with more than 50 tracks only return the first page
+                total_discs = max(total_discs, track['disc_number'])
+            track['total_discs'] = total_discs
+        cache.save()
+
+    def get_playlist_summary(self, playlist_id: str) -> Optional[Dict]:
+        """Get the name, snapshot and track count of a playlist in one small request."""
+        try:
+            playlist = self.sp.playlist(playlist_id, fields='name,snapshot_id,tracks(total)')
+            return {
+                'name': playlist['name'],
+                'snapshot_id': playlist.get('snapshot_id'),
+                'total': playlist['tracks']['total'],
+            }
+        except Exception as e:
+            logging.error(f"Failed to get playlist information: {str(e)}")
+            return None
+
+    def get_playlist_name(self, playlist_id: str) -> Optional[str]:
+        """Get the name of a playlist."""
+        summary = self.get_playlist_summary(playlist_id)
+        return summary['name'] if summary else None 
\ No newline at end of file
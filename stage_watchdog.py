@@ -0,0 +1,121 @@
+import time
+import logging
+import threading
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, Optional
+
+# Default per-stage deadlines in seconds
+DEFAULT_DEADLINES = {
+    'search': 120,
+    'download': 3600,
+    'encode': 1800,
+    'art': 60,
+    'tag': 120,
+}
+
+# How long stuck work gets to stop on its own after its deadline before the
+# scheduler abandons it
+ABANDON_GRACE = 30.0
+
+
+class StageTimeout(Exception):
+    """A stage of a track ran past its deadline."""
+
+    def __init__(self, stage: str, deadline: float):
+        super().__init__(f"{stage} stage exceeded its {deadline:.0f}s deadline")
+        self.stage = stage
+        self.deadline = deadline
+
+
+class Watchdog:
+    def __init__(self, deadlines: Optional[Dict[str, float]] = None, poll_interval: float = 1.0):
+        """Initialize a watchdog that enforces per-stage deadlines from one thread.
+
+        Workers wrap each stage in stage(); when a deadline passes, the
+        stage's on_timeout callback (e.g. killing FFmpeg) is run and the stage
+        raises StageTimeout when it returns. Work that never returns can be
+        found with overdue() and abandoned by the caller.
+        """
+        self.deadlines = dict(DEFAULT_DEADLINES)
+        self.deadlines.update(deadlines or {})
+        self.poll_interval = poll_interval
+        self._active: Dict[int, Dict] = {}
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+    @contextmanager
+    def task(self, token: Any) -> Iterator[None]:
+        """Associate the stages run by this thread with token (e.g. a track attempt)."""
+        self._local.token = token
+        try:
+            yield
+        finally:
+            self._local.token = None
+
+    @contextmanager
+    def stage(self, name: str, on_timeout: Optional[Callable[[], None]] = None) -> Iterator[Dict]:
+        """Run a block under the deadline configured for stage name."""
+        deadline = self.deadlines.get(name)
+        if not deadline:
+            yield {}
+            return
+        entry = {
+            'token': getattr(self._local, 'token', None),
+            'stage': name,
+            'deadline': deadline,
+            'expires': time.monotonic() + deadline,
+            'on_timeout': on_timeout,
+            'expired': False,
+        }
+        key = id(entry)
+        with self._lock:
+            self._active[key] = entry
+            self._ensure_thread()
+        try:
+            yield entry
+        except Exception as e:
+            # Also check the clock, the monitor only looks once per poll interval
+            if entry['expired'] or time.monotonic() > entry['expires']:
+                raise StageTimeout(name, deadline) from e
+            raise
+        finally:
+            with self._lock:
+                self._active.pop(key, None)
+
+    def overdue(self, token: Any, grace: float = ABANDON_GRACE) -> Optional[str]:
+        """Return the stage of token that is past its deadline plus grace, if any."""
+        now = time.monotonic()
+        with self._lock:
+            for entry in self._active.values():
+                if entry['token'] is token and now > entry['expires'] + grace:
+                    return entry['stage']
+        return None
+
+    def release(self, token: Any) -> None:
+        """Stop watching every stage of an abandoned token."""
+        with self._lock:
+            for key in [key for key, entry in self._active.items() if entry['token'] is token]:
+                del self._active[key]
+
+    def _ensure_thread(self) -> None:
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._monitor, daemon=True)
+            self._thread.start()
+
+    def _monitor(self) -> None:
+        while True:
+            time.sleep(self.poll_interval)
+            now = time.monotonic()
+            with self._lock:
+                expired = [entry for entry in self._active.values()
+                           if not entry['expired'] and now > entry['expires']]
+                for entry in expired:
+                    entry['expired'] = True
+            for entry in expired:
+                logging.warning(f"{entry['stage']} stage exceeded its {entry['deadline']:.0f}s deadline")
+                if entry['on_timeout']:
+                    try:
+                        entry['on_timeout']()
+                    except Exception as e:
+                        logging.error(f"Failed to stop stuck {entry['stage']} stage: {str(e)}")
@@ -0,0 +1,1053 @@
+import os
+import time
+import hashlib
+import queue
+import logging
+import threading
+from concurrent.futures import FIRST_COMPLETED, Future, wait
+from dataclasses import dataclass, field, asdict, fields, replace
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+from spotify_handler import SpotifyHandler, TrackRecord
+from youtube_handler import YouTubeHandler, DownloadError
+from metadata_handler import MetadataHandler, DEFAULT_ID3_PADDING
+from format_policy import DEFAULT_PROFILE, get_profile
+from planner import PlannedTrack, SyncPlan, estimate_costs, measured_throughput
+from bandwidth import get_governor
+from run_metrics import RunMetrics
+from library_index import LibraryIndex, link_or_copy, publish_file
+from json_store import JsonStore
+from concurrency import AIMDController
+from artifact_cache import DEFAULT_MAX_BYTES, artifact_key, open_artifact_store
+from stage_watchdog import StageTimeout, Watchdog
+from local_library import LocalLibrary, duration_matches, read_audio_tags
+from device_sync import DeviceSync, TransferReport
+from profiling import StageProfiler
+from retry_policy import TAG, TIMEOUT, VERIFY, FailureReport, RetryQueue, backoff_delay, classify_error, is_retryable
+
+# Hidden folder inside the download directory for caches, indexes and run logs
+STATE_DIR = '.ipodfiller'
+
+EventCallback = Callable[[Dict], None]
+
+# How often the scheduler looks for attempts stuck past their deadline (seconds)
+ABANDON_CHECK_INTERVAL = 5.0
+
+
+def _track_keys(track: TrackRecord) -> Tuple[str, ...]:
+    """Return the keys under which attempts of a track share partial, scratch and output files."""
+    keys = []
+    if track.get('id'):
+        keys.append(f"id:{track['id']}")
+    if track.get('isrc'):
+        keys.append(f"isrc:{track['isrc'].upper()}")
+    return tuple(keys)
+
+
+def _run_in_daemon_thread(fn: Callable, *args) -> Future:
+    """Run fn on a new daemon thread and return a future for its result.
+
+    Unlike a ThreadPoolExecutor's workers, a daemon thread that never
+    returns doesn't keep the interpreter from exiting.
+    """
+    future: Future = Future()
+
+    def runner() -> None:
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            future.set_result(fn(*args))
+        except BaseException as e:
+            future.set_exception(e)
+
+    threading.Thread(target=runner, daemon=True).start()
+    return future
+
+
+@dataclass
+class SyncConfig:
+    """Options for a SyncEngine; the keys match those in config.json."""
+    loudness_analysis: bool = False
+    output_profile: str = DEFAULT_PROFILE
+    id3_padding: int = DEFAULT_ID3_PADDING
+    local_library_roots: List[str] = field(default_factory=list)
+    min_workers: int = 1
+    max_workers: int = 1
+    concurrency_interval: float = 30.0
+    max_attempts: int = 4
+    retry_base_delay: float = 30.0
+    download_segments: int = 4
+    bandwidth_limit: int = 0
+    artifact_cache: Optional[str] = None
+    artifact_cache_max_bytes: int = DEFAULT_MAX_BYTES
+    stage_deadlines: Dict[str, float] = field(default_factory=dict)
+    scratch_dir: Optional[str] = None
+    device_path: Optional[str] = None
+    device_delete_removed: bool = False
+    device_workers: int = 2
+    profile_cpu: bool = False
+    profile_memory: bool = False
+    watch_playlists: List[str] = field(default_factory=list)
+    watch_interval: float = 3600.0
+    watch_jitter: float = 0.5
+    watch_api_rate: float = 1.0
+    bandwidth_schedule: List[Dict] = field(default_factory=list)
+
+    @classmethod
+    def from_dict(cls, config: Dict) -> 'SyncConfig':
+        """Build a config from a dict, ignoring unknown keys such as credentials."""
+        names = {f.name for f in fields(cls)}
+        return cls(**{key: value for key, value in config.items() if key in names})
+
+
+@dataclass
+class TrackResult:
+    """Outcome of a single track in a sync."""
+    index: int
+    title: str
+    artist: str
+    spotify_id: Optional[str]
+    isrc: Optional[str]
+    status: str = 'failed'
+    file_path: Optional[str] = None
+    error: Optional[str] = None
+    error_kind: Optional[str] = None
+    attempts: int = 0
+
+
+@dataclass
+class SyncReport:
+    """Structured result of syncing one playlist."""
+    url: str
+    playlist_name: Optional[str] = None
+    playlist_dir: Optional[str] = None
+    tracks: List[TrackResult] = field(default_factory=list)
+    metrics: Dict = field(default_factory=dict)
+    cancelled: bool = False
+    error: Optional[str] = None
+
+    @property
+    def succeeded(self) -> List[TrackResult]:
+        return [t for t in self.tracks if t.status in ('downloaded', 'reused', 'local', 'cached', 'retagged', 'unchanged')]
+
+    @property
+    def failed(self) -> List[TrackResult]:
+        return [t for t in self.tracks if t.status == 'failed']
+
+    def to_dict(self) -> Dict:
+        return asdict(self)
+
+
+@dataclass
+class _Run:
+    """State shared by the scheduler and workers of one playlist run."""
+    emit: EventCallback
+    report: SyncReport
+    youtube: YouTubeHandler
+    library: LibraryIndex
+    local_library: Optional[LocalLibrary]
+    failures: FailureReport
+    metrics: RunMetrics
+    concurrency: AIMDController
+    profiler: StageProfiler = field(default_factory=StageProfiler)
+    album_loudness: Dict = field(default_factory=dict)
+    # Track IDs and ISRCs of running attempts, only touched by the scheduler
+    in_flight: set = field(default_factory=set)
+    lock: threading.Lock = field(default_factory=threading.Lock)
+
+
+class SyncEngine:
+    def __init__(self, config: Optional[SyncConfig] = None,
+                 spotify: Optional[SpotifyHandler] = None,
+                 metadata: Optional[MetadataHandler] = None):
+        """Initialize a reusable sync engine.
+
+        Clients and per-library caches are kept for the lifetime of the engine,
+        so syncing many playlists in one process shares HTTP sessions, the
+        Spotify catalog cache and the library index.
+        """
+        self.config = config or SyncConfig()
+        self.spotify = spotify or SpotifyHandler()
+        self.metadata = metadata or MetadataHandler(id3_padding=self.config.id3_padding)
+        self._libraries: Dict[str, LibraryIndex] = {}
+        self._catalog_caches: Dict[str, JsonStore] = {}
+        self._local_libraries: Dict[str, LocalLibrary] = {}
+        self._failure_reports: Dict[str, FailureReport] = {}
+        self._resume_stores: Dict[str, JsonStore] = {}
+        self.artifacts = open_artifact_store(self.config.artifact_cache, self.config.artifact_cache_max_bytes)
+        self.watchdog = Watchdog(self.config.stage_deadlines)
+        self.governor = get_governor()
+        self.governor.configure(self.config.bandwidth_limit, self.config.bandwidth_schedule)
+        self._cache_lock = threading.Lock()
+
+    def set_bandwidth_limit(self, limit: int) -> None:
+        """Change the download budget in bytes per second (0 = unlimited), also mid-sync."""
+        self.governor.set_limit(limit)
+
+    def state_path(self, directory: str, *parts: str) -> str:
+        """Return a path inside the engine's state folder for a download directory."""
+        return os.path.join(directory, STATE_DIR, *parts)
+
+    def scratch_path(self, directory: str, *parts: str) -> str:
+        """Return a path in the scratch area for partial downloads and encodes.
+
+        Without a configured scratch_dir this is the state folder. A shared
+        scratch_dir (e.g. a tmpfs) gets a subfolder per download directory.
+        """
+        if not self.config.scratch_dir:
+            return self.state_path(directory, *parts)
+        name = hashlib.sha1(os.path.abspath(directory).encode('utf-8')).hexdigest()[:12]
+        return os.path.join(self.config.scratch_dir, name, *parts)
+
+    def library_for(self, directory: str) -> LibraryIndex:
+        """Return the shared library index for a download directory."""
+        key = os.path.abspath(directory)
+        with self._cache_lock:
+            if key not in self._libraries:
+                self._libraries[key] = LibraryIndex(self.state_path(directory, 'library.json'), directory)
+            return self._libraries[key]
+
+    def catalog_cache_for(self, directory: str) -> JsonStore:
+        """Return the shared Spotify album/artist cache for a download directory."""
+        key = os.path.abspath(directory)
+        with self._cache_lock:
+            if key not in self._catalog_caches:
+                self._catalog_caches[key] = JsonStore(self.state_path(directory, 'spotify_cache.json'))
+            return self._catalog_caches[key]
+
+    def local_library_for(self, directory: str) -> Optional[LocalLibrary]:
+        """Return the local archive resolver for a download directory, if roots are configured."""
+        if not self.config.local_library_roots:
+            return None
+        key = os.path.abspath(directory)
+        with self._cache_lock:
+            if key not in self._local_libraries:
+                self._local_libraries[key] = LocalLibrary(
+                    self.config.local_library_roots,
+                    self.state_path(directory, 'local_library.json')
+                )
+            return self._local_libraries[key]
+
+    def _progress_callback(self, emit: EventCallback, metrics: RunMetrics, index: int) -> Callable:
+        """Build a callback that folds per-track progress into the run metrics."""
+        def report(stage: str, done: float, total: Optional[float]):
+            if stage == 'download':
+                metrics.update_download(index, int(done), int(total) if total else None)
+            elif stage == 'encode':
+                metrics.update_encode(index, int(done))
+            if metrics.should_report():
+                emit({'type': 'progress', 'value': metrics.overall_progress()})
+                emit(metrics.snapshot())
+                emit({'type': 'track', 'index': index, 'progress': metrics.track_progress(index)})
+        return report
+
+    def _track_event(self, emit: EventCallback, index: int, track: TrackRecord, state: str) -> None:
+        """Send a structured per-track state change."""
+        emit({
+            'type': 'track',
+            'index': index,
+            'title': track['title'],
+            'artist': track['artists'][0] if track['artists'] else '',
+            'album': track['album'],
+            'state': state,
+        })
+
+    def use_legacy_file(self, emit: EventCallback, library: LibraryIndex, youtube: YouTubeHandler,
+                        track: TrackRecord, destination: str) -> bool:
+        """Rename this playlist's file from the title-only name of older versions to destination.
+
+        Files written before the library index existed aren't in it, so the
+        file is taken if its duration matches the track even when unindexed.
+        """
+        legacy = youtube.legacy_output_file(track)
+        if os.path.normpath(legacy) == os.path.normpath(destination) or not os.path.exists(legacy):
+            return False
+        source = library.lookup(track.get('isrc'))
+        indexed = source is not None and os.path.normpath(source) == os.path.normpath(legacy)
+        if not indexed and not youtube.verify_download(legacy, track):
+            return False
+        try:
+            os.replace(legacy, destination)
+        except OSError as e:
+            # E.g. another track with the same title took it first
+            logging.warning(f"Failed to rename {legacy}: {str(e)}")
+            return False
+        library.add(track.get('isrc'), destination)
+        emit({'type': 'status', 'message': f"Renamed to {os.path.basename(destination)}: {track['title']}"})
+        return True
+
+    def use_library_copy(self, emit: EventCallback, library: LibraryIndex,
+                         track: TrackRecord, destination: str) -> Optional[str]:
+        """Link or copy an already downloaded recording instead of fetching it again.
+
+        Returns the path it was placed at, which keeps the recording's extension.
+        """
+        source = library.lookup(track.get('isrc'))
+        if not source:
+            return None
+        # The recording may be an .m4a from the local archive
+        destination = os.path.splitext(destination)[0] + os.path.splitext(source)[1].lower()
+        try:
+            method = link_or_copy(source, destination)
+        except OSError as e:
+            logging.error(f"Failed to reuse {source}: {str(e)}")
+            return None
+        # A hard link shares its tags with the canonical file, only retag MP3 copies
+        if method == 'copied' and destination.endswith('.mp3') and \
+                not self.metadata.embed_metadata(destination, track):
+            emit({'type': 'status', 'message': f"Failed to embed metadata: {track['title']}"})
+            return None
+        emit({'type': 'status', 'message': f"Reused from library ({method}): {track['title']}"})
+        return destination
+
+    def use_local_file(self, emit: EventCallback, local_library: Optional[LocalLibrary], youtube: YouTubeHandler,
+                       track: TrackRecord, destination: str) -> Optional[str]:
+        """Link or copy a matching file from a local archive instead of downloading it."""
+        if local_library is None:
+            return None
+        source = local_library.resolve(track)
+        if not source:
+            return None
+        # Same checks as a download; only MP3s have frames to walk
+        if source.lower().endswith('.mp3'):
+            verified = youtube.verify_download(source, track)
+        else:
+            verified = duration_matches((read_audio_tags(source) or {}).get('duration_ms'), track.get('duration_ms'))
+        if not verified:
+            logging.warning(f"Local file {source} failed verification, downloading instead")
+            return None
+        # Keep the archive's container, e.g. an .m4a stays an .m4a
+        destination = os.path.splitext(destination)[0] + os.path.splitext(source)[1].lower()
+        try:
+            method = link_or_copy(source, destination)
+        except OSError as e:
+            logging.error(f"Failed to use local file {source}: {str(e)}")
+            return None
+        # Never touch tags of files shared with the archive; only MP3 copies get our tags
+        if method == 'copied' and destination.endswith('.mp3') and \
+                not self.metadata.embed_metadata(destination, track):
+            emit({'type': 'status', 'message': f"Failed to embed metadata: {track['title']}"})
+            return None
+        emit({'type': 'status', 'message': f"Found in local library ({method}): {track['title']}"})
+        return destination
+
+    def iter_tracks(self, source_id: str, catalog_cache: JsonStore, metrics: RunMetrics,
+                    kind: str = 'playlist', summary: Optional[Dict] = None) -> Iterator[TrackRecord]:
+        """Stream enriched tracks page by page so downloads start after the first page."""
+        for page in self.spotify.iter_source_pages(kind, source_id, catalog_cache, summary):
+            # Fill in year, album artist, genre and totals in a few batched requests
+            self.spotify.enrich_tracks(page, catalog_cache)
+            metrics.add_tracks(page)
+            yield from page
+
+    def add_album_loudness(self, run: '_Run', track: TrackRecord, file_path: str,
+                           loudness: Optional[Dict] = None) -> None:
+        """Remember a track's loudness, measured now or read from its tags, for its album gain."""
+        if not self.config.loudness_analysis or not file_path.endswith('.mp3'):
+            return
+        loudness = loudness or self.metadata.read_loudness(file_path)
+        if not loudness:
+            return
+        with run.lock:
+            album = run.album_loudness.setdefault(track.get('album_id'), {'total': track.get('total_tracks'), 'tracks': {}})
+            album['tracks'][track.get('id') or file_path] = (file_path, loudness, track['duration_ms'])
+
+    def write_album_gain(self, emit: EventCallback, album_loudness: Dict) -> None:
+        """Tag album gain for the albums of which every track has been measured in the run."""
+        for album_id, album in album_loudness.items():
+            entries = list(album['tracks'].values())
+            # A mean over part of an album isn't its gain; leave existing tags alone
+            if not album_id or not album['total'] or len(entries) < album['total']:
+                continue
+            if not self.metadata.embed_album_gain(entries):
+                emit({'type': 'status', 'message': f"Failed to write album gain for {len(entries)} tracks"})
+
+    def resume_store_for(self, directory: str) -> JsonStore:
+        """Return the shared record of partial downloads for a download directory."""
+        key = os.path.abspath(directory)
+        with self._cache_lock:
+            if key not in self._resume_stores:
+                # Saved on every change so it survives the process being killed
+                self._resume_stores[key] = JsonStore(self.state_path(directory, 'partial.json'), autosave_every=1)
+            return self._resume_stores[key]
+
+    def failures_for(self, directory: str) -> FailureReport:
+        """Return the shared permanent-failure report for a download directory."""
+        key = os.path.abspath(directory)
+        with self._cache_lock:
+            if key not in self._failure_reports:
+                self._failure_reports[key] = FailureReport(self.state_path(directory, 'failures.json'))
+            return self._failure_reports[key]
+
+    def sync(self, url: str, directory: str,
+             on_event: Optional[EventCallback] = None,
+             is_cancelled: Optional[Callable[[], bool]] = None) -> SyncReport:
+        """Download a playlist into directory and return a per-track report.
+
+        Progress is reported through on_event as dicts with a 'type' of
+        'status', 'progress', 'stats' or 'track'.
+        """
+        emit = on_event or (lambda event: None)
+        is_cancelled = is_cancelled or (lambda: False)
+        report = SyncReport(url=url)
+
+        def fail(message: str) -> SyncReport:
+            report.error = message
+            emit({'type': 'status', 'message': f"Error: {message}"})
+            return report
+
+        try:
+            # Check if we have valid credentials
+            if not self.spotify.is_configured():
+                return fail("Spotify credentials not configured")
+
+            # Extract the playlist, album, artist or track ID
+            source = self.spotify.extract_source(url)
+            if not source:
+                return fail("Invalid Spotify playlist, album, artist or track URL")
+            kind, source_id = source
+
+            # Get the name and size without fetching any tracks yet
+            summary = self.spotify.get_source_summary(kind, source_id, self.catalog_cache_for(directory))
+            if not summary:
+                return fail(f"Could not retrieve {kind} information")
+            playlist_name = summary['name']
+            report.playlist_name = playlist_name
+
+            emit({'type': 'status', 'message': f"Processing {kind}: {playlist_name}"})
+
+            total_tracks = summary['total']
+            if not total_tracks:
+                return fail("No tracks found in playlist")
+
+            emit({'type': 'status', 'message': f"Found {total_tracks} tracks"})
+
+            # Create playlist directory
+            playlist_dir = os.path.join(directory, playlist_name)
+            os.makedirs(playlist_dir, exist_ok=True)
+            report.playlist_dir = playlist_dir
+
+            metrics = RunMetrics(total_tracks)
+            tracks = self.iter_tracks(source_id, self.catalog_cache_for(directory), metrics, kind, summary)
+            self._run(emit, is_cancelled, report, directory, playlist_dir, tracks, metrics)
+            if self.config.device_path and not report.cancelled:
+                self.transfer([playlist_dir], self.config.device_path, emit, is_cancelled)
+            return report
+
+        except Exception as e:
+            logging.error(f"Download process error: {str(e)}")
+            return fail(str(e))
+
+    def transfer(self, playlist_dirs: List[str], device_path: Optional[str] = None,
+                 on_event: Optional[EventCallback] = None,
+                 is_cancelled: Optional[Callable[[], bool]] = None) -> TransferReport:
+        """Mirror playlist folders onto a mounted device, copying only what changed."""
+        device = DeviceSync(
+            device_path or self.config.device_path,
+            workers=self.config.device_workers,
+            delete_removed=self.config.device_delete_removed,
+            skip_dirs=(STATE_DIR,)
+        )
+        return device.mirror(playlist_dirs, on_event, is_cancelled)
+
+    def plan(self, url: str, directory: str,
+             on_event: Optional[EventCallback] = None) -> SyncPlan:
+        """Estimate what syncing a playlist, album or artist would cost without downloading anything.
+
+        Only Spotify ingestion and the library, local archive and artifact
+        cache lookups run.
+        The returned plan can be saved and passed to execute_plan later.
+        """
+        emit = on_event or (lambda event: None)
+        plan = SyncPlan(url=url, directory=directory, output_profile=self.config.output_profile)
+        if not self.spotify.is_configured():
+            raise ValueError("Spotify credentials not configured")
+        source = self.spotify.extract_source(url)
+        if not source:
+            raise ValueError("Invalid Spotify playlist, album, artist or track URL")
+        kind, source_id = source
+        summary = self.spotify.get_source_summary(kind, source_id, self.catalog_cache_for(directory))
+        if not summary:
+            raise ValueError(f"Could not retrieve {kind} information")
+        # Only playlists have a snapshot to check again when the plan runs
+        plan.playlist_id = source_id if kind == 'playlist' else None
+        plan.playlist_name = summary['name']
+        plan.snapshot_id = summary.get('snapshot_id')
+        plan.playlist_dir = os.path.join(directory, summary['name'])
+
+        library = self.library_for(directory)
+        local_library = self.local_library_for(directory)
+        if local_library is not None:
+            local_library.scan()
+        metrics = RunMetrics(summary['total'])
+        for i, track in enumerate(self.iter_tracks(source_id, self.catalog_cache_for(directory), metrics, kind, summary), 1):
+            key = artifact_key(track, plan.output_profile)
+            if library.lookup(track.get('isrc')):
+                action = 'library'
+            elif local_library is not None and local_library.resolve(track):
+                action = 'local'
+            elif self.artifacts is not None and key and self.artifacts.exists(key):
+                action = 'cached'
+            else:
+                action = 'download'
+            plan.tracks.append(PlannedTrack(
+                index=i,
+                spotify_id=track.get('id'),
+                title=track['title'],
+                artist=track['artists'][0] if track['artists'] else '',
+                duration_ms=track['duration_ms'] or 0,
+                action=action,
+            ))
+
+        estimate_costs(
+            plan,
+            get_profile(self.config.output_profile),
+            workers=self.config.max_workers,
+            throughput=measured_throughput(self.state_path(directory, 'runs')),
+            bandwidth_limit=self.governor.current_limit()
+        )
+        emit({'type': 'plan', 'plan': plan.to_dict()})
+        emit({'type': 'status', 'message': plan.summary()})
+        return plan
+
+    def execute_plan(self, plan: SyncPlan,
+                     on_event: Optional[EventCallback] = None,
+                     is_cancelled: Optional[Callable[[], bool]] = None) -> SyncReport:
+        """Sync exactly the tracks of a saved plan into its playlist folder."""
+        emit = on_event or (lambda event: None)
+        is_cancelled = is_cancelled or (lambda: False)
+        report = SyncReport(url=plan.url, playlist_name=plan.playlist_name, playlist_dir=plan.playlist_dir)
+        try:
+            if not self.spotify.is_configured():
+                raise ValueError("Spotify credentials not configured")
+            summary = self.spotify.get_playlist_summary(plan.playlist_id) if plan.playlist_id else None
+            if summary and summary.get('snapshot_id') != plan.snapshot_id:
+                emit({'type': 'status', 'message': "Playlist changed since it was planned, syncing the planned tracks"})
+            os.makedirs(plan.playlist_dir, exist_ok=True)
+            tracks = self.spotify.get_tracks([t.spotify_id for t in plan.tracks if t.spotify_id])
+            self.spotify.enrich_tracks(tracks, self.catalog_cache_for(plan.directory))
+            metrics = RunMetrics(len(tracks))
+            metrics.add_tracks(tracks)
+            self._run(emit, is_cancelled, report, plan.directory, plan.playlist_dir, iter(tracks), metrics)
+        except Exception as e:
+            logging.error(f"Plan execution error: {str(e)}")
+            report.error = str(e)
+            emit({'type': 'status', 'message': f"Error: {report.error}"})
+        return report
+
+    def retry_failures(self, directory: str,
+                       on_event: Optional[EventCallback] = None,
+                       is_cancelled: Optional[Callable[[], bool]] = None) -> List[SyncReport]:
+        """Re-run only the tracks in a directory's failure report.
+
+        Tracks are fetched again by Spotify ID and processed into the playlist
+        folder they originally failed in; successes leave the report.
+        """
+        emit = on_event or (lambda event: None)
+        is_cancelled = is_cancelled or (lambda: False)
+        failures = self.failures_for(directory)
+        reports = []
+        if not self.spotify.is_configured():
+            report = SyncReport(url=directory, error="Spotify credentials not configured")
+            emit({'type': 'status', 'message': f"Error: {report.error}"})
+            return [report]
+
+        for playlist_dir, entries in failures.by_playlist().items():
+            if is_cancelled():
+                break
+            report = SyncReport(url=directory, playlist_dir=playlist_dir)
+            reports.append(report)
+            ids = [entry['spotify_id'] for entry in entries if entry.get('spotify_id')]
+            if not playlist_dir or not ids:
+                report.error = "No Spotify track IDs to retry"
+                continue
+            report.playlist_name = os.path.basename(playlist_dir)
+            emit({'type': 'status', 'message': f"Retrying {len(ids)} failed tracks in {report.playlist_name}"})
+            try:
+                os.makedirs(playlist_dir, exist_ok=True)
+                tracks = self.spotify.get_tracks(ids)
+                self.spotify.enrich_tracks(tracks, self.catalog_cache_for(directory))
+                metrics = RunMetrics(len(tracks))
+                metrics.add_tracks(tracks)
+                self._run(emit, is_cancelled, report, directory, playlist_dir, iter(tracks), metrics)
+            except Exception as e:
+                logging.error(f"Retry process error: {str(e)}")
+                report.error = str(e)
+        return reports
+
+    def _run(self, emit: EventCallback, is_cancelled: Callable[[], bool], report: SyncReport,
+             directory: str, playlist_dir: str, tracks: Iterator[TrackRecord], metrics: RunMetrics) -> None:
+        """Process a stream of tracks into playlist_dir, filling in report."""
+        stamp = time.strftime('%Y%m%d-%H%M%S')
+        profiler = StageProfiler(self.config.profile_cpu, self.config.profile_memory)
+        profiler.start()
+        library = self.library_for(directory)
+        local_library = self.local_library_for(directory)
+        if local_library is not None:
+            counts = local_library.scan()
+            emit({'type': 'status', 'message': f"Indexed {counts['files']} local files ({counts['read']} new or changed)"})
+        youtube = YouTubeHandler(
+            playlist_dir,
+            loudness_analysis=self.config.loudness_analysis,
+            output_profile=self.config.output_profile,
+            partial_dir=self.scratch_path(directory, 'partial'),
+            resume_store=self.resume_store_for(directory),
+            governor=self.governor,
+            max_segments=self.config.download_segments,
+            watchdog=self.watchdog,
+            scratch_dir=self.scratch_path(directory, 'encode'),
+            profiler=profiler
+        )
+        youtube.prune_partials()
+        run = _Run(
+            emit=emit,
+            report=report,
+            youtube=youtube,
+            library=library,
+            local_library=local_library,
+            failures=self.failures_for(directory),
+            metrics=metrics,
+            concurrency=AIMDController(
+                self.config.min_workers,
+                self.config.max_workers,
+                interval=self.config.concurrency_interval
+            ),
+            profiler=profiler,
+        )
+        metrics.record_concurrency({'to': run.concurrency.limit, 'reason': 'start'})
+        try:
+            self._schedule(run, tracks, is_cancelled)
+        finally:
+            library.save()
+            run.failures.save()
+            self.write_album_gain(emit, run.album_loudness)
+            report.metrics = metrics.snapshot()
+            metrics.save(self.state_path(directory, 'runs', f"{stamp}.json"))
+            profile_dir = profiler.save(self.state_path(directory, 'runs', f"{stamp}-profile"))
+            if profile_dir:
+                emit({'type': 'status', 'message': f"Profile written to {profile_dir}"})
+
+        emit({'type': 'status', 'message': f"\nDownloaded {metrics.summary()}"})
+        if run.failures and report.failed:
+            emit({'type': 'status', 'message': f"{len(report.failed)} tracks failed, see {run.failures.store.path}"})
+
+    def _schedule(self, run: '_Run', tracks: Iterator[TrackRecord], is_cancelled: Callable[[], bool]) -> None:
+        """Feed tracks and deferred retries to the worker pool until all are settled.
+
+        A failed attempt never blocks its worker: retryable tracks go into a
+        delay queue and their slot is handed to the next track straight away.
+        The number of busy workers follows the run's AIMD controller, and
+        attempts stuck past a watchdog deadline are abandoned. A track that
+        appears again while the first copy is running waits for it, and is
+        then usually reused from the library.
+        """
+        retries = RetryQueue()
+        pending: Dict[Future, tuple] = {}
+        waiting: List[tuple] = []
+        exhausted = False
+        while True:
+            if is_cancelled():
+                run.report.cancelled = True
+                run.emit({'type': 'status', 'message': "Download cancelled by user."})
+                break
+
+            # Fill free slots, deferred retries first
+            while len(pending) < run.concurrency.limit:
+                item = next((w for w in waiting if run.in_flight.isdisjoint(_track_keys(w[1]))), None)
+                if item is not None:
+                    waiting.remove(item)
+                else:
+                    item = retries.pop_ready()
+                if item is None and not exhausted:
+                    # Fetching the next page of tracks from Spotify happens here
+                    try:
+                        with run.profiler.stage('spotify'):
+                            track = next(tracks, None)
+                    except Exception as e:
+                        logging.error(f"Failed to fetch tracks: {str(e)}")
+                        run.report.error = f"Failed to fetch tracks: {str(e)}"
+                        run.emit({'type': 'status', 'message': f"Error: {run.report.error}"})
+                        exhausted = True
+                        break
+                    if track is None:
+                        exhausted = True
+                    else:
+                        result = TrackResult(
+                            index=len(run.report.tracks) + 1,
+                            title=track['title'],
+                            artist=track['artists'][0] if track['artists'] else '',
+                            spotify_id=track.get('id'),
+                            isrc=track.get('isrc'),
+                        )
+                        run.report.tracks.append(result)
+                        item = (result.index, track, result)
+                if item is None:
+                    break
+                keys = _track_keys(item[1])
+                if not run.in_flight.isdisjoint(keys):
+                    # Both attempts would use the same partial, scratch and output files
+                    waiting.append(item)
+                    continue
+                run.in_flight.update(keys)
+                # Each attempt works on its own copy so an abandoned one can't touch the report
+                attempt = replace(item[2], error=None, error_kind=None)
+                # A daemon thread per attempt, so an abandoned one can't hold up exit
+                abandoned = threading.Event()
+                future = _run_in_daemon_thread(self._attempt, run, item[0], item[1], attempt, abandoned)
+                pending[future] = (item, attempt, abandoned)
+
+            # Stop like a cancel, in-flight tracks are still collected below
+            if run.report.error:
+                break
+
+            if not pending:
+                if exhausted and not retries and not waiting:
+                    break
+                # Only deferred retries are left, wait for the next one
+                time.sleep(min(retries.next_ready_in() or 0.0, 1.0))
+                continue
+
+            # Wake up early if a retry becomes due while a slot is free
+            timeout = retries.next_ready_in() if retries and len(pending) < run.concurrency.limit else None
+            self._collect(run, pending, retries, timeout)
+
+        # Let in-flight tracks finish and record whatever is still waiting
+        while pending:
+            self._collect(run, pending, None, None)
+        for i, track, result in retries.drain():
+            result.error = result.error or "Cancelled before retry"
+            run.failures.record(result, run.report.playlist_dir)
+            self._track_event(run.emit, i, track, 'failed')
+        # Repeats of tracks that were running; the first copy's outcome is recorded
+        for i, track, result in waiting:
+            result.error = "Cancelled before download"
+            self._track_event(run.emit, i, track, 'failed')
+
+    def _attempt(self, run: '_Run', i: int, track: TrackRecord, attempt: TrackResult,
+                 abandoned: threading.Event) -> str:
+        """Run one attempt of a track with its stages watched by the watchdog."""
+        try:
+            with self.watchdog.task(attempt):
+                return self._process_track(run, i, track, attempt, abandoned)
+        finally:
+            # Only now is nothing writing the partial file any more
+            if abandoned.is_set():
+                run.youtube.discard_partial(track)
+
+    def _collect(self, run: '_Run', pending: Dict[Future, tuple],
+                 retries: Optional[RetryQueue], timeout: Optional[float]) -> None:
+        """Wait for attempts to finish, settle them and abandon any that hang."""
+        timeout = ABANDON_CHECK_INTERVAL if timeout is None else min(timeout, ABANDON_CHECK_INTERVAL)
+        done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+        for future in done:
+            item, attempt, _ = pending.pop(future)
+            run.in_flight.difference_update(_track_keys(item[1]))
+            self._settle(run, retries, future.result(), attempt, *item)
+
+        for future, (item, attempt, abandoned) in list(pending.items()):
+            with run.lock:
+                stage = self.watchdog.overdue(attempt)
+                if stage is None:
+                    continue
+                # The thread can't be stopped; forget it, free its slot and keep
+                # it from publishing anything should it ever return
+                abandoned.set()
+            del pending[future]
+            run.in_flight.difference_update(_track_keys(item[1]))
+            self.watchdog.release(attempt)
+            i, track, result = item
+            attempt.error = f"Abandoned after the {stage} stage hung"
+            attempt.error_kind = TIMEOUT
+            run.emit({'type': 'status', 'message': f"{attempt.error}: {track['title']}"})
+            self._settle(run, retries, 'failed', attempt, *item)
+
+    def _settle(self, run: '_Run', retries: Optional[RetryQueue], state: str, attempt: TrackResult,
+                i: int, track: TrackRecord, result: TrackResult) -> None:
+        """Apply the outcome of one attempt: finish the track, requeue it or report it."""
+        result.status = attempt.status
+        result.file_path = attempt.file_path
+        result.error = attempt.error
+        result.error_kind = attempt.error_kind
+        result.attempts += 1
+        decision = run.concurrency.record(result.error_kind)
+        if decision:
+            run.metrics.record_concurrency(decision)
+            run.emit({'type': 'status', 'message': f"Concurrency {decision['from']} -> {decision['to']} ({decision['reason']})"})
+        if result.error_kind is None:
+            run.metrics.finish_track(i, True)
+            run.failures.resolve(result.spotify_id)
+        elif retries is not None and is_retryable(result.error_kind) and result.attempts < self.config.max_attempts:
+            delay = backoff_delay(result.error_kind, result.attempts, self.config.retry_base_delay)
+            run.metrics.requeue_track(i)
+            retries.push((i, track, result), delay)
+            state = 'retrying'
+            run.emit({'type': 'status', 'message': f"Retrying in {delay:.0f}s ({result.error_kind}): {track['title']}"})
+        else:
+            run.metrics.finish_track(i, False)
+            run.failures.record(result, run.report.playlist_dir)
+
+        # Update progress
+        self._track_event(run.emit, i, track, state)
+        run.emit({'type': 'progress', 'value': run.metrics.overall_progress()})
+        run.emit(run.metrics.snapshot())
+
+    def _process_track(self, run: '_Run', i: int, track: TrackRecord, result: TrackResult,
+                       abandoned: Optional[threading.Event] = None) -> str:
+        """Download, verify and tag a single track, recording the outcome in result.
+
+        Returns the track's new state. On failure result.error_kind is set so
+        the scheduler can decide whether to try again. Once the scheduler has
+        set abandoned, nothing is published or indexed any more.
+        """
+        emit = run.emit
+        youtube = run.youtube
+        run.metrics.start_track(i, track['duration_ms'])
+        self._track_event(emit, i, track, 'processing')
+
+        def failed(message: str, kind: str) -> str:
+            result.error = message
+            result.error_kind = kind
+            emit({'type': 'status', 'message': f"{message}: {track['title']}"})
+            return 'failed'
+
+        def was_abandoned() -> bool:
+            # Checked after the last watched stage: under the lock the
+            # scheduler either abandoned us already or never will
+            with run.lock:
+                if abandoned is None or not abandoned.is_set():
+                    return False
+            logging.info(f"Dropping the result of an abandoned attempt: {track['title']}")
+            return True
+
+        try:
+            emit({'type': 'status', 'message': f"\nProcessing track {i}/{run.metrics.total_tracks}: {track['title']}"})
+
+            # Keep this playlist's file from an older version under its new name
+            destination = youtube.output_file(track)
+            if self.use_legacy_file(emit, run.library, youtube, track, destination):
+                self.add_album_loudness(run, track, destination)
+                result.status = 'reused'
+                result.file_path = destination
+                return 'reused'
+
+            # Reuse the recording if it is already in the library
+            reused_path = self.use_library_copy(emit, run.library, track, destination)
+            if reused_path:
+                self.add_album_loudness(run, track, reused_path)
+                result.status = 'reused'
+                result.file_path = reused_path
+                return 'reused'
+
+            # Use a copy from the local music archive if there is one
+            local_path = self.use_local_file(emit, run.local_library, youtube, track, destination)
+            if local_path:
+                run.library.add(track.get('isrc'), local_path)
+                result.status = 'local'
+                result.file_path = local_path
+                return 'local'
+
+            # Use a finished file another instance already published; it was
+            # tagged for another playlist, so tag it for this one in scratch
+            key = artifact_key(track, self.config.output_profile)
+            cached_path = os.path.join(youtube.scratch_dir, f"{key}.mp3") if key else None
+            if self.artifacts is not None and key and self.artifacts.fetch(key, cached_path):
+                try:
+                    if youtube.verify_download(cached_path, track):
+                        with self.watchdog.stage('tag'), run.profiler.stage('tag'):
+                            if not self.metadata.embed_metadata(cached_path, track):
+                                return failed("Failed to embed metadata", TAG)
+                            if not self.metadata.verify_metadata(cached_path):
+                                return failed("Metadata verification failed", TAG)
+                        if was_abandoned():
+                            return 'failed'
+                        publish_file(cached_path, destination)
+                        run.library.add(track.get('isrc'), destination)
+                        self.add_album_loudness(run, track, destination)
+                        emit({'type': 'status', 'message': f"Found in artifact cache: {track['title']}"})
+                        result.status = 'cached'
+                        result.file_path = destination
+                        return 'cached'
+                    logging.warning(f"Cached artifact {key} failed verification, downloading instead")
+                finally:
+                    if os.path.exists(cached_path):
+                        os.remove(cached_path)
+
+            # Download track into the scratch area
+            try:
+                scratch_path = youtube.download_track(track, self._progress_callback(emit, run.metrics, i))
+            except DownloadError as e:
+                logging.error(f"Failed to download {track['title']}: {str(e)}")
+                return failed(f"Failed to {e.stage}: {str(e)}", classify_error(str(e), e.stage))
+            if track.get('source_format'):
+                run.metrics.add_saved_bytes(track['source_format']['saved_bytes'])
+
+            try:
+                # Verify download
+                if not youtube.verify_download(scratch_path, track):
+                    return failed("Download verification failed", VERIFY)
+
+                # Fetch the cover art first so a stuck image host has its own deadline
+                if track.get('album_art'):
+                    with self.watchdog.stage('art'), run.profiler.stage('art'):
+                        self.metadata.get_cover_art(track['album_art'])
+
+                with self.watchdog.stage('tag'), run.profiler.stage('tag'):
+                    # Embed metadata
+                    if not self.metadata.embed_metadata(scratch_path, track):
+                        return failed("Failed to embed metadata", TAG)
+
+                    # Verify metadata
+                    if not self.metadata.verify_metadata(scratch_path):
+                        return failed("Metadata verification failed", TAG)
+
+                if was_abandoned():
+                    return 'failed'
+                # The finished file reaches the library in one write and a rename
+                publish_file(scratch_path, destination)
+            finally:
+                if os.path.exists(scratch_path):
+                    os.remove(scratch_path)
+            file_path = destination
+
+            run.library.add(track.get('isrc'), file_path)
+            if self.artifacts is not None and key:
+                self.artifacts.publish(key, file_path)
+            self.add_album_loudness(run, track, file_path, track.get('loudness'))
+            emit({'type': 'status', 'message': f"Successfully processed: {track['title']}"})
+            result.status = 'downloaded'
+            result.file_path = file_path
+            return 'done'
+
+        except StageTimeout as e:
+            logging.error(f"Timed out processing track {track['title']}: {str(e)}")
+            run.youtube.discard_partial(track)
+            return failed(f"Timed out ({str(e)})", TIMEOUT)
+
+        except Exception as e:
+            logging.error(f"Error processing track {track['title']}: {str(e)}")
+            return failed("Error processing track", classify_error(str(e)))
+
+    def _iter_library_files(self, directory: str) -> Iterator[str]:
+        """Yield every MP3 in a library once, skipping hard-linked duplicates."""
+        seen = set()
+        for dirpath, dirnames, filenames in os.walk(directory):
+            dirnames[:] = [d for d in dirnames if d != STATE_DIR]
+            for filename in sorted(filenames):
+                if not filename.lower().endswith('.mp3'):
+                    continue
+                path = os.path.join(dirpath, filename)
+                stat = os.stat(path)
+                if (stat.st_dev, stat.st_ino) in seen:
+                    continue
+                seen.add((stat.st_dev, stat.st_ino))
+                yield path
+
+    def retag(self, directory: str,
+              on_event: Optional[EventCallback] = None,
+              is_cancelled: Optional[Callable[[], bool]] = None,
+              batch_size: int = 50) -> SyncReport:
+        """Refresh the tags of an existing library in place without downloading audio.
+
+        Files are matched by their Spotify track ID tag (or ISRC for older
+        files), current metadata is fetched in batches and the tags are only
+        rewritten when something changed. Hard links into the local archive
+        share its tags and are left alone.
+        """
+        emit = on_event or (lambda event: None)
+        is_cancelled = is_cancelled or (lambda: False)
+        report = SyncReport(url=directory, playlist_dir=directory)
+        if not self.spotify.is_configured():
+            report.error = "Spotify credentials not configured"
+            emit({'type': 'status', 'message': f"Error: {report.error}"})
+            return report
+
+        catalog_cache = self.catalog_cache_for(directory)
+        local_library = self.local_library_for(directory)
+        archive_ids = None
+        shared = 0
+        batch = []
+
+        def flush() -> None:
+            ids = list(dict.fromkeys(spotify_id for _, spotify_id, _ in batch if spotify_id))
+            records = {record['id']: record for record in self.spotify.get_tracks(ids)}
+            matched = []
+            for path, spotify_id, isrc in batch:
+                record = records.get(spotify_id) if spotify_id else None
+                if record is None and isrc:
+                    record = self.spotify.find_track_by_isrc(isrc)
+                result = TrackResult(
+                    index=len(report.tracks) + 1,
+                    title=os.path.basename(path),
+                    artist='',
+                    spotify_id=spotify_id,
+                    isrc=isrc,
+                    file_path=path,
+                )
+                report.tracks.append(result)
+                if record is None:
+                    result.error = "No Spotify match"
+                    continue
+                matched.append((path, record, result))
+            self.spotify.enrich_tracks([record for _, record, _ in matched], catalog_cache)
+            for path, record, result in matched:
+                result.title = record['title']
+                result.artist = record['artists'][0] if record['artists'] else ''
+                written = self.metadata.embed_metadata(path, record)
+                if written:
+                    result.status = 'retagged' if written == 'written' else 'unchanged'
+                else:
+                    result.error = "Failed to embed metadata"
+            retagged = sum(1 for t in report.tracks if t.status == 'retagged')
+            unchanged = sum(1 for t in report.tracks if t.status == 'unchanged')
+            emit({'type': 'status', 'message': f"Retagged {retagged} of {len(report.tracks)} files, {unchanged} unchanged"})
+            batch.clear()
+
+        for path in self._iter_library_files(directory):
+            if is_cancelled():
+                report.cancelled = True
+                break
+            stat = os.stat(path)
+            if local_library is not None and stat.st_nlink > 1:
+                if archive_ids is None:
+                    archive_ids = local_library.file_ids()
+                if (stat.st_dev, stat.st_ino) in archive_ids:
+                    shared += 1
+                    continue
+            spotify_id, isrc = self.metadata.read_track_ids(path)
+            batch.append((path, spotify_id, isrc))
+            if len(batch) >= batch_size:
+                flush()
+        if batch and not report.cancelled:
+            flush()
+        if shared:
+            emit({'type': 'status', 'message': f"Left {shared} files linked to the local library untouched"})
+        catalog_cache.save()
+        return report
+
+    def sync_many(self, urls: List[str], directory: str,
+                  on_event: Optional[EventCallback] = None,
+                  is_cancelled: Optional[Callable[[], bool]] = None) -> List[SyncReport]:
+        """Sync several playlists in turn, sharing clients and caches."""
+        reports = []
+        for url in urls:
+            if is_cancelled and is_cancelled():
+                break
+            reports.append(self.sync(url, directory, on_event, is_cancelled))
+        return reports
+
+    def iter_sync(self, url: str, directory: str,
+                  is_cancelled: Optional[Callable[[], bool]] = None) -> Iterator[Dict]:
+        """Run a sync in the background and yield its events as they happen.
+
+        The last event has type 'report' and carries the SyncReport.
+        """
+        events = queue.Queue()
+        worker = threading.Thread(
+            target=lambda: events.put({'type': 'report', 'report': self.sync(url, directory, events.put, is_cancelled)}),
+            daemon=True
+        )
+        worker.start()
+        while True:
+            event = events.get()
+            yield event
+            if event['type'] == 'report':
+                break
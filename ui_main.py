@@ -1,41 +1,144 @@
 from PyQt5.QtWidgets import (
-    QWidget, QVBoxLayout, QHBoxLayout, QLabel, QLineEdit, QPushButton, QFileDialog, QProgressBar, QTextEdit, QDialog
+    QWidget, QVBoxLayout, QHBoxLayout, QLabel, QLineEdit, QPushButton, QFileDialog, QProgressBar, QTextEdit, QDialog,
+    QTableView, QHeaderView, QAbstractItemView, QApplication, QSpinBox
 )
 from PyQt5.QtGui import QFont, QIcon, QPixmap, QPalette, QColor
-from PyQt5.QtCore import Qt, QPropertyAnimation, pyqtSlot, QThread, pyqtSignal
+from PyQt5.QtCore import (
+    Qt, QPropertyAnimation, pyqtSlot, pyqtSignal, QObject, QRunnable, QThreadPool, QTimer,
+    QAbstractTableModel, QModelIndex
+)
 from PyQt5.QtWidgets import QGraphicsDropShadowEffect
-import time
+import sys
 import threading
 import json
 import os
+from main import SpotifyDownloader
+from run_metrics import format_eta
+from bandwidth import get_governor
+
+# Backend messages are applied to the widgets at most this often (ms)
+UPDATE_INTERVAL_MS = 100
+
+
+class BridgeQueue:
+    """Collects sync engine events so the UI can apply them in batches."""
+
+    def __init__(self):
+        self._pending = []
+        self._lock = threading.Lock()
+
+    def put(self, message):
+        with self._lock:
+            self._pending.append(message)
 
-# Dummy backend for test mode
-class DummyDownloader(QThread):
-    progress = pyqtSignal(int)
-    status = pyqtSignal(str)
-    done = pyqtSignal()
+    def drain(self):
+        with self._lock:
+            messages, self._pending = self._pending, []
+        return messages
 
-    def __init__(self, url, directory):
+
+class WorkerSignals(QObject):
+    finished = pyqtSignal()
+
+
+class SyncWorker(QRunnable):
+    """Runs the real sync engine on the Qt thread pool."""
+
+    def __init__(self, backend, url, directory):
         super().__init__()
+        self.backend = backend
         self.url = url
         self.directory = directory
+        self.queue = BridgeQueue()
+        self.signals = WorkerSignals()
         self._cancel = False
 
     def run(self):
-        self.status.emit(f"Starting download for: {self.url}")
-        for i in range(1, 101):
-            if self._cancel:
-                self.status.emit("Download cancelled.")
-                return
-            self.progress.emit(i)
-            self.status.emit(f"Progress: {i}%")
-            time.sleep(0.03)
-        self.status.emit("Download complete!")
-        self.done.emit()
+        try:
+            self.backend.engine.sync(self.url, self.directory, self.queue.put, self.is_cancelled)
+        finally:
+            self.signals.finished.emit()
+
+    def is_cancelled(self):
+        return self._cancel
 
     def cancel(self):
         self._cancel = True
 
+
+class TrackTableModel(QAbstractTableModel):
+    """Per-track state for the track table, updated in batches."""
+
+    COLUMNS = ['#', 'Title', 'Artist', 'Status', 'Progress']
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self._rows = []
+        self._row_of = {}
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self._rows)
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.COLUMNS)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        row = self._rows[index.row()]
+        if role == Qt.DisplayRole:
+            if index.column() == 4:
+                return f"{int(row[4] * 100)}%"
+            return row[index.column()]
+        if role == Qt.TextAlignmentRole and index.column() in (0, 4):
+            return Qt.AlignRight | Qt.AlignVCenter
+        return None
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if role == Qt.DisplayRole and orientation == Qt.Horizontal:
+            return self.COLUMNS[section]
+        return None
+
+    def clear(self):
+        self.beginResetModel()
+        self._rows = []
+        self._row_of = {}
+        self.endResetModel()
+
+    def apply_updates(self, updates):
+        """Apply a batch of track events with one insert and one change notification."""
+        new_indices = []
+        for update in updates:
+            if update['index'] not in self._row_of and update['index'] not in new_indices:
+                new_indices.append(update['index'])
+        if new_indices:
+            first = len(self._rows)
+            self.beginInsertRows(QModelIndex(), first, first + len(new_indices) - 1)
+            for offset, track_index in enumerate(new_indices):
+                self._row_of[track_index] = first + offset
+                self._rows.append([track_index, '', '', 'queued', 0.0])
+            self.endInsertRows()
+
+        changed = set()
+        for update in updates:
+            row_number = self._row_of[update['index']]
+            row = self._rows[row_number]
+            if 'title' in update:
+                row[1] = update['title']
+                row[2] = update.get('artist', '')
+            if 'state' in update:
+                row[3] = update['state']
+                if update['state'] in ('done', 'reused', 'local', 'cached'):
+                    row[4] = 1.0
+            if 'progress' in update:
+                row[4] = update['progress']
+            changed.add(row_number)
+        if changed:
+            self.dataChanged.emit(
+                self.index(min(changed), 0),
+                self.index(max(changed), len(self.COLUMNS) - 1)
+            )
+
 class SettingsDialog(QDialog):
     def __init__(self, parent=None):
         super().__init__(parent)
@@ -69,20 +172,28 @@ class SettingsDialog(QDialog):
                 pass
 
     def save(self):
-        config = {
+        config_path = os.path.join(os.path.dirname(__file__), 'config.json')
+        config = {}
+        if os.path.exists(config_path):
+            try:
+                with open(config_path, 'r') as f:
+                    config = json.load(f)
+            except Exception:
+                pass
+        config.update({
             'client_id': self.client_id_input.text().strip(),
             'client_secret': self.client_secret_input.text().strip()
-        }
-        config_path = os.path.join(os.path.dirname(__file__), 'config.json')
+        })
         with open(config_path, 'w') as f:
-            json.dump(config, f)
+            json.dump(config, f, indent=2)
         self.accept()
 
 class MainWindow(QWidget):
     def __init__(self):
         super().__init__()
         self.setWindowTitle("ipodfiller")
-        self.setFixedSize(600, 560)
+        self.resize(760, 820)
+        self.setMinimumSize(600, 640)
         self.setStyleSheet("""
             QWidget {
                 background: qlineargradient(x1:0, y1:0, x2:0, y2:1,
@@ -90,6 +201,10 @@ class MainWindow(QWidget):
             }
         """)
         self.downloader = None
+        self.backend = None
+        self.update_timer = QTimer(self)
+        self.update_timer.setInterval(UPDATE_INTERVAL_MS)
+        self.update_timer.timeout.connect(self.flush_updates)
         self.init_ui()
         self.fade_in_card()
 
@@ -127,7 +242,7 @@ class MainWindow(QWidget):
         card_layout.addWidget(subtitle)
 
         # Playlist URL
-        url_label = QLabel("Spotify Playlist URL")
+        url_label = QLabel("Spotify Playlist, Album or Artist URL")
         url_label.setFont(QFont("Segoe UI", 10))
         self.url_input = QLineEdit()
         self.url_input.setPlaceholderText("https://open.spotify.com/playlist/...")
@@ -153,6 +268,19 @@ class MainWindow(QWidget):
         card_layout.addWidget(dir_label)
         card_layout.addLayout(dir_layout)
 
+        # Bandwidth limit, applied live to downloads that are already running
+        limit_layout = QHBoxLayout()
+        limit_label = QLabel("Bandwidth limit (KB/s, 0 = unlimited)")
+        limit_label.setFont(QFont("Segoe UI", 10))
+        self.limit_input = QSpinBox()
+        self.limit_input.setRange(0, 1_000_000)
+        self.limit_input.setSingleStep(100)
+        self.limit_input.setValue(self.load_bandwidth_limit() // 1000)
+        self.limit_input.valueChanged.connect(self.apply_bandwidth_limit)
+        limit_layout.addWidget(limit_label)
+        limit_layout.addWidget(self.limit_input)
+        card_layout.addLayout(limit_layout)
+
         # Start Button
         self.start_btn = QPushButton("Start Download")
         self.start_btn.setFont(QFont("Segoe UI", 12, QFont.Bold))
@@ -189,6 +317,23 @@ class MainWindow(QWidget):
         """)
         card_layout.addWidget(self.progress)
 
+        self.stats_label = QLabel("")
+        self.stats_label.setFont(QFont("Segoe UI", 10))
+        card_layout.addWidget(self.stats_label)
+
+        # Track table (only visible rows are painted, so large playlists stay cheap)
+        self.track_model = TrackTableModel(self)
+        self.track_table = QTableView()
+        self.track_table.setModel(self.track_model)
+        self.track_table.setEditTriggers(QAbstractItemView.NoEditTriggers)
+        self.track_table.setSelectionBehavior(QAbstractItemView.SelectRows)
+        self.track_table.verticalHeader().setVisible(False)
+        self.track_table.verticalHeader().setSectionResizeMode(QHeaderView.Fixed)
+        self.track_table.verticalHeader().setDefaultSectionSize(22)
+        self.track_table.horizontalHeader().setSectionResizeMode(1, QHeaderView.Stretch)
+        self.track_table.setStyleSheet("border-radius: 12px; background: #f8fbfd; border: 1px solid #e0e0e0;")
+        card_layout.addWidget(self.track_table)
+
         # Status Log
         self.status_log = QTextEdit()
         self.status_log.setReadOnly(True)
@@ -226,36 +371,107 @@ class MainWindow(QWidget):
         if dir_path:
             self.dir_input.setText(dir_path)
 
+    def load_bandwidth_limit(self):
+        """Read the configured bandwidth limit in bytes per second."""
+        config_path = os.path.join(os.path.dirname(__file__), 'config.json')
+        try:
+            with open(config_path, 'r') as f:
+                return int(json.load(f).get('bandwidth_limit') or 0)
+        except Exception:
+            return 0
+
+    def apply_bandwidth_limit(self, *_):
+        """Push the limit from the spin box to the shared bandwidth governor."""
+        get_governor().set_limit(self.limit_input.value() * 1000)
+
+    def get_backend(self):
+        """Create the real download backend on first use."""
+        if self.backend is None:
+            self.backend = SpotifyDownloader(headless=True)
+        return self.backend
+
     def start_download(self):
         url = self.url_input.text().strip()
         directory = self.dir_input.text().strip()
         if not url or not directory:
             self.status_log.append("Please enter both a playlist URL and a download directory.")
             return
+        backend = self.get_backend()
+        if not backend.spotify.is_configured():
+            self.status_log.append("Please enter your Spotify API credentials in Settings first.")
+            return
+        self.apply_bandwidth_limit()
         self.status_log.clear()
         self.progress.setValue(0)
+        self.stats_label.setText("")
+        self.track_model.clear()
         self.start_btn.setEnabled(False)
         self.cancel_btn.setVisible(True)
-        # Use DummyDownloader for test mode; replace with real backend for production
-        self.downloader = DummyDownloader(url, directory)
-        self.downloader.progress.connect(self.progress.setValue)
-        self.downloader.status.connect(self.status_log.append)
-        self.downloader.done.connect(self.download_done)
-        self.downloader.start()
+        self.cancel_btn.setEnabled(True)
+        self.downloader = SyncWorker(backend, url, directory)
+        self.downloader.signals.finished.connect(self.download_done)
+        self.update_timer.start()
+        QThreadPool.globalInstance().start(self.downloader)
+
+    @pyqtSlot()
+    def flush_updates(self):
+        """Apply everything the backend reported since the last tick in one go."""
+        if not self.downloader:
+            return
+        lines = []
+        track_updates = []
+        progress = None
+        stats = None
+        for event in self.downloader.queue.drain():
+            if event['type'] == 'status':
+                lines.append(event['message'].strip())
+            elif event['type'] == 'progress':
+                progress = event['value']
+            elif event['type'] == 'stats':
+                stats = event
+            elif event['type'] == 'track':
+                track_updates.append(event)
+        if lines:
+            self.status_log.append("\n".join(lines))
+        if progress is not None:
+            self.progress.setValue(int(progress * 100))
+        if stats is not None:
+            self.stats_label.setText(
+                f"{stats['completed_tracks']}/{stats['total_tracks']} tracks  |  "
+                f"{stats['rate_mb_s']:.2f} MB/s  |  ETA {format_eta(stats['eta_seconds'])}"
+            )
+        if track_updates:
+            self.track_model.apply_updates(track_updates)
 
     def cancel_download(self):
         if self.downloader:
             self.downloader.cancel()
-        self.start_btn.setEnabled(True)
-        self.cancel_btn.setVisible(False)
-        self.status_log.append("Download cancelled by user.")
+        self.cancel_btn.setEnabled(False)
+        self.status_log.append("Cancelling download...")
 
     @pyqtSlot()
     def download_done(self):
+        self.update_timer.stop()
+        self.flush_updates()
         self.start_btn.setEnabled(True)
         self.cancel_btn.setVisible(False)
         self.status_log.append("Ready for another download!")
 
     def open_settings(self):
         dlg = SettingsDialog(self)
-        dlg.exec_() 
\ No newline at end of file
+        if dlg.exec_() == QDialog.Accepted and self.backend is not None:
+            self.backend.spotify.configure(
+                dlg.client_id_input.text().strip(),
+                dlg.client_secret_input.text().strip()
+            )
+
+
+def main():
+    app = QApplication(sys.argv)
+    window = MainWindow()
+    window.show()
+    sys.exit(app.exec_())
+
+
+if __name__ == "__main__":
+    main() 
\ No newline at end of file
@@ -0,0 +1,101 @@
+import time
+import random
+import logging
+import threading
+from typing import Callable, Dict, List, Optional
+from bandwidth import TokenBucket
+from json_store import JsonStore
+
+# Seconds between two checks of the same playlist
+DEFAULT_INTERVAL = 3600.0
+
+# Share of each playlist's time slot its check may be moved by at random
+DEFAULT_JITTER = 0.5
+
+# Playlist metadata requests per second across all checks
+DEFAULT_API_RATE = 1.0
+
+
+class PlaylistWatcher:
+    def __init__(self, engine, urls: List[str], directory: str,
+                 interval: float = DEFAULT_INTERVAL, jitter: float = DEFAULT_JITTER,
+                 api_rate: float = DEFAULT_API_RATE):
+        """Initialize a watcher that keeps playlists in directory up to date.
+
+        Each cycle checks every playlist once with the small playlist
+        metadata request and compares its snapshot_id with the one of the
+        last successful sync; only playlists that changed are synced again.
+        Checks are spread evenly over the interval, moved by a random jitter
+        so many watchers don't hit the API at the same moment, and all draw
+        from one request budget.
+        """
+        self.engine = engine
+        self.urls = []
+        for url in dict.fromkeys(urls):
+            source = engine.spotify.extract_source(url)
+            if source and source[0] == 'playlist':
+                self.urls.append(url)
+            else:
+                # Albums and artists have no snapshot to compare
+                logging.warning(f"Only playlists can be watched, skipping {url}")
+        self.directory = directory
+        self.interval = interval
+        self.jitter = max(0.0, min(jitter, 1.0))
+        self.budget = TokenBucket(api_rate, capacity=1)
+        self.state = JsonStore(engine.state_path(directory, 'watch.json'), autosave_every=1)
+
+    def check(self, url: str, on_event: Optional[Callable[[Dict], None]] = None,
+              is_cancelled: Optional[Callable[[], bool]] = None) -> Optional[bool]:
+        """Sync one playlist if it changed since its last sync.
+
+        Returns True if it was synced, False if it was unchanged and None if
+        it couldn't be checked.
+        """
+        emit = on_event or (lambda event: None)
+        source = self.engine.spotify.extract_source(url)
+        if not source or source[0] != 'playlist':
+            return None
+        self.budget.consume(1)
+        summary = self.engine.spotify.get_playlist_summary(source[1])
+        if not summary:
+            return None
+        entry = self.state.get(url) or {}
+        entry['checked_at'] = time.time()
+        if summary.get('snapshot_id') and summary['snapshot_id'] == entry.get('snapshot_id'):
+            self.state.set(url, entry)
+            return False
+
+        emit({'type': 'status', 'message': f"{summary['name']} changed, syncing"})
+        report = self.engine.sync(url, self.directory, on_event, is_cancelled)
+        # Failed tracks stay in the failure report, the snapshot counts as synced
+        if not report.error and not report.cancelled:
+            entry['snapshot_id'] = summary.get('snapshot_id')
+            entry['synced_at'] = time.time()
+        self.state.set(url, entry)
+        return True
+
+    def run(self, on_event: Optional[Callable[[Dict], None]] = None,
+            stop: Optional[threading.Event] = None, cycles: Optional[int] = None) -> None:
+        """Check the playlists until stop is set, or for a number of cycles."""
+        emit = on_event or (lambda event: None)
+        stop = stop or threading.Event()
+        if not self.urls:
+            return
+        slot = self.interval / len(self.urls)
+        cycle = 0
+        while not stop.is_set() and (cycles is None or cycle < cycles):
+            started = time.monotonic()
+            synced = 0
+            for k, url in enumerate(self.urls):
+                due = started + k * slot + random.uniform(0, slot * self.jitter)
+                if stop.wait(max(0.0, due - time.monotonic())):
+                    return
+                try:
+                    if self.check(url, on_event, stop.is_set):
+                        synced += 1
+                except Exception as e:
+                    logging.error(f"Failed to check {url}: {str(e)}")
+            cycle += 1
+            emit({'type': 'status', 'message': f"Checked {len(self.urls)} playlists, {synced} changed"})
+            if cycles is None or cycle < cycles:
+                stop.wait(max(0.0, started + self.interval - time.monotonic()))
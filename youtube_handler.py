@@ -1,37 +1,113 @@
 import yt_dlp
 import os
-from typing import Optional, Dict
+import shutil
+import subprocess
+import sys
+from typing import Callable, Dict, Iterator, List, Optional
 import logging
 import random
+import re
+import threading
 import time
+from contextlib import contextmanager, nullcontext
+from mp3_verifier import verify_mp3
+from format_policy import DEFAULT_PROFILE, get_profile, make_format_selector
+from json_store import JsonStore
+from bandwidth import BandwidthGovernor, get_governor
+from segmented_download import download_segmented, segment_count
+from stage_watchdog import StageTimeout, Watchdog
+from profiling import StageProfiler
+
+# Progress callback signature: (stage, done, total). For the 'download' stage
+# the values are bytes, for the 'encode' stage milliseconds of encoded audio.
+ProgressCallback = Callable[[str, float, Optional[float]], None]
+
+# Partial downloads that haven't been resumed for this long are thrown away
+PARTIAL_MAX_AGE_DAYS = 7
+
+
+class DownloadError(Exception):
+    """A track could not be fetched; stage is 'search', 'download' or 'encode'."""
+
+    def __init__(self, stage: str, message: str):
+        super().__init__(message)
+        self.stage = stage
+
+
+def find_ffmpeg() -> str:
+    """Locate the FFmpeg binary, preferring one bundled next to the app."""
+    base_dir = getattr(sys, '_MEIPASS', os.path.dirname(os.path.abspath(__file__)))
+    for name in ('ffmpeg.exe', 'ffmpeg'):
+        candidate = os.path.join(base_dir, name)
+        if os.path.isfile(candidate):
+            return candidate
+    return shutil.which('ffmpeg') or 'ffmpeg'
+
+
+def parse_ebur128_summary(output: str) -> Optional[Dict]:
+    """Extract integrated loudness and true peak from FFmpeg's ebur128 summary."""
+    summary = output[output.rfind('Summary:'):] if 'Summary:' in output else ''
+    integrated = re.search(r'I:\s+(-?[\d.]+) LUFS', summary)
+    peak = re.search(r'Peak:\s+(-?[\d.]+|-inf) dBFS', summary)
+    if not integrated:
+        return None
+    return {
+        'integrated_lufs': float(integrated.group(1)),
+        'true_peak_dbfs': float(peak.group(1)) if peak else None,
+    }
 
 class YouTubeHandler:
-    def __init__(self, output_path: str):
-        """Initialize the YouTube handler with output path."""
+    def __init__(self, output_path: str, loudness_analysis: bool = False,
+                 output_profile: str = DEFAULT_PROFILE,
+                 partial_dir: Optional[str] = None,
+                 resume_store: Optional[JsonStore] = None,
+                 governor: Optional[BandwidthGovernor] = None,
+                 max_segments: int = 1,
+                 watchdog: Optional[Watchdog] = None,
+                 scratch_dir: Optional[str] = None,
+                 profiler: Optional[StageProfiler] = None):
+        """Initialize the YouTube handler with output, partial and scratch folders.
+
+        The output profile sets the MP3 quality and the smallest source
+        stream worth downloading; every transfer draws from the governor (the
+        process-wide one by default).
+        """
         self.output_path = output_path
+        self.loudness_analysis = loudness_analysis
+        self.profile = get_profile(output_profile)
+        self.partial_dir = partial_dir or output_path
+        self.resume_store = resume_store
+        self.governor = governor or get_governor()
+        self.max_segments = max(1, max_segments)
+        self.watchdog = watchdog
+        self.scratch_dir = scratch_dir or os.path.join(self.partial_dir, 'encode')
+        self.profiler = profiler
         self._setup_ydl_opts()
 
     def _setup_ydl_opts(self) -> None:
         """Set up yt-dlp options for audio download."""
+        # Encoding is done by _encode_mp3 rather than a yt-dlp postprocessor so
+        # FFmpeg's progress output can be reported per track.
+        self.encode_args = [
+            '-codec:a', 'libmp3lame',
+            *self.profile['encode_args'],
+            '-ar', '44100',
+            '-ac', '2'
+        ]
         self.ydl_opts = {
             'format': 'bestaudio/best',
-            'postprocessors': [{
-                'key': 'FFmpegExtractAudio',
-                'preferredcodec': 'mp3',
-                'preferredquality': '192',
-            }],
             'outtmpl': os.path.join(self.output_path, '%(title)s.%(ext)s'),
             'quiet': True,
             'no_warnings': True,
             'extract_flat': True,
             'default_search': 'ytsearch',
             'noplaylist': True,
-            'postprocessor_args': [
-                '-codec:a', 'libmp3lame',
-                '-qscale:a', '2',
-                '-ar', '44100',
-                '-ac', '2'
-            ],
+            # Keep .part files and continue them with range requests
+            'continuedl': True,
+            # Error out on stalled connections instead of waiting forever
+            'socket_timeout': 30,
+            # Fetch DASH/HLS fragments in parallel
+            'concurrent_fragment_downloads': self.max_segments,
             # Add these options to handle restrictions
             'nocheckcertificate': True,
             'ignoreerrors': True,
@@ -46,54 +122,385 @@ class YouTubeHandler:
             }
         }
 
-    def search_and_download(self, track_info: Dict) -> Optional[str]:
-        """Search for and download a track based on its metadata."""
+    @staticmethod
+    def _safe_title(track_info: Dict) -> str:
+        return "".join(c for c in track_info['title'] if c.isalnum() or c in (' ', '-', '_')).strip()
+
+    def output_file(self, track_info: Dict) -> str:
+        """Return the path the finished MP3 for a track is published to.
+
+        The Spotify ID in the name keeps different tracks with the same title
+        from overwriting each other.
+        """
+        name = self._safe_title(track_info)
+        if track_info.get('id'):
+            name = f"{name} [{track_info['id']}]"
+        return os.path.join(self.output_path, f"{name}.mp3")
+
+    def legacy_output_file(self, track_info: Dict) -> str:
+        """Return the title-only path earlier versions wrote a track to."""
+        return os.path.join(self.output_path, f"{self._safe_title(track_info)}.mp3")
+
+    def _resume_key(self, track_info: Dict) -> str:
+        """Return the stable name used for a track's partial download."""
+        if track_info.get('id'):
+            return track_info['id']
+        return os.path.splitext(os.path.basename(self.output_file(track_info)))[0]
+
+    def _partial_files(self, key: str) -> List[str]:
+        """Return the partial or unencoded source files kept for a track."""
+        if not os.path.isdir(self.partial_dir):
+            return []
+        return [os.path.join(self.partial_dir, name) for name in os.listdir(self.partial_dir)
+                if name.startswith(f"{key}.")]
+
+    def _discard_partial(self, key: str) -> None:
+        """Delete a track's partial files and forget how they were fetched."""
+        for path in self._partial_files(key):
+            try:
+                os.remove(path)
+            except OSError as e:
+                logging.warning(f"Failed to remove partial download {path}: {str(e)}")
+        if self.resume_store is not None:
+            self.resume_store.delete(key)
+
+    def discard_partial(self, track_info: Dict) -> None:
+        """Throw away whatever was fetched for a track so far."""
+        self._discard_partial(self._resume_key(track_info))
+
+    def prune_partials(self, max_age_days: float = PARTIAL_MAX_AGE_DAYS) -> int:
+        """Discard partial downloads and leftover encodes older than max_age_days."""
+        cutoff = time.time() - max_age_days * 86400
+        pruned = 0
+        # Encodes are published or deleted right away, old ones are from a crash
+        if os.path.isdir(self.scratch_dir):
+            for entry in os.scandir(self.scratch_dir):
+                if entry.is_file() and entry.stat().st_mtime < cutoff:
+                    os.remove(entry.path)
+                    pruned += 1
+        if self.resume_store is None:
+            return pruned
+        for key, entry in self.resume_store.items():
+            if entry.get('updated', 0) < cutoff or not self._partial_files(key):
+                self._discard_partial(key)
+                pruned += 1
+        return pruned
+
+    def download_track(self, track_info: Dict,
+                       progress_callback: Optional[ProgressCallback] = None) -> str:
+        """Search for and download a track, raising DownloadError on failure.
+
+        Unlike search_and_download, the error keeps the failing stage and
+        yt-dlp's message so the caller can decide whether to retry.
+
+        The source stream goes to partial_dir; with a resume_store the chosen
+        video and format are kept so an interrupted download continues on
+        the next attempt. The MP3 is encoded into scratch_dir, with EBU R128
+        loudness measured in the same pass if loudness_analysis is on, and
+        its path returned: the caller publishes it once it is tagged.
+        """
+        # Create search query with additional terms to improve results
+        search_query = f"{track_info['title']} {track_info['artists'][0]} official audio"
+
+        # Pick up an interrupted download of this track if one was kept
+        key = self._resume_key(track_info)
+        resume = self.resume_store.get(key) if self.resume_store is not None else None
+        partial_bytes = sum(os.path.getsize(path) for path in self._partial_files(key))
+        if resume and not partial_bytes:
+            resume = None
+        offset = [partial_bytes if resume else 0]
+        # The resume entry still in effect after format selection, if any
+        kept = [resume]
+
+        def on_select(chosen: Dict) -> None:
+            track_info['source_format'] = chosen
+            # The format id and size act as validators: if YouTube now serves
+            # something else the old bytes would corrupt the new file
+            if kept[0] and (chosen['format_id'] != kept[0].get('format_id')
+                            or chosen['estimated_bytes'] != kept[0].get('size')):
+                logging.info(f"Source changed for {track_info['title']}, discarding partial download")
+                self._discard_partial(key)
+                offset[0] = 0
+                kept[0] = None
+            if self.resume_store is not None:
+                entry = dict(kept[0] or {})
+                entry.update({
+                    'video_url': video_url,
+                    'format_id': chosen['format_id'],
+                    'size': chosen['estimated_bytes'],
+                    'ext': chosen['ext'],
+                    'updated': time.time(),
+                })
+                self.resume_store.set(key, entry)
+
+        # Encode into the scratch area, the caller publishes the finished file
+        output_path = os.path.join(self.scratch_dir, f"{key}.mp3")
+        os.makedirs(self.partial_dir, exist_ok=True)
+        os.makedirs(self.scratch_dir, exist_ok=True)
+        ydl_opts = dict(self.ydl_opts)
+        ydl_opts['outtmpl'] = os.path.join(self.partial_dir, f"{key}.%(ext)s")
+        # Let yt-dlp raise so the reason for a failure isn't lost
+        ydl_opts['ignoreerrors'] = False
+        # Fetch the smallest stream that still meets the output profile, or
+        # the exact stream a partial download was started from
+        ydl_opts['format'] = make_format_selector(
+            self.profile['min_source_kbps'],
+            track_info.get('duration_ms'),
+            on_select,
+            pinned_format_id=resume.get('format_id') if resume else None
+        )
+        # Set by the watchdog when the download runs past its deadline
+        stop = threading.Event()
+        ydl_opts['progress_hooks'] = [self._make_progress_hook(progress_callback, offset, stop)]
+
+        # Add random delay to avoid rate limiting
+        time.sleep(random.uniform(1, 3))
+
+        # Perform search and download
+        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+            if resume:
+                # Same video as last time, no need to search again
+                video_url = resume['video_url']
+                logging.info(f"Resuming {track_info['title']} from {partial_bytes} bytes")
+            else:
+                # First, search for the video
+                with self._stage('search'):
+                    try:
+                        search_result = ydl.extract_info(f"ytsearch:{search_query}", download=False)
+                    except Exception as e:
+                        raise DownloadError('search', str(e))
+                if not search_result or not search_result.get('entries'):
+                    raise DownloadError('search', f"No results found for: {search_query}")
+
+                # Get the first result
+                video_url = search_result['entries'][0]['url']
+
+            # Download the audio stream; on failure the partial file is kept
+            source_path = None
+            try:
+                with self._stage('download', stop.set):
+                    try:
+                        if self.max_segments > 1:
+                            # Resolve the stream first so large files can be fetched in segments
+                            info = ydl.extract_info(video_url, download=False)
+                            if info and self._use_segments(info, kept[0]):
+                                source_path = self._download_segmented(info, key, progress_callback, stop)
+                            elif info:
+                                info = ydl.process_ie_result(info, download=True)
+                        else:
+                            info = ydl.extract_info(video_url, download=True)
+                    except Exception as e:
+                        raise DownloadError('download', str(e))
+            except StageTimeout:
+                # Don't resume from a source that hung
+                self._discard_partial(key)
+                raise
+            if not info:
+                raise DownloadError('download', f"Failed to download {search_query}")
+            if source_path is None:
+                source_path = self._downloaded_path(ydl, info)
+
+        # Encode to MP3 and return the path to the scratch file
+        loudness = {}
         try:
-            # Create search query with additional terms to improve results
-            search_query = f"{track_info['title']} {track_info['artists'][0]} official audio"
-            
-            # Update output template for this specific track
-            safe_title = "".join(c for c in track_info['title'] if c.isalnum() or c in (' ', '-', '_')).strip()
-            self.ydl_opts['outtmpl'] = os.path.join(
-                self.output_path,
-                f"{safe_title}.%(ext)s"
-            )
+            self._encode_mp3(source_path, output_path, track_info.get('duration_ms'), progress_callback, loudness)
+        finally:
+            self._discard_partial(key)
+        if loudness:
+            track_info['loudness'] = loudness
+        return output_path
 
-            # Add random delay to avoid rate limiting
-            time.sleep(random.uniform(1, 3))
-
-            # Perform search and download
-            with yt_dlp.YoutubeDL(self.ydl_opts) as ydl:
-                try:
-                    # First, search for the video
-                    search_result = ydl.extract_info(f"ytsearch:{search_query}", download=False)
-                    if not search_result['entries']:
-                        logging.warning(f"No results found for: {search_query}")
-                        return None
-
-                    # Get the first result
-                    video_url = search_result['entries'][0]['url']
-                    
-                    # Download the video
-                    ydl.download([video_url])
-                    
-                    # Return the path to the downloaded file
-                    return os.path.join(
-                        self.output_path,
-                        f"{safe_title}.mp3"
-                    )
-                except Exception as e:
-                    logging.error(f"Failed to download {search_query}: {str(e)}")
-                    return None
+    def _use_segments(self, info: Dict, resume: Optional[Dict]) -> bool:
+        """Return whether the selected stream should be fetched in parallel segments."""
+        if resume is not None and 'segmented' in resume:
+            # Finish a partial download the same way it was started
+            return resume['segmented']
+        if resume is not None:
+            return False
+        return (
+            info.get('protocol') in ('http', 'https')
+            and bool(info.get('url'))
+            and segment_count(info.get('filesize') or 0, self.max_segments) > 1
+        )
+
+    @contextmanager
+    def _stage(self, name: str, on_timeout: Optional[Callable[[], None]] = None) -> Iterator[None]:
+        """Run a stage under the watchdog's deadline and the profiler, if any.
+
+        When the deadline passes, on_timeout stops the work (a download at
+        its next chunk, FFmpeg by being killed) and the stage raises
+        StageTimeout.
+        """
+        with self.watchdog.stage(name, on_timeout) if self.watchdog else nullcontext(), \
+                self.profiler.stage(name) if self.profiler else nullcontext():
+            yield
+
+    def _download_segmented(self, info: Dict, key: str,
+                            progress_callback: Optional[ProgressCallback],
+                            stop: Optional[threading.Event] = None) -> str:
+        """Fetch a large stream with parallel range requests into the partial folder.
+
+        Used when max_segments is above 1; fragmented formats instead get
+        that many concurrent fragment downloads from yt-dlp.
+        """
+        path = os.path.join(self.partial_dir, f"{key}.{info['ext']}")
+        size = info['filesize']
+        entry = (self.resume_store.get(key) if self.resume_store is not None else None) or {}
+        entry.setdefault('segments', segment_count(size, self.max_segments))
+        entry['segmented'] = True
+        done = set(entry.get('segments_done') or [])
+        lock = threading.Lock()
+
+        def save_entry() -> None:
+            if self.resume_store is not None:
+                self.resume_store.set(key, dict(entry, segments_done=sorted(done)))
+
+        def on_segment_done(index: int) -> None:
+            with lock:
+                done.add(index)
+                save_entry()
+
+        def report(fetched: int, remaining: int) -> None:
+            if progress_callback:
+                progress_callback('download', fetched, remaining)
+
+        def consume(amount: int) -> None:
+            if stop is not None and stop.is_set():
+                raise IOError("Download stopped by the watchdog")
+            self.governor.consume(amount)
+
+        save_entry()
+        download_segmented(
+            info['url'], f"{path}.part", size, entry['segments'],
+            headers=info.get('http_headers'),
+            done=done,
+            consume=consume,
+            progress=report,
+            on_segment_done=on_segment_done
+        )
+        os.replace(f"{path}.part", path)
+        return path
 
+    def search_and_download(self, track_info: Dict,
+                            progress_callback: Optional[ProgressCallback] = None) -> Optional[str]:
+        """Search for and download a track based on its metadata."""
+        try:
+            return self.download_track(track_info, progress_callback)
         except Exception as e:
             logging.error(f"Error in search_and_download: {str(e)}")
             return None
 
-    def verify_download(self, file_path: str) -> bool:
-        """Verify that a downloaded file exists and is valid."""
+    def _make_progress_hook(self, progress_callback: Optional[ProgressCallback],
+                            offset: Optional[List[int]] = None,
+                            stop: Optional[threading.Event] = None) -> Callable[[Dict], None]:
+        """Build a yt-dlp progress hook that forwards byte progress.
+
+        offset[0] holds the bytes a resumed download already had on disk, which
+        yt-dlp includes in its counts but weren't transferred in this attempt.
+        The hook runs in yt-dlp's read loop, so blocking in the bandwidth
+        governor here throttles the transfer itself, and raising here (once
+        stop is set) aborts it.
+        """
+        seen = [0]
+
+        def hook(d: Dict) -> None:
+            if stop is not None and stop.is_set():
+                raise DownloadError('download', "Download stopped by the watchdog")
+            if d.get('status') in ('downloading', 'finished'):
+                skipped = offset[0] if offset else 0
+                downloaded = max((d.get('downloaded_bytes') or 0) - skipped, 0)
+                delta = downloaded - seen[0]
+                seen[0] = downloaded
+                self.governor.consume(delta if delta >= 0 else downloaded)
+                if progress_callback:
+                    total = d.get('total_bytes') or d.get('total_bytes_estimate')
+                    progress_callback(
+                        'download',
+                        downloaded,
+                        total - skipped if total and total > skipped else total
+                    )
+        return hook
+
+    def _downloaded_path(self, ydl: yt_dlp.YoutubeDL, info: Dict) -> str:
+        """Return the path of the media file yt-dlp just wrote."""
+        for download in info.get('requested_downloads') or []:
+            if download.get('filepath'):
+                return download['filepath']
+        return ydl.prepare_filename(info)
+
+    def _encode_mp3(self, source_path: str, output_path: str, duration_ms: Optional[int],
+                    progress_callback: Optional[ProgressCallback] = None,
+                    loudness: Optional[Dict] = None) -> None:
+        """Encode a downloaded stream to MP3, reporting FFmpeg's progress.
+
+        If loudness analysis is enabled the ebur128 filter runs in the same
+        pass and its results are written into the loudness dict.
+        """
+        analyse = self.loudness_analysis and loudness is not None
+        cmd = [
+            find_ffmpeg(), '-y', '-nostdin', '-hide_banner',
+            # The ebur128 summary is logged at info level
+            '-loglevel', 'info' if analyse else 'error', '-nostats', '-progress', 'pipe:1',
+            '-i', source_path, '-vn'
+        ]
+        if analyse:
+            # framelog=verbose keeps the per-frame lines out of the info log
+            cmd += ['-af', 'ebur128=peak=true:framelog=verbose']
+        cmd += [*self.encode_args, output_path]
+        try:
+            process = subprocess.Popen(
+                cmd,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                text=True,
+                creationflags=getattr(subprocess, 'CREATE_NO_WINDOW', 0)
+            )
+            # Drain stderr on a separate thread so a chatty log can't block the encode
+            stderr_lines = []
+            stderr_reader = threading.Thread(target=lambda: stderr_lines.extend(process.stderr), daemon=True)
+            stderr_reader.start()
+            # A hung FFmpeg is killed, which ends the loop below
+            with self._stage('encode', process.kill):
+                for line in process.stdout:
+                    key, _, value = line.strip().partition('=')
+                    # Despite the name, out_time_ms is in microseconds as well
+                    if key in ('out_time_us', 'out_time_ms') and value.isdigit() and progress_callback:
+                        progress_callback('encode', int(value) / 1000, duration_ms)
+                returncode = process.wait()
+                stderr_reader.join()
+                stderr = ''.join(stderr_lines)
+                if returncode != 0:
+                    if os.path.exists(output_path):
+                        os.remove(output_path)
+                    raise DownloadError('encode', f"FFmpeg failed to encode {source_path}: {stderr.strip()[-2000:]}")
+            if analyse:
+                result = parse_ebur128_summary(stderr)
+                if result:
+                    loudness.update(result)
+                else:
+                    logging.warning(f"No loudness summary from FFmpeg for {source_path}")
+        except (DownloadError, StageTimeout):
+            raise
+        except Exception as e:
+            raise DownloadError('encode', f"Error encoding {source_path}: {str(e)}")
+        finally:
+            if os.path.exists(source_path):
+                os.remove(source_path)
+
+    def verify_download(self, file_path: str, track_info: Optional[Dict] = None) -> bool:
+        """Verify that a downloaded file exists and is valid.
+
+        The MPEG frame structure is walked to catch truncated or corrupt
+        encodes, and the duration is compared with the Spotify track's.
+        """
         try:
-            return os.path.exists(file_path) and os.path.getsize(file_path) > 0
+            if not os.path.exists(file_path) or os.path.getsize(file_path) == 0:
+                return False
+            expected_ms = track_info.get('duration_ms') if track_info else None
+            report = verify_mp3(file_path, expected_ms)
+            if not report['ok']:
+                logging.warning(f"Verification of {file_path} failed: {', '.join(report['problems'])}")
+            return report['ok']
         except Exception as e:
             logging.error(f"Error verifying download {file_path}: {str(e)}")
             return False 
\ No newline at end of file